@@ -0,0 +1,324 @@
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+MAX_PAGE_SIZE = 50
+
+
+def _image(width):
+    return {"url": f"https://i.scdn.co/image/{width}", "width": width, "height": width}
+
+
+def _track(i):
+    return {
+        "id": f"track{i}",
+        "name": f"Track {i}",
+        "uri": f"spotify:track:track{i}",
+        "artists": [{"id": f"artist{i % 20}", "name": f"Artist {i % 20}"}],
+        "album": {"name": f"Album {i}", "images": [_image(640), _image(300)]},
+        "external_urls": {"spotify": f"https://open.spotify.com/track/track{i}"},
+    }
+
+
+def _artist(i):
+    return {
+        "id": f"artist{i}",
+        "name": f"Artist {i}",
+        "genres": ["pop", f"genre {i % 7}"],
+        "images": [_image(640), _image(320)],
+        "followers": {"total": 1000 * i},
+        "external_urls": {"spotify": f"https://open.spotify.com/artist/artist{i}"},
+    }
+
+
+def _playlist(user_id, i):
+    return {
+        "id": f"{user_id}-playlist{i}",
+        "name": "Recommended Tracks" if i == 0 else f"Playlist {i}",
+        "public": i % 2 == 0,
+        "owner": {"id": user_id},
+        "images": [_image(640)],
+        "external_urls": {"spotify": f"https://open.spotify.com/playlist/{i}"},
+    }
+
+
+class FakeSpotify:
+    """
+    It is a stand-in for the Spotify Web API and accounts service that runs on a local port, so the
+    app can be benchmarked without a network. Every user has the same generated library, requests
+    can be slowed down by `latency` seconds, and a share of the Web API requests can be answered with
+    a 429, like Spotify does when rate limiting. It counts every request it serves by method and route
+
+    Args:
+      latency: The number of seconds each request takes.
+      rate_limit: The share of Web API requests, from 0 to 1, answered with a 429.
+      retry_after: The value of the Retry-After header of a 429.
+      top_items: The number of top tracks and top artists of every user.
+      playlists: The number of playlists of every user.
+      recently_played: The number of recently played tracks of every user.
+    """
+
+    def __init__(
+        self,
+        latency=0.0,
+        rate_limit=0.0,
+        retry_after=0,
+        top_items=50,
+        playlists=60,
+        recently_played=50,
+    ):
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.top_items = top_items
+        self.playlists = playlists
+        self.recently_played = recently_played
+        # plays are spaced 3 minutes apart before this, so they're the same on every call
+        self.started_at = int(time.time())
+        self.calls = Counter()
+        self._lock = threading.Lock()
+        self._server = None
+        self._thread = None
+        self._routes = [
+            ("GET", r"me", self.me),
+            ("GET", r"me/top/tracks", self.top_tracks),
+            ("GET", r"me/top/artists", self.top_artists),
+            ("GET", r"me/player/currently-playing", self.currently_playing),
+            ("GET", r"me/player/recently-played", self.recently_played_tracks),
+            ("POST", r"me/player/queue", self.no_content),
+            ("GET", r"me/playlists", self.my_playlists),
+            ("GET", r"users/([^/]+)/playlists", self.user_playlists),
+            ("POST", r"users/([^/]+)/playlists", self.create_playlist),
+            ("GET", r"playlists/([^/]+)", self.playlist),
+            ("GET", r"playlists/([^/]+)/tracks", self.playlist_tracks),
+            ("GET", r"playlists/([^/]+)/followers/contains", self.playlist_followers_contain),
+            ("POST", r"playlists/([^/]+)/tracks", self.add_playlist_tracks),
+            ("GET", r"tracks", self.tracks),
+            ("GET", r"artists", self.artists),
+            ("POST", r"api/token", self.token),
+        ]
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def api_prefix(self):
+        return f"{self.url}/v1/"
+
+    def start(self, host="127.0.0.1", port=0):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                fake._handle(self, "GET")
+
+            def do_POST(self):
+                fake._handle(self, "POST")
+
+            def do_PUT(self):
+                fake._handle(self, "PUT")
+
+            def do_DELETE(self):
+                fake._handle(self, "DELETE")
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name="fake-spotify", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls.clear()
+
+    def total_calls(self):
+        with self._lock:
+            return sum(self.calls.values())
+
+    def _handle(self, request, method):
+        url = urlsplit(request.path)
+        path = url.path.strip("/")
+        if path.startswith("v1/"):
+            path = path[3:]
+        query = dict(parse_qsl(url.query))
+        length = int(request.headers.get("Content-Length") or 0)
+        body = request.rfile.read(length) if length else b""
+        if body and "json" in (request.headers.get("Content-Type") or ""):
+            body = json.loads(body)
+        elif body:
+            body = dict(parse_qsl(body.decode()))
+        user_id = self._user_id(request.headers.get("Authorization", ""))
+
+        for route_method, pattern, handler in self._routes:
+            match = re.fullmatch(pattern, path)
+            if route_method == method and match:
+                route = f"{method} {pattern.replace('([^/]+)', '{id}')}"
+                break
+        else:
+            route, handler, match = f"{method} {path}", None, None
+
+        with self._lock:
+            self.calls[route] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        # like Spotify, only the Web API is rate limited, not the accounts service
+        is_api = route != "POST api/token"
+        if is_api and self.rate_limit and random.random() < self.rate_limit:
+            return self._respond(
+                request, 429, {"error": {"status": 429}}, {"Retry-After": self.retry_after}
+            )
+        if handler is None:
+            return self._respond(request, 404, {"error": {"status": 404}})
+        status, payload = handler(user_id, query, body, *match.groups())
+        self._respond(request, status, payload)
+
+    @staticmethod
+    def _respond(request, status, payload, headers=None):
+        data = b"" if payload is None else json.dumps(payload).encode()
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            request.send_header(name, str(value))
+        request.end_headers()
+        request.wfile.write(data)
+
+    @staticmethod
+    def _user_id(authorization):
+        # access tokens are handed out as "access-<user_id>" by the token endpoint
+        token = authorization.replace("Bearer ", "")
+        return token[len("access-"):] if token.startswith("access-") else "anonymous"
+
+    def _page(self, items, query, href):
+        limit = min(int(query.get("limit", 20)), MAX_PAGE_SIZE)
+        offset = int(query.get("offset", 0))
+        page = items[offset : offset + limit]
+        next_offset = offset + limit
+        return {
+            "href": href,
+            "items": page,
+            "limit": limit,
+            "offset": offset,
+            "total": len(items),
+            "next": f"{self.api_prefix}{href}?offset={next_offset}&limit={limit}"
+            if next_offset < len(items)
+            else None,
+        }
+
+    def me(self, user_id, query, body):
+        return 200, {
+            "id": user_id,
+            "display_name": f"User {user_id}",
+            "images": [_image(640)],
+            "followers": {"total": 42},
+            "external_urls": {"spotify": f"https://open.spotify.com/user/{user_id}"},
+        }
+
+    def top_tracks(self, user_id, query, body):
+        items = [_track(i) for i in range(self.top_items)]
+        return 200, self._page(items, query, "me/top/tracks")
+
+    def top_artists(self, user_id, query, body):
+        items = [_artist(i) for i in range(self.top_items)]
+        return 200, self._page(items, query, "me/top/artists")
+
+    def currently_playing(self, user_id, query, body):
+        return 200, {"is_playing": True, "progress_ms": 1000, "item": _track(7)}
+
+    def recently_played_tracks(self, user_id, query, body):
+        limit = min(int(query.get("limit", 20)), MAX_PAGE_SIZE)
+        after = int(query.get("after", 0))
+        items = []
+        for i in range(self.recently_played):
+            played_at = (self.started_at - 180 * i) * 1000
+            if played_at <= after or len(items) == limit:
+                break
+            items.append(
+                {
+                    "track": _track(i),
+                    "played_at": time.strftime(
+                        "%Y-%m-%dT%H:%M:%S.000Z", time.gmtime(played_at / 1000)
+                    ),
+                    "played_at_ms": played_at,
+                }
+            )
+        cursors = (
+            {"after": str(items[0]["played_at_ms"]), "before": str(items[-1]["played_at_ms"])}
+            if items
+            else None
+        )
+        for item in items:
+            del item["played_at_ms"]
+        return 200, {"items": items, "next": None, "cursors": cursors, "limit": limit}
+
+    def no_content(self, user_id, query, body):
+        return 204, None
+
+    def my_playlists(self, user_id, query, body):
+        return self.user_playlists(user_id, query, body, user_id)
+
+    def user_playlists(self, user_id, query, body, owner_id):
+        items = [_playlist(owner_id, i) for i in range(self.playlists)]
+        return 200, self._page(items, query, f"users/{owner_id}/playlists")
+
+    def create_playlist(self, user_id, query, body, owner_id):
+        return 201, {**_playlist(owner_id, 0), "id": f"{owner_id}-created"}
+
+    def playlist(self, user_id, query, body, playlist_id):
+        return 200, {
+            "id": playlist_id,
+            "name": playlist_id,
+            "followers": {"total": 7},
+            "external_urls": {"spotify": f"https://open.spotify.com/playlist/{playlist_id}"},
+        }
+
+    def playlist_tracks(self, user_id, query, body, playlist_id):
+        return 200, self._page([], query, f"playlists/{playlist_id}/tracks")
+
+    def playlist_followers_contain(self, user_id, query, body, playlist_id):
+        return 200, [True for _ in query.get("ids", "").split(",")]
+
+    def add_playlist_tracks(self, user_id, query, body, playlist_id):
+        return 201, {"snapshot_id": "snapshot"}
+
+    def tracks(self, user_id, query, body):
+        ids = query.get("ids", "").split(",")
+        return 200, {"tracks": [_track(int(i[len("track"):])) for i in ids if i]}
+
+    def artists(self, user_id, query, body):
+        ids = query.get("ids", "").split(",")
+        return 200, {"artists": [_artist(int(i[len("artist"):])) for i in ids if i]}
+
+    def token(self, user_id, query, body):
+        # an authorization code is "code-<user_id>", a refresh token "refresh-<user_id>"
+        if body.get("grant_type") == "refresh_token":
+            user_id = body["refresh_token"][len("refresh-"):]
+        else:
+            user_id = body.get("code", "code-anonymous")[len("code-"):]
+        return 200, {
+            "access_token": f"access-{user_id}",
+            "refresh_token": f"refresh-{user_id}",
+            "token_type": "Bearer",
+            "scope": "",
+            "expires_in": 3600,
+        }
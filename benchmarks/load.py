@@ -0,0 +1,207 @@
+"""
+It load tests the app over HTTP, served the way production serves it, by gunicorn with
+gunicorn.conf.py, and the way `python routes.py` serves it, by the development server, and compares
+their throughput. Both serve the app of benchmarks/load_app.py, against the FakeSpotify server and
+mongomock. Every connection sends its next request as soon as the previous one is answered, and the
+requests of the first `--warmup` seconds aren't counted.
+
+Usage:
+  python -m benchmarks.load
+  python -m benchmarks.load --latency 0.05 --connections 64 --workers 4 --threads 16
+  python -m benchmarks.load --server gunicorn --path /user/<id>/currently_playing
+"""
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+from rich.console import Console
+from rich.table import Table
+
+from benchmarks.fake_spotify import FakeSpotify
+from benchmarks.run import percentile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# The ids of the seeded users are this prefix followed by a number
+USER_PREFIX = "load"
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def command(server, port):
+    if server == "gunicorn":
+        return [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            "-c",
+            "gunicorn.conf.py",
+            "--bind",
+            f"127.0.0.1:{port}",
+            "benchmarks.load_app:app",
+        ]
+    return [sys.executable, "-m", "benchmarks.load_app", "--port", str(port)]
+
+
+def wait_until_ready(url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"the server exited with {process.returncode}")
+        try:
+            if requests.get(f"{url}/index", timeout=1).status_code == 200:
+                return
+        except requests.exceptions.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"the server didn't answer within {timeout}s")
+
+
+def load(url, path, users, connections, duration, warmup):
+    """
+    It sends requests from `connections` threads, each with its own keep-alive connection, for
+    `warmup` + `duration` seconds
+
+    Returns:
+      A dictionary with the number of requests and errors counted, the requests per second, and the
+      p50 and p99 latency.
+    """
+    started = time.monotonic()
+    counted_from, deadline = started + warmup, started + warmup + duration
+    latencies, errors, lock = [], [0], threading.Lock()
+
+    def connection(index):
+        session = requests.Session()
+        i = index
+        while True:
+            sent = time.monotonic()
+            if sent >= deadline:
+                return
+            url_path = path.replace("<id>", f"{USER_PREFIX}{i % users}")
+            i += connections
+            try:
+                failed = session.get(f"{url}{url_path}", timeout=30).status_code >= 400
+            except requests.exceptions.RequestException:
+                failed = True
+            answered = time.monotonic()
+            if sent < counted_from:
+                continue
+            with lock:
+                latencies.append(answered - sent)
+                errors[0] += failed
+
+    threads = [threading.Thread(target=connection, args=(i,)) for i in range(connections)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return {
+        "requests": len(latencies),
+        "errors": errors[0],
+        "rps": len(latencies) / duration,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+    }
+
+
+def serve_and_load(server, args, env):
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    with open(os.path.join(args.logs, f"load_{server}.log"), "w") as log:
+        process = subprocess.Popen(
+            command(server, port), cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT
+        )
+        try:
+            wait_until_ready(url, process)
+            return load(
+                url, args.path, args.users, args.connections, args.duration, args.warmup
+            )
+        finally:
+            process.terminate()
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def report(results, console):
+    table = Table(title="Load test")
+    columns = ("server", "requests", "errors", "req/s", "p50 ms", "p99 ms")
+    for column in columns:
+        table.add_column(column, justify="left" if column == "server" else "right")
+    for server, result in results.items():
+        table.add_row(
+            server,
+            str(result["requests"]),
+            str(result["errors"]),
+            f"{result['rps']:.1f}",
+            f"{result['p50_ms']:.1f}",
+            f"{result['p99_ms']:.1f}",
+        )
+    console.print(table)
+    if "gunicorn" in results and "dev" in results and results["dev"]["rps"]:
+        console.print(
+            f"gunicorn served {results['gunicorn']['rps'] / results['dev']['rps']:.1f}x the "
+            "requests per second of the development server"
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test gunicorn against the dev server")
+    parser.add_argument(
+        "--server", choices=("gunicorn", "dev"), action="append", help="only run these servers"
+    )
+    parser.add_argument("--path", default="/user/<id>", help='"<id>" is replaced by a user id')
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--connections", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10, help="seconds counted")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds not counted")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds per Spotify call")
+    parser.add_argument("--workers", type=int, default=4, help="gunicorn workers")
+    parser.add_argument("--threads", type=int, default=16, help="threads per gunicorn worker")
+    parser.add_argument("--redis-url", help="a Redis to share between the workers")
+    parser.add_argument("--logs", default=".", help="where to write the servers' logs")
+    parser.add_argument("--json", help="write the results to this file")
+    args = parser.parse_args(argv)
+
+    from cryptography.fernet import Fernet
+
+    console = Console()
+    fake = FakeSpotify(latency=args.latency).start()
+    env = {
+        **os.environ,
+        "LOAD_FAKE_SPOTIFY_URL": fake.url,
+        "LOAD_USERS": str(args.users),
+        # every worker has to decrypt the tokens the others seeded
+        "ENCRYPTION_KEY": os.getenv("ENCRYPTION_KEY") or Fernet.generate_key().decode(),
+        "WEB_CONCURRENCY": str(args.workers),
+        "GUNICORN_THREADS": str(args.threads),
+        "PYTHONPATH": ROOT,
+    }
+    if args.redis_url:
+        env["LOAD_REDIS_URL"] = args.redis_url
+    results = {}
+    try:
+        for server in args.server or ("dev", "gunicorn"):
+            results[server] = serve_and_load(server, args, env)
+    finally:
+        fake.stop()
+
+    report(results, console)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
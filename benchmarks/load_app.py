@@ -0,0 +1,35 @@
+"""
+It is the app as benchmarks/load.py serves it: pointed at the FakeSpotify server load.py started,
+with mongomock as its database and the load test's users seeded in every process serving it. Under
+gunicorn it's imported by every worker, and run as a module it serves the app with the development
+server, like `python routes.py` does.
+
+Usage:
+  gunicorn -c gunicorn.conf.py benchmarks.load_app:app
+  python -m benchmarks.load_app --port 8001
+"""
+import argparse
+import os
+
+from benchmarks import run as bench
+from benchmarks.load import USER_PREFIX
+
+_fake_url = os.environ["LOAD_FAKE_SPOTIFY_URL"]
+_args = argparse.Namespace(
+    fake=argparse.Namespace(url=_fake_url, api_prefix=f"{_fake_url}/v1/"),
+    spotify_rate_limit=float(os.getenv("LOAD_SPOTIFY_RATE_LIMIT", 0)),
+    redis_url=os.getenv("LOAD_REDIS_URL"),
+    mongo_uri=None,
+)
+routes = bench.setup(_args, bench.MongoOps())
+bench.seed_users(routes, USER_PREFIX, int(os.getenv("LOAD_USERS", 20)))
+app = routes.app
+start_worker = routes.start_worker
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the load test's app with the dev server")
+    parser.add_argument("--port", type=int, default=8001)
+    port = parser.parse_args().port
+    start_worker()
+    app.run(host="127.0.0.1", port=port, request_handler=routes.MyRequestHandler)
@@ -0,0 +1,365 @@
+"""
+It benchmarks the app end to end without touching Spotify or a real database. The Flask app is
+driven through its test client, Spotify is replaced by the local FakeSpotify server and MongoDB by
+mongomock (or a local mongod with --mongo-uri). For every scenario it reports the p50 and p99
+latency, and the number of Spotify calls and Mongo operations per request, and with --check it
+fails when a scenario makes more calls than benchmarks/budgets.json allows.
+
+Usage:
+  python -m benchmarks.run
+  python -m benchmarks.run --latency 0.05 --requests 50 --concurrency 8
+  python -m benchmarks.run --rate-limit 0.05 --scenario /user/<id> --verbose
+  python -m benchmarks.run --check
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock, local
+
+from rich.console import Console
+from rich.table import Table
+
+from benchmarks.fake_spotify import FakeSpotify
+
+BUDGETS_PATH = os.path.join(os.path.dirname(__file__), "budgets.json")
+
+# name, HTTP method, path; "<id>" is replaced by a user id and "<code>" by an authorization code
+SCENARIOS = [
+    ("/callback", "get", "/callback?code=<code>"),
+    ("/user/<id>", "get", "/user/<id>"),
+    ("/user/<id>/top_tracks", "get", "/user/<id>/top_tracks"),
+    ("/user/<id>/top_artists", "get", "/user/<id>/top_artists"),
+    ("/user/<id>/top_genres", "get", "/user/<id>/top_genres"),
+    ("/user/<id>/public_playlists", "get", "/user/<id>/public_playlists"),
+    ("/user/<id>/recently_played", "get", "/user/<id>/recently_played"),
+    ("/user/<id>/currently_playing", "get", "/user/<id>/currently_playing"),
+    (
+        "/user/<id>/add_track_to_recommended_playlist",
+        "post",
+        "/user/<id>/add_track_to_recommended_playlist",
+    ),
+]
+# The form posted by the scenarios that post one
+SCENARIO_FORMS = {
+    "/user/<id>/add_track_to_recommended_playlist": {
+        "link": "https://open.spotify.com/track/4cOdK2wGLETKBW3PvgPWqT"
+    },
+}
+
+
+class MongoOps:
+    """
+    It counts the operations the app sends to MongoDB, by name. With mongomock it wraps the methods
+    of its Collection, only counting the outermost call since mongomock implements some operations
+    with others, and with a real server it listens to pymongo's command events
+    """
+
+    OPERATIONS = (
+        "find_one",
+        "find",
+        "insert_one",
+        "insert_many",
+        "update_one",
+        "update_many",
+        "replace_one",
+        "delete_one",
+        "delete_many",
+        "bulk_write",
+        "aggregate",
+        "count_documents",
+        "find_one_and_update",
+    )
+
+    def __init__(self):
+        self.ops = Counter()
+        self._lock = Lock()
+        self._local = local()
+
+    def count(self, name):
+        with self._lock:
+            self.ops[name] += 1
+
+    def reset(self):
+        with self._lock:
+            self.ops.clear()
+
+    def total(self):
+        with self._lock:
+            return sum(self.ops.values())
+
+    def patch_mongomock(self):
+        import mongomock
+        import pymongo
+
+        for name in self.OPERATIONS:
+            method = getattr(mongomock.collection.Collection, name, None)
+            if method is None:
+                continue
+
+            def counted(collection, *args, _method=method, _name=name, **kwargs):
+                if getattr(self._local, "inside", False):
+                    return _method(collection, *args, **kwargs)
+                self.count(_name)
+                self._local.inside = True
+                try:
+                    return _method(collection, *args, **kwargs)
+                finally:
+                    self._local.inside = False
+
+            setattr(mongomock.collection.Collection, name, counted)
+        pymongo.MongoClient = mongomock.MongoClient
+
+    def listen(self):
+        from pymongo import monitoring
+
+        ops = self
+
+        class Listener(monitoring.CommandListener):
+            def started(self, event):
+                if event.command_name not in ("endSessions", "hello", "isMaster", "ping"):
+                    ops.count(event.command_name)
+
+            def succeeded(self, event):
+                pass
+
+            def failed(self, event):
+                pass
+
+        monitoring.register(Listener())
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    index = min(len(values) - 1, max(0, round(p / 100 * len(values) + 0.5) - 1))
+    return values[index]
+
+
+def setup(args, mongo_ops):
+    """
+    It points the app at the fake Spotify server and the chosen database and cache, then imports it
+
+    Returns:
+      The `routes` module.
+    """
+    os.environ["SPOTIFY_API_PREFIX"] = args.fake.api_prefix
+    os.environ["SPOTIFY_ACCOUNTS_URL"] = args.fake.url
+    os.environ.setdefault("SPOTIFY_CLIENT_ID", "benchmark")
+    os.environ.setdefault("SPOTIFY_CLIENT_SECRET", "benchmark")
+    os.environ.setdefault("SPOTIFY_REDIRECT_URI", "http://localhost/callback")
+    os.environ["SPOTIFY_RATE_LIMIT"] = str(args.spotify_rate_limit)
+    # submissions are only timed up to being queued, their flush would land in a later pass
+    os.environ["SUBMISSION_FLUSH_INTERVAL"] = "3600"
+    # the app's logs go to the console only, never to a .log file in the working tree
+    os.environ["LOG_FILE"] = ""
+    if not os.getenv("ENCRYPTION_KEY"):
+        from cryptography.fernet import Fernet
+
+        os.environ["ENCRYPTION_KEY"] = Fernet.generate_key().decode()
+    if args.redis_url:
+        os.environ["CACHE_TYPE"] = "redis"
+        os.environ["REDIS_URL"] = args.redis_url
+    else:
+        os.environ["CACHE_TYPE"] = "SimpleCache"
+    if args.mongo_uri:
+        os.environ["MONGO_URI"] = args.mongo_uri
+        mongo_ops.listen()
+    else:
+        mongo_ops.patch_mongomock()
+
+    import routes
+
+    routes.app.secret_key = "benchmark"
+    routes.app.config["TESTING"] = True
+    logging.getLogger("spotify").setLevel(logging.WARNING)
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    return routes
+
+
+def seed_users(routes, prefix, count):
+    from functions import util
+
+    user_ids = [f"{prefix}{i}" for i in range(count)]
+    for user_id in user_ids:
+        token = {
+            "access_token": f"access-{user_id}",
+            "refresh_token": f"refresh-{user_id}",
+            "token_type": "Bearer",
+            "scope": "",
+            "expires_in": 3600,
+            "expires_at": int(time.time()) + 3600,
+        }
+        routes.users.create(user_id, user_id=user_id, **util.token_fields(token))
+    return user_ids
+
+
+def run_pass(routes, fake, mongo_ops, method, path, user_ids, concurrency, form=None):
+    def request(user_id):
+        client = routes.app.test_client()
+        url = path.replace("<id>", user_id).replace("<code>", f"code-{user_id}")
+        started = time.perf_counter()
+        try:
+            status = getattr(client, method)(url, data=form).status_code
+        except Exception:
+            status = 500
+        return time.perf_counter() - started, status
+
+    fake.reset_calls()
+    mongo_ops.reset()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        responses = list(executor.map(request, user_ids))
+    latencies = [elapsed for elapsed, _ in responses]
+    return {
+        "requests": len(latencies),
+        "errors": sum(status >= 400 for _, status in responses),
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "spotify_calls": fake.total_calls() / len(latencies),
+        "mongo_ops": mongo_ops.total() / len(latencies),
+        "spotify_routes": dict(fake.calls),
+        "mongo_operations": dict(mongo_ops.ops),
+    }
+
+
+def run(args):
+    """
+    It runs every selected scenario twice on its own fresh users: a cold pass, where nothing is
+    cached yet, then a warm pass over the same users
+
+    Returns:
+      A dictionary mapping "<scenario> (cold|warm)" to its results.
+    """
+    mongo_ops = MongoOps()
+    routes = setup(args, mongo_ops)
+    results = {}
+    for index, (name, method, path) in enumerate(SCENARIOS):
+        if args.scenario and name not in args.scenario:
+            continue
+        prefix = f"bench{int(time.time())}s{index}u"
+        if "<code>" in path:
+            # /callback creates the users itself
+            user_ids = [f"{prefix}{i}" for i in range(args.requests)]
+        else:
+            user_ids = seed_users(routes, prefix, args.requests)
+        for temperature in ("cold", "warm"):
+            results[f"{name} ({temperature})"] = run_pass(
+                routes,
+                args.fake,
+                mongo_ops,
+                method,
+                path,
+                user_ids,
+                args.concurrency,
+                SCENARIO_FORMS.get(name),
+            )
+    return results
+
+
+def report(results, verbose, console):
+    table = Table(title="Benchmark")
+    columns = ("scenario", "requests", "errors", "p50 ms", "p99 ms", "spotify/req", "mongo/req")
+    for column in columns:
+        table.add_column(column, justify="left" if column == "scenario" else "right")
+    for name, result in results.items():
+        table.add_row(
+            name,
+            str(result["requests"]),
+            str(result["errors"]),
+            f"{result['p50_ms']:.1f}",
+            f"{result['p99_ms']:.1f}",
+            f"{result['spotify_calls']:.2f}",
+            f"{result['mongo_ops']:.2f}",
+        )
+    console.print(table)
+    if verbose:
+        for name, result in results.items():
+            console.print(f"[bold]{name}[/bold]")
+            for route, count in sorted(result["spotify_routes"].items()):
+                console.print(f"  spotify {route}: {count / result['requests']:.2f}/req")
+            for operation, count in sorted(result["mongo_operations"].items()):
+                console.print(f"  mongo {operation}: {count / result['requests']:.2f}/req")
+
+
+def check(results, budgets, console):
+    """
+    It compares the calls per request of every scenario with its budget
+
+    Returns:
+      True if every scenario is within its budget and answered every request.
+    """
+    ok = True
+    for name, result in results.items():
+        if result["errors"]:
+            ok = False
+            console.print(f"[red]{name}: {result['errors']} requests failed[/red]")
+        budget = budgets.get(name)
+        if budget is None:
+            continue
+        for metric in ("spotify_calls", "mongo_ops"):
+            if metric in budget and result[metric] > budget[metric]:
+                ok = False
+                console.print(
+                    f"[red]{name}: {result[metric]:.2f} {metric} per request, "
+                    f"the budget is {budget[metric]}[/red]"
+                )
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the app against a fake Spotify")
+    parser.add_argument("--requests", type=int, default=20, help="requests per pass")
+    parser.add_argument("--concurrency", type=int, default=1)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds per Spotify call")
+    parser.add_argument(
+        "--rate-limit", type=float, default=0.0, help="share of Spotify calls answered with 429"
+    )
+    parser.add_argument("--retry-after", type=int, default=0)
+    parser.add_argument(
+        "--spotify-rate-limit",
+        type=float,
+        default=0,
+        help="calls per second the app allows itself, 0 to not throttle",
+    )
+    parser.add_argument("--playlists", type=int, default=60, help="playlists per user")
+    parser.add_argument("--mongo-uri", help="a MongoDB to use instead of mongomock")
+    parser.add_argument("--redis-url", help="a Redis to cache in instead of the process")
+    parser.add_argument("--scenario", action="append", help="only run these scenarios")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="show calls per route")
+    parser.add_argument(
+        "--check", action="store_true", help="fail when a scenario exceeds its budget"
+    )
+    args = parser.parse_args(argv)
+
+    console = Console()
+    args.fake = FakeSpotify(
+        latency=args.latency,
+        rate_limit=args.rate_limit,
+        retry_after=args.retry_after,
+        playlists=args.playlists,
+    ).start()
+    try:
+        results = run(args)
+    finally:
+        args.fake.stop()
+
+    report(results, args.verbose, console)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+    if args.check:
+        with open(BUDGETS_PATH) as f:
+            budgets = json.load(f)
+        if not check(results, budgets, console):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
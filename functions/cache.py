@@ -0,0 +1,237 @@
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+logger = logging.getLogger("spotify")
+
+_MISSING = object()
+
+
+class TTLCache:
+    """
+    A small thread-safe in-process cache that forgets entries after `ttl` seconds and evicts the
+    least recently used entry once it holds `maxsize` of them
+
+    Args:
+      maxsize: The maximum number of entries kept.
+      ttl: The number of seconds an entry stays valid.
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            value, expires_at = self._data.get(key, (_MISSING, 0))
+            if value is _MISSING:
+                return default
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class UserDocumentCache:
+    """
+    It sits in front of the `spotify_users` collection and answers `find_one({"_id": ...})` from an
+    in-process LRU first, then from a shared remote cache (the app's Redis), and only then from Mongo.
+    Reads may be projected: only the fields that aren't cached yet are read from Mongo, and they are
+    added to the cached copy. Writes go straight to Mongo; a plain `$set` is also merged into the
+    local copy so the rest of the request keeps reading from memory, while the remote copy is
+    invalidated so other workers reload it. Everything else is passed through to the collection
+    untouched.
+
+    The remote copy is invalidated by giving the user's document a new version, and a copy read from
+    Mongo is saved with the version seen before the read. A copy read just before a write and saved
+    just after it is then never served, which dropping the copy alone couldn't prevent.
+
+    Args:
+      collection: The pymongo collection holding one document per user.
+      remote: An object with `get_many` and `set`, like a Flask-Caching `Cache`, or None.
+      maxsize: The maximum number of documents kept in process.
+      ttl: The number of seconds a document stays in the process cache.
+      remote_ttl: The number of seconds a document stays in the remote cache.
+    """
+
+    def __init__(self, collection, remote=None, maxsize=1024, ttl=10, remote_ttl=300):
+        self.collection = collection
+        self.remote = remote
+        self.remote_ttl = remote_ttl
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    @staticmethod
+    def _remote_key(user_id):
+        return f"user_document/{user_id}"
+
+    @staticmethod
+    def _version_key(user_id):
+        return f"user_document_version/{user_id}"
+
+    @staticmethod
+    def _cacheable_id(filter):
+        if not isinstance(filter, dict) or set(filter) != {"_id"}:
+            return None
+        return filter["_id"] if isinstance(filter["_id"], str) else None
+
+    @staticmethod
+    def _projected_fields(projection):
+        """
+        It returns the fields an inclusion projection asks for, None for the whole document, or False
+        when the projection can't be served from a cached copy
+        """
+        if projection is None:
+            return None
+        if isinstance(projection, dict):
+            if not all(value in (1, True) for key, value in projection.items() if key != "_id"):
+                return False
+            projection = [key for key in projection if key != "_id"]
+        if any("." in field for field in projection):
+            return False
+        return frozenset(projection) | {"_id"}
+
+    def _remote_call(self, method, *args):
+        if self.remote is None:
+            return None
+        try:
+            return getattr(self.remote, method)(*args)
+        except Exception as e:
+            logger.error(f"user document cache {method} failed: {e!r}")
+            return None
+
+    def _remote_get(self, user_id):
+        """
+        It reads the remote copy of a user's document and its current version in one round trip
+
+        Returns:
+          A tuple of whether the remote cache answered, the current version, and the entry, None
+          unless it was saved at the current version.
+        """
+        values = self._remote_call(
+            "get_many", self._version_key(user_id), self._remote_key(user_id)
+        )
+        if not values:
+            return False, None, None
+        version, cached = values
+        if cached is None or cached[0] != version:
+            return True, version, None
+        return True, version, cached[1]
+
+    def find_one(self, filter=None, projection=None, *args, **kwargs):
+        user_id = self._cacheable_id(filter)
+        fields = self._projected_fields(projection)
+        if user_id is None or fields is False or args or kwargs:
+            return self.collection.find_one(filter, projection, *args, **kwargs)
+        # an entry is the cached part of the document and the fields it covers, None meaning all
+        entry = self.local.get(user_id)
+        remote_answered, version = False, None
+        if entry is None:
+            remote_answered, version, entry = self._remote_get(user_id)
+        if entry is None or not self._covers(entry[1], fields):
+            missing = fields
+            if entry is not None and fields is not None and entry[1] is not None:
+                missing = (fields - entry[1]) | {"_id"}
+            document = self.collection.find_one(
+                filter, None if missing is None else list(missing)
+            )
+            if document is None:
+                return None
+            if entry is None:
+                entry = (document, missing)
+            else:
+                covered = None if missing is None or entry[1] is None else entry[1] | missing
+                entry = ({**entry[0], **document}, covered)
+            if remote_answered:
+                # a write since the version was read gave the document a new one, so this copy is
+                # ignored instead of replacing the one the write invalidated
+                self._remote_call(
+                    "set", self._remote_key(user_id), (version, entry), self.remote_ttl
+                )
+        self.local.set(user_id, entry)
+        document = entry[0]
+        if fields is None:
+            return dict(document)
+        return {field: document[field] for field in fields if field in document}
+
+    @staticmethod
+    def _covers(covered, fields):
+        return covered is None or (fields is not None and fields <= covered)
+
+    def _new_version(self, user_id):
+        # it outlives the copies saved with the version before it, so they can't become current again
+        self._remote_call(
+            "set", self._version_key(user_id), uuid.uuid4().hex, 2 * self.remote_ttl
+        )
+
+    def invalidate(self, user_id):
+        """
+        It drops the user's document from both cache tiers
+
+        Args:
+          user_id: the user's id
+        """
+        self.local.delete(user_id)
+        self._new_version(user_id)
+
+    def write_through(self, filter, update):
+        """
+        It brings the cache up to date after `update` was written to the documents matching `filter`,
+        merging a plain `$set` into the local copy and dropping the copy otherwise
+
+        Args:
+          filter: The filter of the write.
+          update: The update document of the write.
+        """
+        user_id = self._cacheable_id(filter)
+        if user_id is None:
+            return
+        self._new_version(user_id)
+        with self._lock:
+            entry = self.local.get(user_id)
+            if entry is not None and set(update) == {"$set"} and not any(
+                "." in field for field in update["$set"]
+            ):
+                document, covered = entry
+                if covered is not None:
+                    covered = covered | set(update["$set"])
+                self.local.set(user_id, ({**document, **update["$set"]}, covered))
+            else:
+                self.local.delete(user_id)
+
+    def insert_one(self, document, *args, **kwargs):
+        result = self.collection.insert_one(document, *args, **kwargs)
+        self.invalidate(document["_id"])
+        return result
+
+    def update_one(self, filter, update, *args, **kwargs):
+        result = self.collection.update_one(filter, update, *args, **kwargs)
+        self.write_through(filter, update)
+        return result
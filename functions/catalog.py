@@ -0,0 +1,71 @@
+import logging
+
+from pymongo import UpdateOne
+
+from functions.cache import TTLCache
+
+logger = logging.getLogger("spotify")
+
+
+class Catalog:
+    """
+    It is the metadata of every track and artist shown on a profile, kept once in a collection keyed
+    by their Spotify id and shared by every user, so the users' documents only hold the ids. Entries
+    are read a batch at a time with one `$in` query, through an in-process LRU, and only the entries
+    that changed are written back
+
+    Args:
+      collection: The pymongo collection holding one document per track or artist.
+      maxsize: The maximum number of entries kept in process.
+      ttl: The number of seconds an entry stays in the process cache.
+    """
+
+    def __init__(self, collection, maxsize=10000, ttl=3600):
+        self.collection = collection
+        self.local = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def save(self, items):
+        """
+        It adds tracks or artists to the catalog, or updates them, with one write
+
+        Args:
+          items: A dictionary mapping Spotify ids to their metadata.
+        """
+        changed = {
+            item_id: item for item_id, item in items.items() if self.local.get(item_id) != item
+        }
+        if changed:
+            self.collection.bulk_write(
+                [
+                    UpdateOne({"_id": item_id}, {"$set": item}, upsert=True)
+                    for item_id, item in changed.items()
+                ],
+                ordered=False,
+            )
+            logger.debug(f"Saved {len(changed)} catalog entries")
+        for item_id, item in changed.items():
+            self.local.set(item_id, dict(item))
+
+    def get_many(self, ids):
+        """
+        It looks up tracks or artists, reading the ones that aren't cached in process with one query
+
+        Args:
+          ids: The Spotify ids to look up.
+
+        Returns:
+          A dictionary mapping the ids found to their metadata.
+        """
+        found, missing = {}, []
+        for item_id in dict.fromkeys(ids):
+            item = self.local.get(item_id)
+            if item is None:
+                missing.append(item_id)
+            else:
+                found[item_id] = item
+        if missing:
+            for item in self.collection.find({"_id": {"$in": missing}}):
+                item_id = item.pop("_id")
+                self.local.set(item_id, item)
+                found[item_id] = item
+        return found
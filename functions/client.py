@@ -0,0 +1,259 @@
+import logging
+import os
+import random
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+import spotipy
+from spotipy.exceptions import SpotifyException
+from urllib3 import Retry
+
+from functions import metrics
+from functions import ratelimit
+from functions.fetch import FETCH_MAX_WORKERS, FETCH_SECTION_WORKERS
+
+logger = logging.getLogger("spotify")
+
+# Lets the app talk to a stand-in of the Web API, e.g. the one in benchmarks/
+API_PREFIX = os.getenv("SPOTIFY_API_PREFIX")
+
+MAX_ATTEMPTS = int(os.getenv("SPOTIFY_MAX_ATTEMPTS", 4))
+RETRY_BASE_DELAY = float(os.getenv("SPOTIFY_RETRY_BASE_DELAY", 0.25))
+RETRY_MAX_DELAY = float(os.getenv("SPOTIFY_RETRY_MAX_DELAY", 4))
+# How long a call may wait for the rate limit before giving up, by priority
+INTERACTIVE_MAX_WAIT = float(os.getenv("SPOTIFY_INTERACTIVE_MAX_WAIT", 5))
+BACKGROUND_MAX_WAIT = float(os.getenv("SPOTIFY_BACKGROUND_MAX_WAIT", 60))
+
+# The number of connections kept alive per host, enough for every thread that calls Spotify
+POOL_SIZE = int(
+    os.getenv("SPOTIFY_POOL_SIZE", FETCH_MAX_WORKERS + FETCH_SECTION_WORKERS + 8)
+)
+_session = None
+_session_lock = threading.Lock()
+
+# Every worker shares this bucket; routes.py hands it the Redis client so all workers do
+limiter = ratelimit.TokenBucket(
+    rate=float(os.getenv("SPOTIFY_RATE_LIMIT", 50)),
+    capacity=float(os.getenv("SPOTIFY_RATE_BURST", 100)),
+    reserve=float(os.getenv("SPOTIFY_BACKGROUND_RESERVE", 0.25)),
+)
+
+# Path segments that are followed by an id, e.g. "playlists/<id>/tracks"
+_COLLECTIONS = {
+    "albums",
+    "artists",
+    "audio-analysis",
+    "audio-features",
+    "categories",
+    "episodes",
+    "playlists",
+    "shows",
+    "tracks",
+    "users",
+}
+_NOT_IDS = {"contains", "followers", "images", "top-tracks", "related-artists"}
+
+
+def operation_name(method, url):
+    """
+    It turns a Web API call into a name that doesn't depend on the ids in it, so calls can be
+    counted by what they do
+
+    Args:
+      method: The HTTP method of the call.
+      url: The URL or path of the call, with or without its query string.
+
+    Returns:
+      A name like "GET playlists/{id}/tracks".
+    """
+    path = urlsplit(url).path.strip("/")
+    if path.startswith("v1/"):
+        path = path[len("v1/") :]
+    segments = path.split("/")
+    for i in range(1, len(segments)):
+        if segments[i - 1] in _COLLECTIONS and segments[i] not in _NOT_IDS:
+            segments[i] = "{id}"
+    return f"{method} {'/'.join(segments)}"
+
+
+def build_session(pool_size=POOL_SIZE):
+    """
+    It builds an HTTP session keeping up to `pool_size` connections alive per host. The session only
+    retries connection errors: 429s and server errors are retried by the client itself, which can
+    honour Retry-After and knows which calls are safe to repeat
+
+    Args:
+      pool_size: The number of connections kept per host.
+
+    Returns:
+      A requests Session.
+    """
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=pool_size,
+        max_retries=Retry(
+            total=2, connect=2, read=False, status=0, respect_retry_after_header=False
+        ),
+    )
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def shared_session():
+    """
+    It returns the process-wide session every client uses, building it the first time. Sharing it
+    means the connections to Spotify are opened once per worker and reused by every user's client,
+    instead of paying a new TLS handshake each time a client is created
+
+    Returns:
+      A requests Session.
+    """
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = build_session()
+    return _session
+
+
+def pool_stats():
+    """
+    It describes the connection pools of the shared session
+
+    Returns:
+      A list of dictionaries, one per host, with the number of connections opened and requests
+      made since the pool was created, the number of idle connections and the size of the pool.
+    """
+    if _session is None:
+        return []
+    stats = []
+    for adapter in set(_session.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is None:
+                continue
+            stats.append(
+                {
+                    "host": f"{pool.scheme}://{pool.host}:{pool.port}",
+                    "connections_opened": pool.num_connections,
+                    "requests": pool.num_requests,
+                    # the queue is padded with None up to its size
+                    "idle": sum(conn is not None for conn in list(pool.pool.queue))
+                    if pool.pool is not None
+                    else 0,
+                    "size": pool.pool.maxsize if pool.pool is not None else 0,
+                }
+            )
+    return stats
+
+
+def _collect_pool_stats():
+    stats = pool_stats()
+    for field, name, kind, description in (
+        ("connections_opened", "connections_opened_total", "counter", "Connections opened."),
+        ("requests", "requests_total", "counter", "Requests sent over pooled connections."),
+        ("idle", "idle_connections", "gauge", "Idle connections kept alive."),
+        ("size", "size", "gauge", "Connections kept alive at most."),
+    ):
+        samples = [({"host": pool["host"]}, pool[field]) for pool in stats]
+        yield f"http_pool_{name}", kind, description, samples
+
+
+metrics.registry.add_collector(_collect_pool_stats)
+
+
+def _retry_after(headers):
+    try:
+        return max(float((headers or {}).get("Retry-After", 1)), 0)
+    except ValueError:
+        return 1.0
+
+
+def _backoff(attempt):
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**attempt))
+
+
+class Spotify(spotipy.Spotify):
+    """
+    It is spotipy's client, made to share the app's rate limit politely. Every call first takes a
+    token from the shared `limiter`, waiting at most as long as its priority allows. A 429 pauses
+    every call for its Retry-After and is retried, since Spotify didn't process the call. GETs are
+    also retried after a server error or a connection error, with a jittered exponential backoff.
+    Every attempt is timed and counted in the current request's metrics and in the `/metrics`
+    registry
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("requests_session", shared_session())
+        super().__init__(*args, **kwargs)
+        if API_PREFIX:
+            self.prefix = API_PREFIX
+
+    def __del__(self):
+        # spotipy closes the client's session here, which is shared with every other client
+        if self._session is not _session:
+            super().__del__()
+
+    def _internal_call(self, method, url, payload, params):
+        operation = operation_name(method, url)
+        max_wait = (
+            BACKGROUND_MAX_WAIT
+            if ratelimit.current_priority() == ratelimit.BACKGROUND
+            else INTERACTIVE_MAX_WAIT
+        )
+        for attempt in range(MAX_ATTEMPTS):
+            waited = limiter.acquire(max_wait=max_wait)
+            if waited:
+                metrics.record("throttle", ratelimit.current_priority(), waited)
+            try:
+                with metrics.timed("spotify", operation):
+                    # spotipy pops `content_type` out of the params, so every attempt gets a copy
+                    return super()._internal_call(
+                        method, url, payload, None if params is None else dict(params)
+                    )
+            except SpotifyException as e:
+                if e.http_status == 429:
+                    retry_after = _retry_after(e.headers)
+                    limiter.pause(retry_after)
+                    delay = retry_after
+                elif e.http_status >= 500 and method == "GET":
+                    delay = _backoff(attempt)
+                else:
+                    raise
+                error = e
+            except requests.exceptions.RequestException as e:
+                if method != "GET":
+                    raise
+                delay, error = _backoff(attempt), e
+            if attempt + 1 == MAX_ATTEMPTS:
+                raise error
+            logger.warning(f"{operation} failed ({error!r}), retrying in {delay:.2f}s")
+            time.sleep(delay)
+
+
+class SpotifyOAuth(spotipy.oauth2.SpotifyOAuth):
+    """
+    It is spotipy's authorization code flow, except the calls it makes to the accounts service go
+    through the shared session, and are timed and counted like the Web API calls
+    """
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault("requests_session", shared_session())
+        super().__init__(*args, **kwargs)
+
+    def __del__(self):
+        if self._session is not _session:
+            super().__del__()
+
+    def get_access_token(self, *args, **kwargs):
+        with metrics.timed("spotify", "POST api/token"):
+            return super().get_access_token(*args, **kwargs)
+
+    def refresh_access_token(self, *args, **kwargs):
+        with metrics.timed("spotify", "POST api/token (refresh)"):
+            return super().refresh_access_token(*args, **kwargs)
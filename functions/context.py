@@ -0,0 +1,71 @@
+import logging
+import threading
+from concurrent.futures import Future
+
+from functions.client import Spotify
+
+logger = logging.getLogger("spotify")
+
+
+class SpotifyContext:
+    """
+    It holds everything a request needs to talk to Spotify on behalf of one user: a single
+    spotipy client on the pooled HTTP session of the process, and the user's profile, which is only
+    looked up once no matter how many helpers ask for it
+
+    Args:
+      access_token: The access token of the user.
+      user_info: The user's profile, if the caller already has it.
+    """
+
+    def __init__(self, access_token, user_info=None):
+        self.access_token = access_token
+        self.sp = Spotify(auth=access_token)
+        self._user_info = user_info
+        self._lock = threading.Lock()
+        self._memo = {}
+        self._memo_lock = threading.Lock()
+
+    @property
+    def user_info(self):
+        """
+        It returns the user's profile, calling /me the first time it is needed
+
+        Returns:
+          A dictionary with the user's information.
+        """
+        with self._lock:
+            if self._user_info is None:
+                self._user_info = self.sp.current_user()
+                logger.debug(
+                    "Getting user info for {}".format(self._user_info["display_name"])
+                )
+        return self._user_info
+
+    @property
+    def user_id(self):
+        return self.user_info["id"]
+
+    def memoize(self, key, fn):
+        """
+        It calls `fn` once per context for each key and hands its result to every caller, including
+        callers on other threads that ask while the first call is still running
+
+        Args:
+          key: The name of the value.
+          fn: A function that takes no arguments and computes the value.
+
+        Returns:
+          The value returned by `fn`.
+        """
+        with self._memo_lock:
+            future = self._memo.get(key)
+            is_owner = future is None
+            if is_owner:
+                future = self._memo[key] = Future()
+        if is_owner:
+            try:
+                future.set_result(fn())
+            except Exception as e:
+                future.set_exception(e)
+        return future.result()
@@ -0,0 +1,114 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from cryptography.fernet import Fernet, MultiFernet
+from dotenv import load_dotenv
+
+from functions.cache import TTLCache
+
+load_dotenv()
+logger = logging.getLogger("spotify")
+
+_cipher = None
+_cipher_lock = threading.Lock()
+
+# Decrypted plaintexts keyed by the digest of their ciphertext, so a token read on every request is
+# only decrypted once in a while. The ciphertext itself is never used as a key
+_decrypted = TTLCache(
+    maxsize=int(os.getenv("DECRYPT_CACHE_SIZE", 256)),
+    ttl=int(os.getenv("DECRYPT_CACHE_TTL", 300)),
+)
+
+
+def _load_keys():
+    """
+    It reads the keys from `ENCRYPTION_KEY`, a comma separated list where the first key encrypts and
+    every key can decrypt, so a key can be rotated by putting the new one first. Every worker has to
+    use the same keys, so there's no key to fall back to when none is set
+
+    Returns:
+      A list of keys, as bytes.
+    """
+    keys = [key.strip() for key in os.getenv("ENCRYPTION_KEY", "").split(",")]
+    keys = [key.encode() for key in keys if key]
+    if not keys:
+        raise RuntimeError(
+            "ENCRYPTION_KEY is not set, generate one with "
+            '`python -c "from cryptography.fernet import Fernet; print(Fernet.generate_key().decode())"`'
+        )
+    return keys
+
+
+def get_cipher():
+    """
+    It builds the cipher from the configured keys the first time it's needed, and returns the same
+    one afterwards
+
+    Returns:
+      A MultiFernet.
+    """
+    global _cipher
+    if _cipher is None:
+        with _cipher_lock:
+            if _cipher is None:
+                _cipher = MultiFernet([Fernet(key) for key in _load_keys()])
+    return _cipher
+
+
+def session_key():
+    """
+    It returns the key Flask signs sessions with: `SECRET_KEY`, or else the oldest encryption key,
+    which stays the same while newer keys are put in front of it, so rotating the encryption key
+    doesn't sign everyone out
+
+    Returns:
+      The key, as a string.
+    """
+    return os.getenv("SECRET_KEY") or _load_keys()[-1].decode()
+
+
+def _digest(data):
+    if isinstance(data, str):
+        data = data.encode()
+    return hashlib.sha256(data).digest()
+
+
+def encrypt(data):
+    """
+    It encrypts a string, or a dictionary as JSON, with the current key
+
+    Args:
+      data: A string or a dictionary.
+
+    Returns:
+      The encrypted data, as bytes.
+    """
+    if isinstance(data, dict):
+        data = json.dumps(data)
+    logger.debug("Encrypting %d characters", len(data))
+    return get_cipher().encrypt(data.encode())
+
+
+def decrypt(data):
+    """
+    It decrypts data encrypted by `encrypt` with any of the configured keys. The same ciphertext is
+    only decrypted once per `DECRYPT_CACHE_TTL` seconds
+
+    Args:
+      data: The encrypted data, as bytes or a string.
+
+    Returns:
+      The decrypted string, or a new dictionary if it was encrypted from one.
+    """
+    digest = _digest(data)
+    decrypted_data = _decrypted.get(digest)
+    if decrypted_data is None:
+        decrypted_data = get_cipher().decrypt(data).decode()
+        _decrypted.set(digest, decrypted_data)
+        logger.debug("Decrypted %d characters", len(decrypted_data))
+    if decrypted_data.startswith("{"):
+        return json.loads(decrypted_data)
+    return decrypted_data
@@ -0,0 +1,91 @@
+import contextvars
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+
+logger = logging.getLogger("spotify")
+
+FETCH_MAX_WORKERS = int(os.getenv("FETCH_MAX_WORKERS", 8))
+FETCH_SECTION_WORKERS = int(os.getenv("FETCH_SECTION_WORKERS", 8))
+FETCH_TIMEOUT = float(os.getenv("FETCH_TIMEOUT", 10))
+FETCH_FOLLOWERS_WORKERS = int(os.getenv("FETCH_FOLLOWERS_WORKERS", 4))
+
+
+class FetchEngine:
+    """
+    It runs independent calls on a bounded thread pool and collects whatever finished in time, so a
+    batch costs roughly as much as its slowest call instead of the sum of all of them. Every call
+    runs in a copy of the caller's context, so it is counted in the caller's request metrics
+
+    Args:
+      max_workers: The maximum number of calls running at the same time.
+      timeout: The default number of seconds to wait for each call.
+      name: The prefix used for the worker thread names.
+    """
+
+    def __init__(self, max_workers, timeout=FETCH_TIMEOUT, name="fetch"):
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix=name
+        )
+
+    def submit(self, fn, *args, **kwargs):
+        context = contextvars.copy_context()
+        return self._executor.submit(context.run, fn, *args, **kwargs)
+
+    def run(self, calls, timeout=None):
+        """
+        It starts every call at once and waits for them, never longer than the timeout per call
+
+        Args:
+          calls: A dictionary mapping a name to a function that takes no arguments.
+          timeout: The number of seconds to wait for each call, defaults to the engine's timeout.
+
+        Returns:
+          A tuple of two dictionaries: the results of the calls that succeeded and the exceptions of
+          the ones that failed or timed out, both keyed by the call's name.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        started = time.monotonic()
+        futures = {name: self.submit(call) for name, call in calls.items()}
+        results, errors = {}, {}
+        for name, future in futures.items():
+            remaining = max(timeout - (time.monotonic() - started), 0)
+            try:
+                results[name] = future.result(timeout=remaining)
+            except FutureTimeoutError as e:
+                future.cancel()
+                logger.error(f"{name} timed out after {timeout}s")
+                errors[name] = e
+            except Exception as e:
+                logger.error(f"{name} failed: {e!r}")
+                errors[name] = e
+        return results, errors
+
+    def gather(self, calls, timeout=None):
+        """
+        It is `run` for callers that need every result, raising the first error instead of
+        returning partial results
+
+        Args:
+          calls: A dictionary mapping a name to a function that takes no arguments.
+          timeout: The number of seconds to wait for each call.
+
+        Returns:
+          A dictionary with the result of every call, keyed by the call's name.
+        """
+        results, errors = self.run(calls, timeout)
+        for error in errors.values():
+            raise error
+        return results
+
+
+# Spotify requests and page sections get separate pools: a section waits on its own requests, so
+# sharing one bounded pool could leave every worker blocked on work that has nowhere to run.
+calls = FetchEngine(FETCH_MAX_WORKERS, name="spotify-call")
+sections = FetchEngine(FETCH_SECTION_WORKERS, name="spotify-section")
+# Follower counts take one request per playlist, so a user with hundreds of playlists gets them
+# looked up on a small pool of their own instead of queueing them in front of every other call.
+followers = FetchEngine(FETCH_FOLLOWERS_WORKERS, name="spotify-followers")
@@ -0,0 +1,88 @@
+import hashlib
+import logging
+import threading
+
+from flask import current_app, get_template_attribute
+from markupsafe import Markup
+
+logger = logging.getLogger("spotify")
+
+
+def section_version(section, *extra):
+    """
+    It identifies the data a fragment is rendered from, so a fragment is rendered again only once the
+    section it shows was refreshed
+
+    Args:
+      section: A cached section of the user's document, with its datetime_added.
+      extra: Anything else the fragment shows, e.g. the user's display name.
+
+    Returns:
+      A string that changes with the data, or None for a section that wasn't cached, e.g. the empty
+      fallback of a section that failed, which shouldn't be cached either.
+    """
+    if not isinstance(section, dict) or "datetime_added" not in section:
+        return None
+    return "/".join(str(part) for part in (section["datetime_added"], *extra))
+
+
+class FragmentCache:
+    """
+    It caches the markup of the components in templates/components, keyed by the user, the part of
+    the page and the version of the data it shows. A profile page is then assembled from fragments
+    that are only rendered again when their section changes, while the parts that change all the
+    time, like the currently playing track, are rendered fresh. The template's source is part of the
+    key too, so a deploy that changes a component doesn't serve the old markup
+
+    Args:
+      cache: The Flask-Caching cache the fragments are kept in.
+      timeout: The number of seconds a fragment is kept.
+    """
+
+    def __init__(self, cache, timeout=3600):
+        self.cache = cache
+        self.timeout = timeout
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def _template_digest(self, template):
+        with self._lock:
+            digest = self._digests.get(template)
+        if digest is None:
+            env = current_app.jinja_env
+            source, _, _ = env.loader.get_source(env, template)
+            digest = hashlib.sha1(source.encode()).hexdigest()[:12]
+            with self._lock:
+                self._digests[template] = digest
+        return digest
+
+    def key(self, template, user_id, name, version):
+        digest = hashlib.sha1(
+            f"{self._template_digest(template)}/{version}".encode()
+        ).hexdigest()
+        return f"fragment/{template}/{user_id}/{name}/{digest}"
+
+    def render(self, template, user_id, name, version, *args):
+        """
+        It renders the `component` macro of a template, or returns its cached markup
+
+        Args:
+          template: The name of the template, e.g. "components/top_card_tracks.jinja".
+          user_id: The id of the user the fragment belongs to.
+          name: Which of the user's fragments rendered by this template it is, e.g. a time range.
+          version: The version of the data, from `section_version`. None renders without caching.
+          args: The arguments of the macro.
+
+        Returns:
+          The markup of the fragment.
+        """
+        component = get_template_attribute(template, "component")
+        if version is None:
+            return component(*args)
+        key = self.key(template, user_id, name, version)
+        markup = self.cache.get(key)
+        if markup is None:
+            markup = str(component(*args))
+            self.cache.set(key, markup, timeout=self.timeout)
+            logger.debug(f"Rendered the {name} fragment of {template} for {user_id}")
+        return Markup(markup)
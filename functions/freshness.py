@@ -0,0 +1,144 @@
+import datetime
+import hashlib
+import os
+
+
+def env_seconds(name, default):
+    """
+    It reads a number of seconds from the environment
+
+    Args:
+      name: The name of the environment variable.
+      default: The number of seconds used when it isn't set.
+
+    Returns:
+      The number of seconds.
+    """
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
+class FreshnessPolicy:
+    """
+    It is how long a cached section stays fresh. A section made of time ranges can give each range
+    its own lifetime, e.g. a user's short term top tracks change daily while their long term ones
+    barely change. Every lifetime is shortened by up to `jitter` of itself, by an amount that depends
+    on the key, so sections cached at the same time, e.g. right after a deploy, don't all expire
+    together, while a given section always expires at the same moment
+
+    Args:
+      ttl: The number of seconds the section stays fresh.
+      range_ttls: A dictionary mapping time ranges to the number of seconds they stay fresh, for a
+        section refreshed a time range at a time.
+      jitter: The largest fraction of a lifetime taken off it.
+    """
+
+    def __init__(self, ttl, range_ttls=None, jitter=0.1):
+        self.ttl = ttl
+        self.range_ttls = range_ttls or {}
+        self.jitter = jitter
+
+    def max_age(self, key, time_range=None):
+        """
+        It tells how old a section, or one of its time ranges, may be before it's refreshed
+
+        Args:
+          key: What identifies the section, e.g. "top_tracks/<user_id>".
+          time_range: The time range, or None for the whole section.
+
+        Returns:
+          A timedelta.
+        """
+        ttl = self.range_ttls.get(time_range, self.ttl)
+        digest = hashlib.sha1(f"{key}/{time_range}".encode()).digest()
+        spread = int.from_bytes(digest[:4], "big") / 2**32
+        return datetime.timedelta(seconds=ttl * (1 - self.jitter * spread))
+
+    def stale_ranges(self, key, section, now=None):
+        """
+        It finds the time ranges of a section that should be refreshed. A range's age is read from
+        the section's `ranges_added`, and falls back to its `datetime_added`
+
+        Args:
+          key: What identifies the section, e.g. "top_tracks/<user_id>".
+          section: The cached section.
+          now: The current naive local datetime, defaults to now.
+
+        Returns:
+          A list of the stale time ranges.
+        """
+        now = now or datetime.datetime.now()
+        ranges_added = section.get("ranges_added") or {}
+        return [
+            time_range
+            for time_range in self.range_ttls
+            if ranges_added.get(time_range, section["datetime_added"])
+            < now - self.max_age(key, time_range)
+        ]
+
+    def is_stale(self, key, section, now=None):
+        """
+        It tells whether a section should be refreshed
+
+        Args:
+          key: What identifies the section, e.g. "top_tracks/<user_id>".
+          section: The cached section, with its `datetime_added`.
+          now: The current naive local datetime, defaults to now.
+
+        Returns:
+          True if the section, or any of its time ranges, is older than its lifetime.
+        """
+        now = now or datetime.datetime.now()
+        if self.range_ttls:
+            return bool(self.stale_ranges(key, section, now))
+        return section["datetime_added"] < now - self.max_age(key)
+
+
+class FreshnessRegistry:
+    """
+    It holds the freshness policy of every cached section. Every lifetime can be changed from the
+    environment, in seconds: `<SECTION>_TTL` for a section, e.g. PLAYLISTS_TTL, which for a section
+    with time ranges applies to every range, `<SECTION>_<RANGE>_TTL` for one of its time ranges, e.g.
+    TOP_TRACKS_SHORT_TERM_TTL, and FRESHNESS_JITTER for the jitter of them all
+
+    Args:
+      default_ttl: The number of seconds the sections without a policy stay fresh.
+      jitter: The largest fraction of a lifetime taken off it, see `FreshnessPolicy`.
+    """
+
+    def __init__(self, default_ttl, jitter=0.1):
+        self.jitter = env_seconds("FRESHNESS_JITTER", jitter)
+        self.default = FreshnessPolicy(default_ttl, jitter=self.jitter)
+        self._policies = {}
+
+    def register(self, section, ttl=None, range_ttls=None):
+        """
+        It sets the policy of a section, as overridden by the environment
+
+        Args:
+          section: The name of the section, e.g. "top_tracks".
+          ttl: The number of seconds the section stays fresh, defaults to the registry's.
+          range_ttls: A dictionary mapping time ranges to the number of seconds they stay fresh.
+
+        Returns:
+          The policy.
+        """
+        name = section.upper()
+        section_ttl = os.getenv(f"{name}_TTL")
+        ttl = float(section_ttl) if section_ttl else ttl or self.default.ttl
+        policy = FreshnessPolicy(
+            ttl,
+            {
+                # the section's own lifetime, when it's set, replaces the default of every range
+                time_range: env_seconds(
+                    f"{name}_{time_range.upper()}_TTL", ttl if section_ttl else range_ttl
+                )
+                for time_range, range_ttl in (range_ttls or {}).items()
+            },
+            jitter=self.jitter,
+        )
+        self._policies[section] = policy
+        return policy
+
+    def __getitem__(self, section):
+        return self._policies.get(section, self.default)
@@ -0,0 +1,139 @@
+import datetime
+import logging
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import CollectionInvalid
+
+logger = logging.getLogger("spotify")
+
+
+def create_history_collection(db, name="spotify_recently_played"):
+    """
+    It creates the collection the plays are kept in, if it doesn't exist yet, as a time-series
+    collection bucketed by user. Servers older than MongoDB 5.0, and mongomock, get a regular
+    collection instead, which the index on the user and the time serves just as well
+
+    Args:
+      db: The pymongo database.
+      name: The name of the collection.
+
+    Returns:
+      The collection.
+    """
+    if name not in db.list_collection_names():
+        try:
+            db.create_collection(
+                name,
+                timeseries={
+                    "timeField": "played_at",
+                    "metaField": "user_id",
+                    "granularity": "minutes",
+                },
+            )
+        except CollectionInvalid:
+            # another worker created it in the meantime
+            pass
+        except Exception as e:
+            logger.warning(f"{name} is a regular collection, not a time-series one: {e!r}")
+    collection = db[name]
+    collection.create_index([("user_id", ASCENDING), ("played_at", DESCENDING)])
+    return collection
+
+
+def to_cursor(played_at):
+    """
+    It turns the time of a play into one of Spotify's recently played cursors
+
+    Args:
+      played_at: A naive UTC datetime, as MongoDB returns them.
+
+    Returns:
+      The number of milliseconds since the epoch.
+    """
+    return int(played_at.replace(tzinfo=datetime.timezone.utc).timestamp() * 1000)
+
+
+class PlayHistory:
+    """
+    It is every track a user played, as far back as they've been using the app, while Spotify only
+    remembers their last 50 plays. Plays are only ever appended, and read newest first a page at a
+    time
+
+    Args:
+      collection: The collection of plays, usually made by `create_history_collection`.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def append(self, user_id, plays):
+        """
+        It adds plays to a user's history with one write
+
+        Args:
+          user_id: the user's id
+          plays: A list of dictionaries, each with the naive UTC datetime it was played at as
+            `played_at`.
+        """
+        if plays:
+            self.collection.insert_many(
+                [{"user_id": user_id, **play} for play in plays], ordered=False
+            )
+
+    def last_played_at(self, user_id):
+        """
+        It finds when a user's latest play in the history was played
+
+        Args:
+          user_id: the user's id
+
+        Returns:
+          A naive UTC datetime, or None if the user's history is empty.
+        """
+        play = self.collection.find_one(
+            {"user_id": user_id},
+            {"_id": 0, "played_at": 1},
+            sort=[("played_at", DESCENDING)],
+        )
+        return play["played_at"] if play else None
+
+    def played_at_since(self, user_id, since):
+        """
+        It finds when a user's plays since a given time were played, to tell plays already in the
+        history from new ones
+
+        Args:
+          user_id: the user's id
+          since: A naive UTC datetime.
+
+        Returns:
+          A set of naive UTC datetimes.
+        """
+        return {
+            play["played_at"]
+            for play in self.collection.find(
+                {"user_id": user_id, "played_at": {"$gte": since}}, {"_id": 0, "played_at": 1}
+            )
+        }
+
+    def page(self, user_id, before=None, limit=50):
+        """
+        It reads a page of a user's history, newest first
+
+        Args:
+          user_id: the user's id
+          before: Only read the plays played before this naive UTC datetime, to read the page after
+            the one that ended with it.
+          limit: The number of plays to read.
+
+        Returns:
+          A list of dictionaries, the plays without their user id.
+        """
+        query = {"user_id": user_id}
+        if before is not None:
+            query["played_at"] = {"$lt": before}
+        return list(
+            self.collection.find(query, {"_id": 0, "user_id": 0})
+            .sort("played_at", DESCENDING)
+            .limit(limit)
+        )
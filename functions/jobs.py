@@ -0,0 +1,92 @@
+import logging
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from functions import ratelimit
+
+logger = logging.getLogger("spotify")
+
+
+class RefreshQueue:
+    """
+    It runs background refresh jobs on a small pool of worker threads. A job is identified by a key,
+    and a key that is already queued or running is not queued again, so a popular profile whose
+    cache just went stale is refreshed once no matter how many people are looking at it. With a
+    remote cache the de-duplication also covers the other workers
+
+    Args:
+      max_workers: The number of jobs running at the same time.
+      remote: An object with `add` and `delete`, like a Flask-Caching `Cache`, or None.
+      remote_timeout: The number of seconds a key stays claimed in the remote cache, in case the
+        worker holding it dies before releasing it.
+    """
+
+    def __init__(self, max_workers, remote=None, remote_timeout=300):
+        self.remote = remote
+        self.remote_timeout = remote_timeout
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="refresh"
+        )
+        self._pending = set()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _remote_key(key):
+        return f"refresh/{key}"
+
+    def _claim_remote(self, key):
+        if self.remote is None:
+            return True
+        try:
+            return bool(self.remote.add(self._remote_key(key), 1, self.remote_timeout))
+        except Exception as e:
+            logger.error(f"refresh queue couldn't claim {key}: {e!r}")
+            return True
+
+    def _release_remote(self, key):
+        if self.remote is None:
+            return
+        try:
+            self.remote.delete(self._remote_key(key))
+        except Exception as e:
+            logger.error(f"refresh queue couldn't release {key}: {e!r}")
+
+    def enqueue(self, key, job):
+        """
+        It queues a job unless a job with the same key is already queued or running
+
+        Args:
+          key: The key identifying what the job refreshes, e.g. "top_tracks/<user_id>".
+          job: A function that takes no arguments.
+
+        Returns:
+          True if the job was queued.
+        """
+        with self._lock:
+            if key in self._pending:
+                return False
+            self._pending.add(key)
+        if not self._claim_remote(key):
+            with self._lock:
+                self._pending.discard(key)
+            return False
+        logger.info(f"Queued background refresh of {key}")
+        self._executor.submit(self._run, key, job)
+        return True
+
+    def _run(self, key, job):
+        try:
+            # refreshes make way for the calls of visitors when the rate limit gets close
+            with ratelimit.priority(ratelimit.BACKGROUND):
+                job()
+        except Exception:
+            logger.error(f"Background refresh of {key} failed\n{traceback.format_exc()}")
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+            self._release_remote(key)
+
+
+refresh_queue = RefreshQueue(int(os.getenv("REFRESH_WORKERS", 2)))
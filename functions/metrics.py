@@ -0,0 +1,329 @@
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+logger = logging.getLogger("spotify")
+
+# The upper bounds, in seconds, of the request duration histogram
+DURATION_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_current = ContextVar("request_metrics", default=None)
+
+
+class RequestMetrics:
+    """
+    It collects the calls made while handling one request: how many calls each service got, per
+    operation, and how long they took. Calls made from worker threads are collected too, as long as
+    the thread runs in a copy of the request's context
+
+    Args:
+      endpoint: The name of the endpoint being handled.
+    """
+
+    def __init__(self, endpoint=None):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.operations = defaultdict(lambda: [0, 0.0])
+        self._lock = threading.Lock()
+
+    def add(self, service, operation, seconds):
+        with self._lock:
+            entry = self.operations[(service, operation)]
+            entry[0] += 1
+            entry[1] += seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def by_service(self):
+        """
+        It adds up the operations of each service
+
+        Returns:
+          A dictionary mapping a service to a tuple of its number of calls and their total seconds.
+        """
+        services = defaultdict(lambda: [0, 0.0])
+        with self._lock:
+            for (service, _), (count, seconds) in self.operations.items():
+                services[service][0] += count
+                services[service][1] += seconds
+        return {service: tuple(entry) for service, entry in services.items()}
+
+    def server_timing(self):
+        """
+        It describes the request in the format of the Server-Timing header. The time of a service is
+        the sum of its calls, which can be more than the request took when calls ran in parallel
+
+        Returns:
+          The value of the header.
+        """
+        timings = [
+            f'{service};dur={seconds * 1000:.1f};desc="{count} calls"'
+            for service, (count, seconds) in sorted(self.by_service().items())
+        ]
+        timings.append(f"total;dur={self.elapsed() * 1000:.1f}")
+        return ", ".join(timings)
+
+    def summary(self):
+        with self._lock:
+            operations = {
+                f"{service} {operation}": {"count": count, "ms": round(seconds * 1000, 1)}
+                for (service, operation), (count, seconds) in sorted(self.operations.items())
+            }
+        return {
+            "endpoint": self.endpoint,
+            "duration_ms": round(self.elapsed() * 1000, 1),
+            "services": {
+                service: {"count": count, "ms": round(seconds * 1000, 1)}
+                for service, (count, seconds) in sorted(self.by_service().items())
+            },
+            "operations": operations,
+        }
+
+
+class Registry:
+    """
+    It holds the process-wide counters behind the `/metrics` endpoint, and renders them in the
+    Prometheus text format. Every worker process has its own registry
+    """
+
+    def __init__(self, prefix="spotify_profile"):
+        self.prefix = prefix
+        self._requests = defaultdict(int)
+        self._durations = defaultdict(lambda: [[0] * len(DURATION_BUCKETS), 0, 0.0])
+        self._calls = defaultdict(lambda: [0, 0, 0.0])
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def add_collector(self, collector):
+        """
+        It adds metrics that are read when `/metrics` is scraped instead of being counted as they
+        happen
+
+        Args:
+          collector: A function that takes no arguments and yields tuples of a name, a type
+            ("counter" or "gauge"), a description and a list of (labels, value) samples.
+        """
+        self._collectors.append(collector)
+
+    def observe_call(self, service, operation, seconds, failed=False):
+        with self._lock:
+            entry = self._calls[(service, operation)]
+            entry[0] += 1
+            entry[1] += failed
+            entry[2] += seconds
+
+    def observe_request(self, endpoint, status, seconds):
+        with self._lock:
+            self._requests[(endpoint, status)] += 1
+            buckets, _, _ = entry = self._durations[endpoint]
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if seconds <= bound:
+                    buckets[i] += 1
+            entry[1] += 1
+            entry[2] += seconds
+
+    @staticmethod
+    def _labels(**labels):
+        def escape(value):
+            return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+        return ",".join(f'{name}="{escape(value)}"' for name, value in labels.items())
+
+    def render(self):
+        """
+        It renders every metric in the Prometheus text exposition format
+
+        Returns:
+          The metrics, as a string.
+        """
+        p = self.prefix
+        lines = [
+            f"# HELP {p}_http_requests_total Requests handled, by endpoint and status.",
+            f"# TYPE {p}_http_requests_total counter",
+        ]
+        with self._lock:
+            for (endpoint, status), count in sorted(self._requests.items()):
+                labels = self._labels(endpoint=endpoint, status=status)
+                lines.append(f"{p}_http_requests_total{{{labels}}} {count}")
+
+            lines += [
+                f"# HELP {p}_http_request_duration_seconds Time spent handling requests.",
+                f"# TYPE {p}_http_request_duration_seconds histogram",
+            ]
+            for endpoint, (buckets, count, total) in sorted(self._durations.items()):
+                for bound, bucket_count in zip(DURATION_BUCKETS, buckets):
+                    labels = self._labels(endpoint=endpoint, le=bound)
+                    lines.append(
+                        f"{p}_http_request_duration_seconds_bucket{{{labels}}} {bucket_count}"
+                    )
+                labels = self._labels(endpoint=endpoint, le="+Inf")
+                lines.append(f"{p}_http_request_duration_seconds_bucket{{{labels}}} {count}")
+                labels = self._labels(endpoint=endpoint)
+                lines.append(f"{p}_http_request_duration_seconds_sum{{{labels}}} {total}")
+                lines.append(f"{p}_http_request_duration_seconds_count{{{labels}}} {count}")
+
+            lines += [
+                f"# HELP {p}_calls_total Calls made to Spotify and MongoDB, by operation.",
+                f"# TYPE {p}_calls_total counter",
+            ]
+            for (service, operation), (count, _, _) in sorted(self._calls.items()):
+                labels = self._labels(service=service, operation=operation)
+                lines.append(f"{p}_calls_total{{{labels}}} {count}")
+            lines += [
+                f"# HELP {p}_call_errors_total Calls that raised, by operation.",
+                f"# TYPE {p}_call_errors_total counter",
+            ]
+            for (service, operation), (_, failed, _) in sorted(self._calls.items()):
+                labels = self._labels(service=service, operation=operation)
+                lines.append(f"{p}_call_errors_total{{{labels}}} {failed}")
+            lines += [
+                f"# HELP {p}_call_duration_seconds_total Time spent in calls, by operation.",
+                f"# TYPE {p}_call_duration_seconds_total counter",
+            ]
+            for (service, operation), (_, _, total) in sorted(self._calls.items()):
+                labels = self._labels(service=service, operation=operation)
+                lines.append(f"{p}_call_duration_seconds_total{{{labels}}} {total}")
+        for collector in self._collectors:
+            try:
+                for name, kind, description, samples in collector():
+                    lines += [f"# HELP {p}_{name} {description}", f"# TYPE {p}_{name} {kind}"]
+                    for labels, value in samples:
+                        lines.append(f"{p}_{name}{{{self._labels(**labels)}}} {value}")
+            except Exception as e:
+                logger.error(f"metrics collector {collector!r} failed: {e!r}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def current():
+    """
+    It returns the metrics of the request being handled, or None outside of a request
+    """
+    return _current.get()
+
+
+def start_request(endpoint=None):
+    """
+    It starts collecting the calls of a request
+
+    Args:
+      endpoint: The name of the endpoint being handled.
+
+    Returns:
+      A tuple of the request's RequestMetrics and the token to pass to `end_request`.
+    """
+    request_metrics = RequestMetrics(endpoint)
+    return request_metrics, _current.set(request_metrics)
+
+
+def end_request(request_metrics, token, status, method=None, path=None, remote_addr=None):
+    """
+    It stops collecting the calls of a request, counts it in the registry and logs a summary of it
+
+    Args:
+      request_metrics: The RequestMetrics returned by `start_request`.
+      token: The token returned by `start_request`.
+      status: The status code of the response.
+      method: The HTTP method of the request, for the log.
+      path: The path of the request, for the log.
+      remote_addr: The address of the client, for the log.
+    """
+    _current.reset(token)
+    endpoint = request_metrics.endpoint or "unknown"
+    registry.observe_request(endpoint, status, request_metrics.elapsed())
+    if endpoint == "static":
+        return
+    summary = {
+        "method": method,
+        "path": path,
+        "status": status,
+        "remote_addr": remote_addr,
+        **request_metrics.summary(),
+    }
+    logger.info("request %s", json.dumps(summary))
+
+
+@contextmanager
+def timed(service, operation):
+    """
+    It times the call made inside the `with` block and records it in the current request's metrics
+    and in the registry
+
+    Args:
+      service: The service called, e.g. "spotify" or "mongo".
+      operation: What was called, e.g. "GET me/top/tracks" or "spotify_users.find_one".
+    """
+    started = time.perf_counter()
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        record(service, operation, time.perf_counter() - started, failed)
+
+
+def record(service, operation, seconds, failed=False):
+    """
+    It records a call that was already timed in the current request's metrics and in the registry
+
+    Args:
+      service: The service called, e.g. "spotify" or "mongo".
+      operation: What was called.
+      seconds: How long the call took.
+      failed: Whether the call raised.
+    """
+    registry.observe_call(service, operation, seconds, failed)
+    request_metrics = _current.get()
+    if request_metrics is not None:
+        request_metrics.add(service, operation, seconds)
+
+
+class InstrumentedCollection:
+    """
+    It wraps a pymongo collection and times every operation sent to it. A cursor returned by `find`
+    only queries the database once it's iterated, so `find` is counted but its time is mostly spent
+    by the caller. Everything that isn't an operation is passed through to the collection untouched
+
+    Args:
+      collection: The pymongo collection to wrap.
+    """
+
+    OPERATIONS = {
+        "find_one",
+        "find",
+        "insert_one",
+        "insert_many",
+        "update_one",
+        "update_many",
+        "replace_one",
+        "delete_one",
+        "delete_many",
+        "bulk_write",
+        "aggregate",
+        "count_documents",
+        "find_one_and_update",
+        "create_index",
+    }
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def __getattr__(self, name):
+        attribute = getattr(self.collection, name)
+        if name not in self.OPERATIONS:
+            return attribute
+
+        def operation(*args, **kwargs):
+            with timed("mongo", f"{self.collection.name}.{name}"):
+                return attribute(*args, **kwargs)
+
+        return operation
@@ -0,0 +1,229 @@
+import json
+import logging
+import queue
+import threading
+import traceback
+import uuid
+from collections import defaultdict
+
+from functions import spotify
+
+logger = logging.getLogger("spotify")
+
+
+class Subscription:
+    """
+    It is one viewer's feed of a user's currently playing track. Updates are queued until the viewer's
+    stream takes them, and only the latest few are kept for a viewer that can't keep up
+
+    Args:
+      hub: The NowPlayingHub the subscription belongs to.
+      user_id: The id of the user being watched.
+      maxsize: The number of updates kept.
+    """
+
+    def __init__(self, hub, user_id, maxsize=8):
+        self.hub = hub
+        self.user_id = user_id
+        self._queue = queue.Queue(maxsize=maxsize)
+
+    def put(self, currently_playing):
+        while True:
+            try:
+                self._queue.put_nowait(currently_playing)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout=None):
+        """
+        It waits for the next update
+
+        Args:
+          timeout: The number of seconds to wait at most.
+
+        Returns:
+          The next currently playing dictionary, or None if there was none in time.
+        """
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+
+class NowPlayingHub:
+    """
+    It pushes changes of users' currently playing tracks to everyone watching their profile. While a
+    user has viewers, one poller fetches their track every `interval` seconds and publishes it when
+    it changes, so Spotify is called once per watched profile instead of once per viewer. With a Redis
+    client the poller of a user runs in one worker only, elected with a lock, and the changes reach
+    the viewers connected to every worker over pub/sub. The poller stops with the last viewer
+
+    Args:
+      fetch: A function taking a user id and returning their currently playing dictionary.
+      redis: A redis-py client, or None to only serve the viewers of this process.
+      interval: The number of seconds between two fetches of the same user.
+    """
+
+    CHANNEL_PREFIX = "now_playing/"
+
+    def __init__(self, fetch, redis=None, interval=5):
+        self.fetch = fetch
+        self.redis = redis
+        self.interval = interval
+        self.worker_id = uuid.uuid4().hex
+        self._subscribers = defaultdict(set)
+        self._pollers = {}
+        self._lock = threading.Lock()
+        self._listener = None
+
+    def subscribe(self, user_id):
+        """
+        It starts following a user's currently playing track, starting their poller if they had no
+        viewers in this process yet
+
+        Args:
+          user_id: The id of the user to follow.
+
+        Returns:
+          A Subscription to read the updates from and to close once done.
+        """
+        subscription = Subscription(self, user_id)
+        with self._lock:
+            self._subscribers[user_id].add(subscription)
+            if user_id not in self._pollers:
+                stopped = threading.Event()
+                thread = threading.Thread(
+                    target=self._poll,
+                    args=(user_id, stopped),
+                    name=f"now-playing-{user_id}",
+                    daemon=True,
+                )
+                self._pollers[user_id] = (thread, stopped)
+                thread.start()
+            self._start_listener()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            subscribers = self._subscribers.get(subscription.user_id)
+            if subscribers is None:
+                return
+            subscribers.discard(subscription)
+            if not subscribers:
+                del self._subscribers[subscription.user_id]
+                _, stopped = self._pollers.pop(subscription.user_id, (None, None))
+                if stopped is not None:
+                    stopped.set()
+
+    def viewers(self, user_id):
+        with self._lock:
+            return len(self._subscribers.get(user_id, ()))
+
+    def _deliver(self, user_id, currently_playing):
+        with self._lock:
+            subscribers = list(self._subscribers.get(user_id, ()))
+        for subscription in subscribers:
+            subscription.put(currently_playing)
+
+    def _poller_key(self, user_id):
+        return f"{self.CHANNEL_PREFIX}poller/{user_id}"
+
+    def _claim(self, user_id):
+        """
+        It makes this worker the poller of a user, or keeps it so. Without Redis every process polls
+        for its own viewers
+
+        Returns:
+          True if this worker should poll the user.
+        """
+        if self.redis is None:
+            return True
+        key, timeout = self._poller_key(user_id), max(int(self.interval * 3), 1)
+        try:
+            if self.redis.set(key, self.worker_id, nx=True, ex=timeout):
+                return True
+            if self.redis.get(key) == self.worker_id.encode():
+                self.redis.expire(key, timeout)
+                return True
+            return False
+        except Exception as e:
+            logger.error(f"now playing couldn't claim the poller of {user_id}: {e!r}")
+            return True
+
+    def _release(self, user_id):
+        if self.redis is None:
+            return
+        key = self._poller_key(user_id)
+        try:
+            if self.redis.get(key) == self.worker_id.encode():
+                self.redis.delete(key)
+        except Exception as e:
+            logger.error(f"now playing couldn't release the poller of {user_id}: {e!r}")
+
+    def _publish(self, user_id, currently_playing):
+        if self.redis is not None:
+            try:
+                self.redis.publish(
+                    f"{self.CHANNEL_PREFIX}{user_id}", json.dumps(currently_playing)
+                )
+                return
+            except Exception as e:
+                logger.error(f"now playing couldn't publish for {user_id}: {e!r}")
+        self._deliver(user_id, currently_playing)
+
+    def _poll(self, user_id, stopped):
+        logger.debug(f"Started polling the currently playing track of {user_id}")
+        last_etag = None
+        while not stopped.is_set():
+            if self._claim(user_id):
+                try:
+                    currently_playing = self.fetch(user_id)
+                    etag = spotify.currently_playing_etag(currently_playing)
+                    if etag != last_etag:
+                        self._publish(user_id, currently_playing)
+                        last_etag = etag
+                except Exception:
+                    logger.error(
+                        f"Polling the currently playing track of {user_id} failed\n"
+                        f"{traceback.format_exc()}"
+                    )
+            else:
+                # another worker polls, it may stop before us so start from scratch if we take over
+                last_etag = None
+            stopped.wait(self.interval)
+        self._release(user_id)
+        logger.debug(f"Stopped polling the currently playing track of {user_id}")
+
+    def _start_listener(self):
+        if self.redis is None or self._listener is not None:
+            return
+        self._listener = threading.Thread(
+            target=self._listen, name="now-playing-listener", daemon=True
+        )
+        self._listener.start()
+
+    def _listen(self):
+        # one pattern subscription for every user, so the connection is only used by this thread
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(f"{self.CHANNEL_PREFIX}*")
+                for message in pubsub.listen():
+                    if message["type"] != "pmessage":
+                        continue
+                    channel = message["channel"]
+                    if isinstance(channel, bytes):
+                        channel = channel.decode()
+                    user_id = channel[len(self.CHANNEL_PREFIX) :]
+                    if self.viewers(user_id):
+                        self._deliver(user_id, json.loads(message["data"]))
+            except Exception as e:
+                logger.error(f"now playing listener lost Redis, reconnecting: {e!r}")
+                threading.Event().wait(self.interval)
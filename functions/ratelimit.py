@@ -0,0 +1,177 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+logger = logging.getLogger("spotify")
+
+INTERACTIVE = "interactive"
+BACKGROUND = "background"
+
+_priority = ContextVar("spotify_priority", default=INTERACTIVE)
+
+# It refills the bucket for the time elapsed since the last call, then takes a token if more than
+# `floor` tokens are left. It returns how long to wait before trying again, or 0 if a token was taken
+_TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local floor = tonumber(ARGV[4])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(bucket[1]) or capacity
+local updated_at = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+local wait = 0
+if tokens - floor >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 + floor - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+
+class RateLimited(Exception):
+    """
+    It is raised when a call would have to wait longer than its priority allows for the rate limit
+    """
+
+
+def current_priority():
+    return _priority.get()
+
+
+@contextmanager
+def priority(value):
+    """
+    It sets the priority of the Spotify calls made inside the `with` block, and of the calls made by
+    worker threads started from it
+
+    Args:
+      value: INTERACTIVE or BACKGROUND.
+    """
+    token = _priority.set(value)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket:
+    """
+    It spreads the app's Spotify calls over time: every call takes a token from a bucket holding at
+    most `capacity` tokens and refilled with `rate` tokens per second. With a Redis client the bucket
+    is shared by every worker. Background calls leave `reserve` of the bucket to interactive ones, so
+    cache refreshes slow down first when the app gets close to the limit. When Spotify answers with a
+    429 anyway, every call pauses for as long as its Retry-After asks
+
+    Args:
+      rate: The number of calls per second, 0 to disable the limit.
+      capacity: The number of calls that can be made at once after a quiet period.
+      reserve: The share of the bucket, from 0 to 1, background calls can't use.
+      redis: A redis-py client, or None to only limit the calls of this process.
+      key: The Redis key of the bucket.
+    """
+
+    def __init__(self, rate, capacity, reserve=0.25, redis=None, key="spotify_rate_limit"):
+        self.rate = rate
+        self.capacity = capacity
+        self.reserve = reserve
+        self.redis = redis
+        self.key = key
+        self._tokens = capacity
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self._script = None
+
+    def _floor(self, priority):
+        return self.capacity * self.reserve if priority == BACKGROUND else 0
+
+    def _take_local(self, floor):
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._updated_at
+            self._tokens = min(self.capacity, self._tokens + elapsed * self.rate)
+            self._updated_at = now
+            if self._tokens - floor >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 + floor - self._tokens) / self.rate
+
+    def _take_remote(self, floor):
+        if self._script is None:
+            self._script = self.redis.register_script(_TAKE_SCRIPT)
+        wait = self._script(
+            keys=[self.key], args=[self.rate, self.capacity, time.time(), floor]
+        )
+        return float(wait)
+
+    def _take(self, floor):
+        if self.redis is not None:
+            try:
+                return self._take_remote(floor)
+            except Exception as e:
+                logger.error(f"rate limiter couldn't reach Redis, limiting locally: {e!r}")
+        return self._take_local(floor)
+
+    def _pause_remaining(self):
+        paused_until = self._paused_until
+        if self.redis is not None:
+            try:
+                remote = self.redis.get(f"{self.key}/paused_until")
+                if remote is not None:
+                    paused_until = max(paused_until, float(remote))
+            except Exception as e:
+                logger.error(f"rate limiter couldn't read the pause: {e!r}")
+        return paused_until - time.time()
+
+    def pause(self, seconds):
+        """
+        It stops every call, in every worker, for `seconds`, e.g. after a 429 with a Retry-After
+
+        Args:
+          seconds: The number of seconds to pause for.
+        """
+        paused_until = time.time() + seconds
+        self._paused_until = max(self._paused_until, paused_until)
+        if self.redis is not None:
+            try:
+                self.redis.set(
+                    f"{self.key}/paused_until", paused_until, px=max(int(seconds * 1000), 1)
+                )
+            except Exception as e:
+                logger.error(f"rate limiter couldn't share the pause: {e!r}")
+
+    def acquire(self, priority=None, max_wait=None):
+        """
+        It waits until a call of the given priority may be made
+
+        Args:
+          priority: INTERACTIVE or BACKGROUND, defaults to the priority of the current context.
+          max_wait: The number of seconds the call may wait at most, forever when None.
+
+        Returns:
+          The number of seconds waited.
+        """
+        if not self.rate:
+            return 0.0
+        priority = priority or current_priority()
+        floor = self._floor(priority)
+        deadline = None if max_wait is None else time.monotonic() + max_wait
+        waited = 0.0
+        while True:
+            wait = self._pause_remaining()
+            if wait <= 0:
+                wait = self._take(floor)
+                if wait <= 0:
+                    return waited
+            if deadline is not None and time.monotonic() + wait > deadline:
+                raise RateLimited(
+                    f"A {priority} Spotify call would wait {wait:.2f}s for the rate limit"
+                )
+            time.sleep(wait)
+            waited += wait
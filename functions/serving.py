@@ -0,0 +1,181 @@
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+
+from flask import current_app, request, url_for
+from jinja2 import FileSystemBytecodeCache
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, static files are then only pre-compressed with gzip
+    brotli = None
+
+logger = logging.getLogger("spotify")
+
+# The types worth compressing, images and fonts are compressed already
+COMPRESSIBLE_TYPES = {
+    "application/javascript",
+    "application/json",
+    "application/manifest+json",
+    "image/svg+xml",
+    "text/css",
+    "text/html",
+    "text/javascript",
+    "text/plain",
+}
+
+
+def precompile_templates(app, cache_dir=None):
+    """
+    It compiles every template once, at startup, instead of on the first request that renders it.
+    The compiled code is also written to a bytecode cache, so the next workers and restarts load it
+    instead of parsing the templates again, and templates are no longer checked for changes on every
+    render
+
+    Args:
+      app: The Flask app.
+      cache_dir: The directory of the bytecode cache, defaults to one in the temporary directory.
+
+    Returns:
+      The number of templates compiled.
+    """
+    env = app.jinja_env
+    env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+    env.auto_reload = False
+    names = env.list_templates()
+    for name in names:
+        env.get_template(name)
+    logger.debug(f"Precompiled {len(names)} templates")
+    return len(names)
+
+
+def accepts(encoding):
+    return request.accept_encodings[encoding] > 0
+
+
+def compress_response(response, min_size=1024, level=6):
+    """
+    It gzips an HTML or JSON response of at least `min_size` bytes when the client accepts it.
+    Streamed responses, like the currently playing stream, and files are left alone, and a strong
+    ETag is made weak since the bytes sent are no longer the ones it was computed from
+
+    Args:
+      response: The response of the request.
+      min_size: The number of bytes below which compressing isn't worth it.
+      level: The gzip compression level.
+
+    Returns:
+      The response, compressed or not.
+    """
+    if (
+        response.status_code != 200
+        or response.direct_passthrough
+        or response.is_streamed
+        or "Content-Encoding" in response.headers
+        or response.mimetype not in COMPRESSIBLE_TYPES
+    ):
+        return response
+    response.vary.add("Accept-Encoding")
+    if not accepts("gzip") or (response.content_length or 0) < min_size:
+        return response
+    response.set_data(gzip.compress(response.get_data(), compresslevel=level))
+    response.headers["Content-Encoding"] = "gzip"
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+class StaticAssets:
+    """
+    It serves the files in the app's static folder so browsers can cache them for good. Every file
+    is hashed at startup, and `static_url` in the templates links to it with its hash in the query
+    string, so a URL always points to the same content and is served with a long-lived, immutable
+    Cache-Control. The compressible files are also compressed once, at startup, with gzip and brotli
+    when it's installed, and served compressed to the clients that accept it. When disabled, e.g.
+    while developing, the files are served by Flask as they are on disk
+
+    Args:
+      app: The Flask app.
+      enabled: Whether to hash and compress the files.
+      max_age: The number of seconds a hashed URL is cached for.
+      min_size: The number of bytes below which a file isn't compressed.
+    """
+
+    def __init__(self, app, enabled=True, max_age=31536000, min_size=1024):
+        self.enabled = enabled
+        self.max_age = max_age
+        self.min_size = min_size
+        self.assets = {}
+        app.jinja_env.globals["static_url"] = self.url
+        if enabled:
+            self.load(app.static_folder)
+            app.view_functions["static"] = self.send
+
+    def load(self, folder):
+        for root, _, files in os.walk(folder):
+            for name in files:
+                path = os.path.join(root, name)
+                filename = os.path.relpath(path, folder).replace(os.sep, "/")
+                with open(path, "rb") as f:
+                    data = f.read()
+                mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+                variants = {}
+                if mimetype in COMPRESSIBLE_TYPES and len(data) >= self.min_size:
+                    variants["gzip"] = gzip.compress(data, compresslevel=9)
+                    if brotli is not None:
+                        variants["br"] = brotli.compress(data, quality=11)
+                self.assets[filename] = {
+                    "digest": hashlib.sha256(data).hexdigest()[:12],
+                    "mimetype": mimetype,
+                    "variants": variants,
+                }
+        logger.debug(f"Loaded {len(self.assets)} static files")
+
+    def url(self, filename):
+        """
+        It links to a static file, with its hash when it's known
+
+        Args:
+          filename: The path of the file in the static folder, e.g. "css/base.css".
+
+        Returns:
+          The URL of the file.
+        """
+        asset = self.assets.get(filename)
+        if asset is None:
+            return url_for("static", filename=filename)
+        return url_for("static", filename=filename, v=asset["digest"])
+
+    def send(self, filename):
+        asset = self.assets.get(filename)
+        if asset is None:
+            return current_app.send_static_file(filename)
+        encoding = next(
+            (
+                encoding
+                for encoding in ("br", "gzip")
+                if encoding in asset["variants"] and accepts(encoding)
+            ),
+            None,
+        )
+        if encoding is None:
+            response = current_app.send_static_file(filename)
+        else:
+            response = current_app.response_class(
+                asset["variants"][encoding], mimetype=asset["mimetype"]
+            )
+            response.headers["Content-Encoding"] = encoding
+            response.set_etag(f"{asset['digest']}-{encoding}")
+            response.cache_control.no_cache = True
+            response.make_conditional(request)
+        if asset["variants"]:
+            response.vary.add("Accept-Encoding")
+        if request.args.get("v") == asset["digest"]:
+            response.cache_control.no_cache = None
+            response.cache_control.public = True
+            response.cache_control.max_age = self.max_age
+            response.cache_control.immutable = True
+        return response
@@ -0,0 +1,135 @@
+import logging
+import pickle
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+
+logger = logging.getLogger("spotify")
+
+
+class SingleFlight:
+    """
+    It makes sure only one call per key runs at a time and hands its result to everyone who asked
+    for the same key while it was running. Inside a process the callers simply wait for the first
+    call. With a Redis client the first caller across all workers also takes a Redis lock, and
+    callers in other workers poll for the result it publishes instead of running the call again.
+    The result is published under the token of the lock, so callers only ever get the result of the
+    call that was running when they asked, never one left over by an earlier call
+
+    Args:
+      redis: A redis-py client, or None to coalesce only inside this process.
+      lock_timeout: The number of seconds the Redis lock is held at most, in case its holder dies.
+      wait_timeout: The number of seconds a caller in another worker waits before giving up and
+        running the call itself.
+      result_ttl: The number of seconds a published result stays in Redis for the callers polling it.
+      poll_interval: The number of seconds between two polls for the result.
+    """
+
+    def __init__(
+        self,
+        redis=None,
+        lock_timeout=30,
+        wait_timeout=10,
+        result_ttl=5,
+        poll_interval=0.05,
+    ):
+        self.redis = redis
+        self.lock_timeout = lock_timeout
+        self.wait_timeout = wait_timeout
+        self.result_ttl = result_ttl
+        self.poll_interval = poll_interval
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        """
+        It calls `fn` unless a call for the same key is already running, in which case it waits for
+        that call and returns its result, or raises its exception
+
+        Args:
+          key: The key identifying the call.
+          fn: A function that takes no arguments.
+
+        Returns:
+          The value returned by `fn`.
+        """
+        with self._lock:
+            future = self._calls.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = self._calls[key] = Future()
+        if not is_leader:
+            logger.debug(f"Waiting for the running call of {key}")
+            return future.result()
+        try:
+            future.set_result(self._do_remote(key, fn))
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self._lock:
+                del self._calls[key]
+        return future.result()
+
+    def _do_remote(self, key, fn):
+        if self.redis is None:
+            return fn()
+        lock_key = f"singleflight/lock/{key}"
+        token = uuid.uuid4().hex
+        try:
+            is_leader = self.redis.set(
+                lock_key, token, nx=True, ex=self.lock_timeout
+            )
+            leader = None if is_leader else self.redis.get(lock_key)
+        except Exception as e:
+            logger.error(f"single flight couldn't lock {key}: {e!r}")
+            return fn()
+        if is_leader:
+            try:
+                result = fn()
+                self._publish(self._result_key(key, token), result)
+                return result
+            finally:
+                self._unlock(lock_key, token)
+        if leader is None:
+            # the other worker's call ended in between, and its result may already be out of date
+            return fn()
+        return self._wait(key, lock_key, leader, fn)
+
+    @staticmethod
+    def _result_key(key, token):
+        return f"singleflight/result/{key}/{token}"
+
+    def _publish(self, result_key, result):
+        try:
+            self.redis.set(result_key, pickle.dumps(result), ex=self.result_ttl)
+        except Exception as e:
+            logger.error(f"single flight couldn't publish {result_key}: {e!r}")
+
+    def _unlock(self, lock_key, token):
+        try:
+            if self.redis.get(lock_key) == token.encode():
+                self.redis.delete(lock_key)
+        except Exception as e:
+            logger.error(f"single flight couldn't unlock {lock_key}: {e!r}")
+
+    def _wait(self, key, lock_key, leader, fn):
+        logger.debug(f"Waiting for another worker's call of {key}")
+        result_key = self._result_key(key, leader.decode())
+        deadline = time.monotonic() + self.wait_timeout
+        try:
+            while time.monotonic() < deadline:
+                result = self.redis.get(result_key)
+                if result is not None:
+                    return pickle.loads(result)
+                if self.redis.get(lock_key) != leader:
+                    # the call is over: either its result was published just now, or the other
+                    # worker failed and never will
+                    result = self.redis.get(result_key)
+                    if result is not None:
+                        return pickle.loads(result)
+                    break
+                time.sleep(self.poll_interval)
+        except Exception as e:
+            logger.error(f"single flight couldn't wait for {key}: {e!r}")
+        return fn()
@@ -1,12 +1,94 @@
 from collections import Counter
+from functools import partial
 import datetime
-import traceback
-import spotipy
+import hashlib
 import logging
+import os
+import re
+from urllib.parse import urlsplit
+
+from spotipy.exceptions import SpotifyException
+
+from functions import fetch
+from functions import jobs
+from functions.cache import TTLCache
+from functions.context import SpotifyContext
+from functions.freshness import FreshnessRegistry
+from functions.history import to_cursor
+from functions.singleflight import SingleFlight
+from functions.transform import field, image, ranked, transform
 
 logger = logging.getLogger("spotify")
 logger.setLevel(logging.DEBUG)
 
+TIME_RANGES = ("short_term", "medium_term", "long_term")
+# Spotify's largest page size for the top items endpoints
+TOP_ARTISTS_LIMIT = 50
+TOP_ARTISTS_CARDS = 10
+PLAYLISTS_PAGE_SIZE = 50
+# Spotify's largest page size, and number of tracks added at once, for a playlist's items
+PLAYLIST_ITEMS_PAGE_SIZE = 100
+RECENTLY_PLAYED_PAGE_SIZE = 50
+RECOMMENDED_PLAYLIST_NAME = "Recommended Tracks"
+# Spotify ids are 22 base62 characters
+TRACK_ID = re.compile(r"[0-9A-Za-z]{22}")
+DAY = 24 * 60 * 60
+# How long every cached section is served before it's refreshed in the background
+freshness = FreshnessRegistry(default_ttl=4 * DAY)
+# What users played recently changes the fastest, and long term favourites the slowest
+TOP_ITEMS_RANGE_TTLS = {"short_term": DAY, "medium_term": 7 * DAY, "long_term": 30 * DAY}
+freshness.register("top_tracks", range_ttls=TOP_ITEMS_RANGE_TTLS)
+freshness.register("top_artists", range_ttls=TOP_ITEMS_RANGE_TTLS)
+freshness.register("top_genres", range_ttls=TOP_ITEMS_RANGE_TTLS)
+freshness.register("playlists", DAY)
+# How long a saved recommended playlist is trusted before checking the user still has it
+freshness.register("recommended_playlist", DAY)
+# How long the plays made since the last ingestion may wait before they're ingested
+freshness.register("recently_played", 60)
+# Two ingestions of the same user at once would both append the same plays
+ingest_flight = SingleFlight()
+
+# Follower counts change slowly and are shared by everyone who views the playlist's owner, so they
+# are kept apart from the playlists section with their own lifetime
+playlist_followers = TTLCache(
+    maxsize=int(os.getenv("PLAYLIST_FOLLOWERS_CACHE_SIZE", 10000)),
+    ttl=int(os.getenv("PLAYLIST_FOLLOWERS_TTL", 6 * 60 * 60)),
+)
+# How long a refresh waits for all the follower counts it's missing, however many there are
+PLAYLIST_FOLLOWERS_TIMEOUT = float(os.getenv("PLAYLIST_FOLLOWERS_TIMEOUT", fetch.FETCH_TIMEOUT))
+
+# What every section keeps of the tracks, artists and playlists Spotify returns
+TRACK_FIELDS = {
+    "track_name": field("name"),
+    "artist_name": field("artists", 0, "name"),
+    "album_name": field("album", "name"),
+    "album_cover": image("album", "images"),
+    "track_id": field("id"),
+    "track_url": field("external_urls", "spotify"),
+}
+ARTIST_FIELDS = {
+    "artist_name": field("name"),
+    "artist_id": field("id"),
+    "artist_url": field("external_urls", "spotify"),
+    "artist_image": image("images"),
+    "followers": field("followers", "total", default=0),
+}
+PLAYLIST_FIELDS = {
+    "playlist_name": field("name"),
+    "playlist_id": field("id"),
+    "playlist_url": field("external_urls", "spotify"),
+    "playlist_picture": image("images", default=""),
+}
+PLAY_FIELDS = {
+    "track_id": field("track", "id"),
+    "track_name": field("track", "name"),
+    "artist_name": field("track", "artists", 0, "name"),
+    "album_name": field("track", "album", "name"),
+    "album_picture": image("track", "album", "images"),
+    "track_url": field("track", "external_urls", "spotify"),
+}
+
+
 def get_user_info(access_token):
     """
     It takes an access token and returns the user's information
@@ -17,161 +99,281 @@ def get_user_info(access_token):
     Returns:
       A dictionary with the user's information.
     """
-    sp = spotipy.Spotify(auth=access_token)
-    logger.debug("Getting user info for {}".format(sp.current_user()["display_name"]))
-    return sp.current_user()
+    return SpotifyContext(access_token).user_info
 
 
-def get_640_image(list_of_images):
+def get_cached_section(ctx, store, name, refresh, refresh_key=None):
     """
-    It takes a list of images and returns the URL of the image that has a width of 640 pixels
+    It returns a section cached in the user's document, downloading it only when there is no cached
+    copy yet. A copy older than its freshness policy allows is still returned right away, and a
+    background job is queued to refresh it, so visitors never wait on Spotify for a section that is
+    merely stale. A section whose policy has time ranges only has its stale time ranges refreshed
 
     Args:
-      list_of_images: a list of dictionaries, each dictionary containing information about an image.
+      ctx: The SpotifyContext of the user.
+      store: The UserStore the section is cached in.
+      name: The field of the user's document holding the section.
+      refresh: A function taking the context and the store that downloads, saves and returns the
+        section, and the time ranges to download as `time_ranges` if its policy has time ranges.
+      refresh_key: The name background refreshes are de-duplicated by, defaults to `name`.
+        Sections refreshed together should share it, so they expire together.
 
     Returns:
-      The url of the image with a width of 640.
+      The section.
+    """
+    user_id = ctx.user_id
+    section = store.get_field(user_id, name)
+    if not isinstance(section, dict) or "datetime_added" not in section:
+        logger.info(f"No cached {name} for {user_id}, fetching it")
+        return refresh(ctx, store)
+    policy = freshness[name]
+    key = f"{refresh_key or name}/{user_id}"
+    if policy.is_stale(key, section):
+        if policy.range_ttls:
+            refresh = partial(refresh, time_ranges=policy.stale_ranges(key, section))
+        jobs.refresh_queue.enqueue(key, partial(refresh, ctx, store))
+    return section
+
+
+def time_ranges_to_download(section, time_ranges):
     """
-    for image in list_of_images:
-        if image["width"] == 640:
-            return image["url"]
+    It tells which time ranges of a section have to be downloaded: the ones asked for, or every one
+    of them if the cached section doesn't have them all
 
+    Args:
+      section: The cached section, or None.
+      time_ranges: The time ranges asked for.
 
-def get_user_top_tracks(access_token, collection):
+    Returns:
+      A tuple of time ranges.
     """
-    It gets the user's top tracks from Spotify, and returns a list of dictionaries containing the
-    track's name, artist, album, album cover, track id, and track url
+    if not isinstance(section, dict) or any(time_range not in section for time_range in TIME_RANGES):
+        return TIME_RANGES
+    return tuple(time_ranges)
+
+
+def merge_time_ranges(section, ranges, datetime_added):
+    """
+    It puts the time ranges downloaded again into a section, keeping the others as they were
 
     Args:
-      access_token: The access token that you get from the Spotify API.
+      section: The cached section, or None.
+      ranges: A dictionary mapping the time ranges downloaded to their items.
+      datetime_added: When they were downloaded.
 
     Returns:
-      A list of dictionaries.
+      The section, with when each of its time ranges was downloaded as `ranges_added`.
+    """
+    section = dict(section) if isinstance(section, dict) else {}
+    ranges_added = section.get("ranges_added") or {}
+    ranges_added = {
+        time_range: ranges_added.get(time_range, section.get("datetime_added"))
+        for time_range in TIME_RANGES
+        if time_range in section
+    }
+    section.update(ranges)
+    ranges_added.update(dict.fromkeys(ranges, datetime_added))
+    section["ranges_added"] = ranges_added
+    section["datetime_added"] = datetime_added
+    return section
+
+
+def get_user_top_tracks(ctx, store, catalog):
+    """
+    It gets the user's top tracks from Spotify, as the ids of the tracks for every time range, most
+    played first. `hydrate_sections` turns them into the track's name, artist, album, album cover,
+    track id, and track url
+
+    Args:
+      ctx: The SpotifyContext of the user.
+      store: The UserStore the section is cached in.
+      catalog: The Catalog the tracks are kept in.
+
+    Returns:
+      A dictionary mapping every time range to a list of track ids.
+    """
+    return get_cached_section(
+        ctx, store, "top_tracks", partial(refresh_user_top_tracks, catalog=catalog)
+    )
+
+
+def refresh_user_top_tracks(ctx, store, catalog, time_ranges=TIME_RANGES):
     """
-    user_id = get_user_info(access_token)["id"]    
-    try:
-      top_tracks = collection.find_one({"_id": user_id})["top_tracks"]
-      if top_tracks["datetime_added"] < datetime.datetime.now() - datetime.timedelta(days=4):
-        raise "Cache expired"
-    except Exception as e:
-      logger.error(e)
-      sp = spotipy.Spotify(auth=access_token)
-      short_term_top_tracks = sp.current_user_top_tracks(limit=10, offset=0, time_range="short_term")
-      medium_term_top_tracks = sp.current_user_top_tracks(limit=10, offset=0, time_range="medium_term")
-      long_term_top_tracks = sp.current_user_top_tracks(limit=10, offset=0, time_range="long_term")
-      top_tracks = {
-          "short_term": [
-              {
-                "number": short_term_top_tracks["items"].index(track) + 1,
-                "track_name" : track["name"],
-                "artist_name" : track["artists"][0]["name"],
-                "album_name" : track["album"]["name"],
-                "album_cover" : get_640_image(track["album"]["images"]),
-                "track_id" : track["id"],
-                "track_url" : track["external_urls"]["spotify"]
-              } for track in short_term_top_tracks["items"]
-          ],
-          "medium_term": [
-              {
-                "number": medium_term_top_tracks["items"].index(track) + 1,
-                "track_name" : track["name"],
-                "artist_name" : track["artists"][0]["name"],
-                "album_name" : track["album"]["name"],
-                "album_cover" : get_640_image(track["album"]["images"]),
-                "track_id" : track["id"],
-                "track_url" : track["external_urls"]["spotify"]
-              } for track in medium_term_top_tracks["items"]
-          ],
-          "long_term": [
-              {
-                "number": long_term_top_tracks["items"].index(track) + 1,
-                "track_name" : track["name"],
-                "artist_name" : track["artists"][0]["name"],
-                "album_name" : track["album"]["name"],
-                "album_cover" : get_640_image(track["album"]["images"]),
-                "track_id" : track["id"],
-                "track_url" : track["external_urls"]["spotify"]
-              } for track in long_term_top_tracks["items"]
-          ],
-          "datetime_added": datetime.datetime.now()
-      }
-      try:
-        collection.insert_one({"_id": user_id, "top_tracks": top_tracks})
-      except Exception as e:
-        collection.update_one({"_id": user_id}, {"$set": {"top_tracks": top_tracks}})
-      top_tracks = collection.find_one({"_id": user_id})["top_tracks"]
+    It downloads the user's top tracks for some time ranges, saves the tracks to the catalog and
+    their ids to the user's document
+
+    Args:
+      ctx: The SpotifyContext of the user.
+      store: The UserStore the section is cached in.
+      catalog: The Catalog the tracks are kept in.
+      time_ranges: The time ranges to download, the others are kept as they were.
+
+    Returns:
+      The top tracks section.
+    """
+    sp = ctx.sp
+    previous = None
+    if tuple(time_ranges) != TIME_RANGES:
+        previous = store.get_field(ctx.user_id, "top_tracks")
+        time_ranges = time_ranges_to_download(previous, time_ranges)
+    data = fetch.calls.gather({
+        time_range: partial(sp.current_user_top_tracks, limit=10, offset=0, time_range=time_range)
+        for time_range in time_ranges
+    })
+    catalog.save({
+        track["id"]: transform(track, TRACK_FIELDS)
+        for time_range in time_ranges
+        for track in data[time_range]["items"]
+    })
+    top_tracks = merge_time_ranges(
+        previous,
+        {
+            time_range: [track["id"] for track in data[time_range]["items"]]
+            for time_range in time_ranges
+        },
+        datetime.datetime.now(),
+    )
+    store.set(ctx.user_id, top_tracks=top_tracks)
     return top_tracks
 
 
-def get_user_top_artists(access_token, collection):
+def get_user_top_artists(ctx, store, catalog):
     """
-    > This function takes in an access token and returns a list of dictionaries containing the top 10
-    artists of the user
+    It gets the ids of the user's top 10 artists for every time range, most played first.
+    `hydrate_sections` turns them into the artist's name, id, url, image and followers
 
     Args:
-      access_token: the access token we got from the previous step
+      ctx: The SpotifyContext of the user.
+      store: The UserStore the section is cached in.
+      catalog: The Catalog the artists are kept in.
 
     Returns:
-      A list of dictionaries.
+      A dictionary mapping every time range to a list of artist ids.
+    """
+    return get_cached_section(
+        ctx,
+        store,
+        "top_artists",
+        lambda ctx, store, time_ranges=TIME_RANGES: get_user_top_artist_dataset(
+            ctx, store, catalog, time_ranges
+        )["top_artists"],
+        refresh_key="top_artist_dataset",
+    )
+
+
+def get_user_top_artist_dataset(ctx, store, catalog, time_ranges=TIME_RANGES):
+    """
+    It downloads the user's top artists for some time ranges once, and derives both the top artist
+    cards and the top genres from the same download. The result is shared by every caller using the
+    same context, so the two sections of a profile page only ever cost one download
+
+    Args:
+      ctx: The SpotifyContext of the user.
+      store: The UserStore the sections are cached in.
+      catalog: The Catalog the artists are kept in.
+      time_ranges: The time ranges to download, the others are kept as they were.
+
+    Returns:
+      A dictionary with the "top_artists" and "top_genres" sections.
+    """
+    return ctx.memoize(
+        f"top_artist_dataset/{'/'.join(time_ranges)}",
+        partial(_refresh_top_artist_dataset, ctx, store, catalog, time_ranges),
+    )
+
+
+def _refresh_top_artist_dataset(ctx, store, catalog, time_ranges):
+    user_id = ctx.user_id
+    sp = ctx.sp
+    previous, genre_counts = None, {}
+    if tuple(time_ranges) != TIME_RANGES:
+        previous = store.get_field(user_id, "top_artists")
+        # the genres of every time range, so the top genres are summed up without downloading them all
+        genre_counts = store.get_field(user_id, "genre_counts") or {}
+        time_ranges = time_ranges_to_download(previous, time_ranges)
+        if any(time_range not in genre_counts for time_range in TIME_RANGES):
+            time_ranges = TIME_RANGES
+    data = fetch.calls.gather({
+        time_range: partial(sp.current_user_top_artists, limit=TOP_ARTISTS_LIMIT, offset=0, time_range=time_range)
+        for time_range in time_ranges
+    })
+    cards = {
+        time_range: data[time_range]["items"][:TOP_ARTISTS_CARDS] for time_range in time_ranges
+    }
+    catalog.save({
+        item["id"]: transform(item, ARTIST_FIELDS)
+        for time_range in time_ranges
+        for item in cards[time_range]
+    })
+    datetime_added = datetime.datetime.now()
+    top_artists = merge_time_ranges(
+        previous,
+        {time_range: [item["id"] for item in cards[time_range]] for time_range in time_ranges},
+        datetime_added,
+    )
+    genre_counts = {
+        **genre_counts,
+        **{
+            time_range: [
+                [genre, count]
+                for genre, count in Counter(
+                    genre for item in data[time_range]["items"] for genre in item["genres"]
+                ).most_common()
+            ]
+            for time_range in time_ranges
+        },
+    }
+    genres = Counter()
+    for time_range in TIME_RANGES:
+        genres.update(dict(genre_counts[time_range]))
+    genres = [{"name": name, "number_of_occcurences": count} for name, count in genres.most_common()]
+    top_genres = {
+        "datetime_added": datetime_added,
+        "ranges_added": top_artists["ranges_added"],
+        "genres": genres,
+    }
+    store.set(user_id, top_artists=top_artists, top_genres=top_genres, genre_counts=genre_counts)
+    return {"top_artists": top_artists, "top_genres": top_genres}
+
+
+def hydrate_sections(catalog, *sections):
     """
-    user_id = get_user_info(access_token)["id"]    
-    try:
-      top_artists = collection.find_one({"_id": user_id})["top_artists"]
-      if top_artists["datetime_added"] < datetime.datetime.now() - datetime.timedelta(days=4):
-        raise "Cache expired"
-    except Exception as e:
-      logger.error(e)
-      sp = spotipy.Spotify(auth=access_token)
-      short_term_top_artists = sp.current_user_top_artists(limit=10, offset=0, time_range="short_term")
-      medium_term_top_artists = sp.current_user_top_artists(limit=10, offset=0, time_range="medium_term")
-      long_term_top_artists = sp.current_user_top_artists(limit=10, offset=0, time_range="long_term")
-      top_artists = {
-          "short_term": [
-              {
-                  "number": short_term_top_artists["items"].index(item) + 1,
-                  "artist_name": item["name"],
-                  "artist_id": item["id"],
-                  "artist_url": item["external_urls"]["spotify"],
-                  "artist_image": get_640_image(item["images"]),
-                  "followers": item["followers"]["total"]
-              }
-              for item in short_term_top_artists["items"]
-          ],
-          "medium_term": [
-              {
-                  "number": medium_term_top_artists["items"].index(item) + 1,
-                  "artist_name": item["name"],
-                  "artist_id": item["id"],
-                  "artist_url": item["external_urls"]["spotify"],
-                  "artist_image": get_640_image(item["images"]),
-                  "followers": item["followers"]["total"]
-              }
-              for item in medium_term_top_artists["items"]
-          ],
-          "long_term": [
-              {   
-                  "number": long_term_top_artists["items"].index(item) + 1,
-                  "artist_name": item["name"],
-                  "artist_id": item["id"],
-                  "artist_url": item["external_urls"]["spotify"],
-                  "artist_image": get_640_image(item["images"]),
-                  "followers": item["followers"]["total"]
-              }
-              for item in long_term_top_artists["items"]
-          ],
-          "datetime_added": datetime.datetime.now()
-      }
-      try:
-        collection.insert_one({"_id": user_id, "top_artists": top_artists})
-      except Exception as e:
-        collection.update_one({"_id": user_id}, {"$set": {"top_artists": top_artists}})
-      top_artists = collection.find_one({"_id": user_id})["top_artists"]
-    return top_artists
-  
-
-
-
-def get_user_currently_playing(access_token):
+    It turns the ids of sections like the top tracks and the top artists back into cards, numbered
+    by their rank, looking up every id of every section with one batch. Cards embedded by older
+    versions of the app are kept as they are until the section is refreshed
+
+    Args:
+      catalog: The Catalog the tracks and artists are kept in.
+      sections: Dictionaries mapping time ranges to lists of ids.
+
+    Returns:
+      A list of the sections, with a list of cards for every time range.
+    """
+    items = catalog.get_many(
+        item
+        for section in sections
+        for time_range in TIME_RANGES
+        for item in section.get(time_range, [])
+        if isinstance(item, str)
+    )
+    hydrated = []
+    for section in sections:
+        section = dict(section)
+        for time_range in TIME_RANGES:
+            cards = []
+            for number, item in enumerate(section.get(time_range, []), 1):
+                if isinstance(item, str):
+                    if item not in items:
+                        logger.warning(f"{item} is missing from the catalog")
+                        continue
+                    item = items[item]
+                cards.append({**item, "number": number})
+            section[time_range] = cards
+        hydrated.append(section)
+    return hydrated
+
+
+def get_user_currently_playing(ctx):
     """
     It takes an access token, uses it to create a Spotify object, then uses that object to get the
     currently playing track. If there is a currently playing track, it returns a dictionary with the
@@ -179,7 +381,7 @@ def get_user_currently_playing(access_token):
     track, it returns a dictionary with empty strings for all of the values
 
     Args:
-      access_token: The access token that you get from the Spotify API.
+      ctx: The SpotifyContext of the user.
 
     Returns:
       A dictionary with the following keys:
@@ -189,57 +391,110 @@ def get_user_currently_playing(access_token):
         album_cover
         track_id
         track_url
+        is_playing
         datetime_added
     """
-    sp = spotipy.Spotify(auth=access_token)
+    sp = ctx.sp
     data = sp.current_user_playing_track()
     datetime_added = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
-    if data:
+    # the item is missing while an ad or a local file is playing
+    if data and data.get("item"):
         currently_playing = {
-            "track_name": data["item"]["name"],
-            "artist_name": data["item"]["artists"][0]["name"],
-            "album_name": data["item"]["album"]["name"],
-            "album_cover": get_640_image(data["item"]["album"]["images"]),
-            "track_id": data["item"]["id"],
-            "track_url": data["item"]["external_urls"]["spotify"],
+            **transform(data["item"], TRACK_FIELDS),
+            "is_playing": data.get("is_playing", True),
             "datetime_added": datetime_added,
         }
     else:
-        currently_playing = {
-            "track_name": "",
-            "artist_name": "",
-            "album_name": "",
-            "album_cover": "",
-            "track_id": "",
-            "track_url": "",
-            "datetime_added": datetime_added,
-        }
-    logger.info("Got currently playing for {}".format(sp.current_user()["display_name"]))
+        currently_playing = nothing_playing(datetime_added)
     return currently_playing
 
 
+def is_same_playback(previous, currently_playing):
+    """
+    It tells whether two currently playing dictionaries describe the same track in the same state,
+    in which case there is nothing new to save or send
+
+    Args:
+      previous: The currently playing dictionary saved before, or None.
+      currently_playing: The currently playing dictionary just fetched.
+
+    Returns:
+      True if the track and whether it is playing are the same.
+    """
+    if not previous:
+        return False
+    return previous.get("track_id") == currently_playing.get(
+        "track_id"
+    ) and previous.get("is_playing") == currently_playing.get("is_playing")
+
+
+def currently_playing_etag(currently_playing):
+    """
+    It derives an ETag from the track and whether it is playing, the only things a poller cares about
+
+    Args:
+      currently_playing: A currently playing dictionary.
+
+    Returns:
+      The ETag, without quotes.
+    """
+    state = f"{currently_playing.get('track_id')}:{currently_playing.get('is_playing')}"
+    return hashlib.sha1(state.encode()).hexdigest()
+
+
+def nothing_playing(datetime_added=None):
+    """
+    It returns the currently playing dictionary used when the user isn't playing anything
+
+    Args:
+      datetime_added: When the user was last checked, defaults to now.
+
+    Returns:
+      A currently playing dictionary with empty strings for all of the track values
+    """
+    if datetime_added is None:
+        datetime_added = datetime.datetime.now().strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    return {
+        "track_name": "",
+        "artist_name": "",
+        "album_name": "",
+        "album_cover": "",
+        "track_id": "",
+        "track_url": "",
+        "is_playing": False,
+        "datetime_added": datetime_added,
+    }
+
+
 def get_uri_from_track_url(track_url):
     """
-    It takes a Spotify track URL and returns the URI of the track
+    It takes a Spotify track URL and returns the URI of the track. The URL must point to a track,
+    e.g. https://open.spotify.com/track/<id>, optionally behind a locale like /intl-fr, and the id be
+    a 22 character base62 string, so a bad link is refused before anything is sent to Spotify
 
     Args:
       track_url: The URL of the track you want to add to the playlist.
 
     Returns:
-      A list of track URIs
+      The URI of the track.
+
+    Raises:
+      ValueError: If the URL isn't the link of a track.
     """
-    track_url = track_url.split("?")[0]
-    track_id = track_url.split("/")[4]
-    uri = "spotify:track:" + track_id
-    return uri
+    segments = [segment for segment in urlsplit(track_url.strip()).path.split("/") if segment]
+    if segments and segments[0].startswith("intl-"):
+        segments = segments[1:]
+    if len(segments) != 2 or segments[0] != "track" or not TRACK_ID.fullmatch(segments[1]):
+        raise ValueError(f"{track_url!r} isn't the link of a Spotify track")
+    return "spotify:track:" + segments[1]
 
 
-def add_track_to_queue(access_token, track_url):
+def add_track_to_queue(ctx, track_url):
     """
     It takes a track URL and adds it to the user's queue
 
     Args:
-      access_token: The access token you got from the previous step.
+      ctx: The SpotifyContext of the user.
       track_url: The URL of the track you want to add to the queue.
 
     Returns:
@@ -247,177 +502,439 @@ def add_track_to_queue(access_token, track_url):
         'snapshot_id'
         'tracks'
     """
-    sp = spotipy.Spotify(auth=access_token)
+    sp = ctx.sp
     uri = get_uri_from_track_url(track_url)
     return sp.add_to_queue(uri)
 
-def get_user_public_playlists(access_token, collection):
+
+def get_user_public_playlists(ctx, store):
     """
     It gets the user's public playlists and returns a list of dictionaries containing the playlist's
     name, playlist id, and playlist url
 
     Args:
-      access_token: The access token that you get from the Spotify API.
+      ctx: The SpotifyContext of the user.
 
     Returns:
       A list of dictionaries.
     """
-    user_id = get_user_info(access_token)["id"]
-    try:
-      playlists = collection.find_one({"_id": user_id})["playlists"]
-      if playlists["datetime_added"] < datetime.datetime.now() - datetime.timedelta(days=4):
-        raise "Cache expired"
-    except Exception as e:
-      logger.error(traceback.format_exc())
-      sp = spotipy.Spotify(auth=access_token)
-      data = sp.current_user_playlists()
-      public_playlists = [
-          {
-              "number": data["items"].index(item) + 1,
-              "playlist_name": item["name"],
-              "playlist_id": item["id"],
-              "playlist_url": item["external_urls"]["spotify"],
-              "playlist_picture": item["images"][0]["url"],
-              "playlist_like_count": sp.playlist(item["id"])["followers"]["total"],
-          }
-          for item in data["items"]
-          if item["public"]
-      ]
-      playlists = {
-          "playlists": public_playlists,
-          "datetime_added": datetime.datetime.now()
-      }
-      try:
-        collection.insert_one({"_id": user_id, "playlists": playlists})
-      except Exception as e:
-        collection.update_one({"_id": user_id}, {"$set": {"playlists": playlists}})
-      playlists = collection.find_one({"_id": user_id})["playlists"]
-      logger.debug(data)
-      logger.info("Got public playlists for {}".format(sp.current_user()["display_name"]))
-    public_playlists = collection.find_one({"_id": user_id})["playlists"]
-    return public_playlists
-
-def get_user_recommended_playlist(access_token):
-    """
-    Get the user's "Recommended Tracks" playlist, or create one if it doesn't exist
+    return get_cached_section(ctx, store, "playlists", refresh_user_public_playlists)
+
+
+def refresh_user_public_playlists(ctx, store):
+    """
+    It downloads every public playlist of the user with its follower count and saves them. A count
+    that couldn't be fetched is taken from the saved section, and if it isn't there either it's
+    saved as None, unknown, so a made up count is never shown
+
+    Args:
+      ctx: The SpotifyContext of the user.
+      store: The UserStore the section is cached in.
+
+    Returns:
+      The playlists section.
+    """
+    sp = ctx.sp
+    data = [
+        item
+        for item in iterate_pages(sp, sp.current_user_playlists(limit=PLAYLISTS_PAGE_SIZE))
+        if item["public"]
+    ]
+    followers = get_playlists_followers(ctx, [item["id"] for item in data])
+    unknown = [item["id"] for item in data if item["id"] not in followers]
+    if unknown:
+        previous = store.get_field(ctx.user_id, "playlists")
+        previous = previous.get("playlists", []) if isinstance(previous, dict) else []
+        for playlist in previous:
+            if playlist["playlist_id"] in unknown and playlist["playlist_like_count"] is not None:
+                followers[playlist["playlist_id"]] = playlist["playlist_like_count"]
+        unknown = [playlist_id for playlist_id in unknown if playlist_id not in followers]
+        if unknown:
+            logger.warning(
+                f"The follower counts of {len(unknown)} playlists of {ctx.user_id} are unknown"
+            )
+    public_playlists = ranked(data, PLAYLIST_FIELDS)
+    for playlist in public_playlists:
+        playlist["playlist_like_count"] = followers.get(playlist["playlist_id"])
+    playlists = {
+        "playlists": public_playlists,
+        "datetime_added": datetime.datetime.now()
+    }
+    store.set(ctx.user_id, playlists=playlists)
+    logger.debug(data)
+    return playlists
+
+
+def iterate_pages(sp, page):
+    """
+    It yields every item of a Spotify paging object, following its `next` links to the last page
 
     Args:
-      access_token: The access token you got from the authorization step.
+      sp: The spotipy client used to fetch the following pages.
+      page: The first page.
 
     Returns:
-      A dictionary containing the playlist information
-    """
-    sp = spotipy.Spotify(auth=access_token)
-    user_id = get_user_info(access_token)["id"]
-    playlists = sp.user_playlists(user_id)["items"]
-    for playlist in playlists:
-        if playlist["name"] == "Recommended Tracks":
-            return playlist
-    new_playlist_id = sp.user_playlist_create(
-        user_id, "Recommended Tracks", public=False
-    )["id"]
-    sp.user_playlist_change_details(
-        user_id,
-        new_playlist_id,
-        description="Generated Playlist from https://spotify.radityaharya.me",
+      A generator of items.
+    """
+    while page:
+        yield from page["items"]
+        page = sp.next(page) if page["next"] else None
+
+
+def get_playlists_followers(ctx, playlist_ids):
+    """
+    It gets the follower count of every playlist, taking them from `playlist_followers` when it can
+    and asking Spotify for only the `followers.total` field of the rest, on the `fetch.followers`
+    pool. The lookups share one deadline of PLAYLIST_FOLLOWERS_TIMEOUT seconds, and the ones that
+    finish after it still fill `playlist_followers` for the next refresh
+
+    Args:
+      ctx: The SpotifyContext of the user.
+      playlist_ids: The ids of the playlists.
+
+    Returns:
+      A dictionary mapping a playlist id to its follower count. Playlists whose lookup failed or
+      didn't finish in time are left out.
+    """
+
+    def lookup(playlist_id):
+        count = ctx.sp.playlist(playlist_id, fields="followers.total")["followers"]["total"]
+        playlist_followers.set(playlist_id, count)
+        return count
+
+    followers = {}
+    missing = []
+    for playlist_id in playlist_ids:
+        count = playlist_followers.get(playlist_id)
+        if count is None:
+            missing.append(playlist_id)
+        else:
+            followers[playlist_id] = count
+    results, _ = fetch.followers.run(
+        {playlist_id: partial(lookup, playlist_id) for playlist_id in missing},
+        timeout=PLAYLIST_FOLLOWERS_TIMEOUT,
     )
-    return sp.user_playlist(user_id, new_playlist_id)
+    followers.update(results)
+    return followers
 
 
-def add_track_to_recommended_playlist(access_token, track_url):
+def get_user_recommended_playlist(ctx, store):
     """
-    > It takes a track url and adds it to the user's recommended playlist
+    Get the user's "Recommended Tracks" playlist, or create one if it doesn't exist. The playlist is
+    saved in the user's document once found, and checked again in the background once it's older
+    than its freshness policy allows, so steady state lookups don't list the user's playlists
 
     Args:
-      access_token: The access token you got from the authorization flow.
-      track_url: The url of the track you want to add to the playlist.
+      ctx: The SpotifyContext of the user.
+      store: The UserStore the playlist is saved in.
 
     Returns:
-      A dictionary with the following keys:
-        snapshot_id
-        tracks
-    """
-    sp = spotipy.Spotify(auth=access_token)
-    logger.info(f"Adding track to recommended playlist: {track_url}")
-    return sp.user_playlist_add_tracks(
-        get_user_info(access_token)["id"],
-        get_user_recommended_playlist(access_token)["id"],
-        [get_uri_from_track_url(track_url)],
+      A dictionary containing the playlist's id and external urls
+    """
+    return get_cached_section(
+        ctx,
+        store,
+        "recommended_playlist",
+        refresh_user_recommended_playlist,
     )
 
-def get_user_top_genres(access_token, collection, limit=100):
+
+def refresh_user_recommended_playlist(ctx, store):
+    """
+    It checks the saved recommended playlist is still followed by the user, which is what deleting a
+    playlist does on Spotify, and finds or creates it again if it isn't
+
+    Args:
+      ctx: The SpotifyContext of the user.
+      store: The UserStore the playlist is saved in.
+
+    Returns:
+      The playlist, as saved.
+    """
+    playlist = store.get_field(ctx.user_id, "recommended_playlist")
+    if isinstance(playlist, dict) and playlist.get("id"):
+        try:
+            if ctx.sp.playlist_is_following(playlist["id"], [ctx.user_id])[0]:
+                playlist = {**playlist, "datetime_added": datetime.datetime.now()}
+                store.set(ctx.user_id, recommended_playlist=playlist)
+                return playlist
+        except SpotifyException as e:
+            if e.http_status != 404:
+                raise
+        logger.info(f"{ctx.user_id} no longer has their recommended playlist")
+    return resolve_user_recommended_playlist(ctx, store)
+
+
+def resolve_user_recommended_playlist(ctx, store):
+    """
+    It looks for the user's recommended playlist through every page of their playlists, creates it
+    if it isn't there, and saves it
+
+    Args:
+      ctx: The SpotifyContext of the user.
+      store: The UserStore the playlist is saved in.
+
+    Returns:
+      The playlist, as saved.
+    """
+    sp = ctx.sp
+    user_id = ctx.user_id
+    playlist = next(
+        (
+            item
+            for item in iterate_pages(sp, sp.current_user_playlists(limit=PLAYLISTS_PAGE_SIZE))
+            if item["name"] == RECOMMENDED_PLAYLIST_NAME and item["owner"]["id"] == user_id
+        ),
+        None,
+    )
+    if playlist is None:
+        playlist = sp.user_playlist_create(
+            user_id,
+            RECOMMENDED_PLAYLIST_NAME,
+            public=False,
+            description="Generated Playlist from https://spotify.radityaharya.me",
+        )
+        logger.info(f"Created the recommended playlist of {user_id}")
+    playlist = {
+        "id": playlist["id"],
+        "external_urls": playlist["external_urls"],
+        "datetime_added": datetime.datetime.now(),
+    }
+    store.set(user_id, recommended_playlist=playlist)
+    return playlist
+
+
+def get_recommended_playlist_uris(ctx, store):
+    """
+    It lists the URIs of every track in the user's recommended playlist
+
+    Args:
+      ctx: The SpotifyContext of the user.
+      store: The UserStore the playlist is saved in.
+
+    Returns:
+      A set of track URIs.
+    """
+    sp = ctx.sp
+    playlist = get_user_recommended_playlist(ctx, store)
+    page = sp.playlist_items(
+        playlist["id"],
+        fields="items(track(uri)),next",
+        limit=PLAYLIST_ITEMS_PAGE_SIZE,
+        additional_types=("track",),
+    )
+    return {item["track"]["uri"] for item in iterate_pages(sp, page) if item.get("track")}
+
+
+def add_tracks_to_recommended_playlist(ctx, store, uris):
+    """
+    > It adds tracks to the user's recommended playlist, PLAYLIST_ITEMS_PAGE_SIZE at a time. If the
+    saved playlist is gone, it's found or created again and the tracks are added to that one
+
+    Args:
+      ctx: The SpotifyContext of the user.
+      store: The UserStore the playlist is saved in.
+      uris: The URIs of the tracks.
+
+    Returns:
+      The snapshot id of the playlist after the last batch.
+    """
+    sp = ctx.sp
+    playlist_id = get_user_recommended_playlist(ctx, store)["id"]
+    snapshot_id = None
+    for start in range(0, len(uris), PLAYLIST_ITEMS_PAGE_SIZE):
+        batch = uris[start : start + PLAYLIST_ITEMS_PAGE_SIZE]
+        try:
+            snapshot_id = sp.playlist_add_items(playlist_id, batch)["snapshot_id"]
+        except SpotifyException as e:
+            if e.http_status != 404:
+                raise
+            playlist_id = resolve_user_recommended_playlist(ctx, store)["id"]
+            snapshot_id = sp.playlist_add_items(playlist_id, batch)["snapshot_id"]
+    return snapshot_id
+
+
+def get_user_top_genres(ctx, store, catalog):
     """
     It gets the user's top genres
 
     Args:
-      access_token: The access token you got from the authorization step.
+      ctx: The SpotifyContext of the user.
+      store: The UserStore the section is cached in.
+      catalog: The Catalog the top artists are kept in, they're downloaded together.
 
     Returns:
       A list of dictionaries containing the genre name and genre id
     """
-    user_id = get_user_info(access_token)["id"]    
-    try:
-      top_genres = collection.find_one({"_id": user_id})["top_genres"]
-      if top_genres["datetime_added"] < datetime.datetime.now() - datetime.timedelta(days=4):
-        raise "Cache expired"
-    except Exception as e:
-      logger.error(e)
-      sp = spotipy.Spotify(auth=access_token)
-      short_term_data = sp.current_user_top_artists(limit=limit, time_range="short_term")["items"]
-      medium_term_data = sp.current_user_top_artists(limit=limit, time_range="medium_term")["items"]
-      long_term_data = sp.current_user_top_artists(limit=limit, time_range="long_term")["items"]
-      data = short_term_data + medium_term_data + long_term_data
-      genres = [item["genres"] for item in data]
-      genres = [item for sublist in genres for item in sublist]
-      genres = Counter(genres)
-      genres = sorted(genres.items(), key=lambda x: x[1], reverse=True)
-      genres = [{"name": item[0], "number_of_occcurences": item[1]} for item in genres]
-      top_genres = {"datetime_added": datetime.datetime.now(), "genres": genres}
-      try:
-        collection.insert_one({"_id": user_id, "top_genres": top_genres})
-      except Exception as e:
-        logger.error(e)
-        collection.update_one({"_id": user_id}, {"$set": {"top_genres": top_genres}})
-      top_genres = collection.find_one({"_id": user_id})["top_genres"]
-    return top_genres
-  
-
-def get_user_recently_played(access_token, collection, limit=50):
-    """
-    It gets the user's recently played tracks
-      
-      Args:
-        access_token: The access token you got from the authorization step.
-        limit: The number of tracks to return.
-
-      returns:
-        A list of dictionaries containing the track name, artist name, album name, album picture, and track url
-    """
-    user_id = get_user_info(access_token)["id"]
-    try:
-      recently_played = collection.find_one({"_id": user_id})["recently_played"]
-      if recently_played["datetime_added"] < datetime.datetime.now() - datetime.timedelta(days=4):
-        raise "Cache expired"
-    except Exception as e:
-      logger.error(e)
-      sp = spotipy.Spotify(auth=access_token)
-      data = sp.current_user_recently_played(limit=limit)["items"]
-      recently_played = [
-          {
-              "track_id" : item["track"]["id"],
-              "track_name": item["track"]["name"],
-              "artist_name": item["track"]["artists"][0]["name"],
-              "album_name": item["track"]["album"]["name"],
-              "album_picture": item["track"]["album"]["images"][0]["url"],
-              "track_url": item["track"]["external_urls"]["spotify"],
-              "datetime_played": item["played_at"],
-          }
-          for item in data
-      ]
-      try:
-        collection.insert_one({"_id": user_id, "recently_played": recently_played})
-      except Exception as e:
-        logger.error(e)
-        collection.update_one({"_id": user_id}, {"$set": {"recently_played": recently_played}})
-      recently_played = collection.find_one({"_id": user_id})["recently_played"]
-    return recently_played
+    return get_cached_section(
+        ctx,
+        store,
+        "top_genres",
+        lambda ctx, store, time_ranges=TIME_RANGES: get_user_top_artist_dataset(
+            ctx, store, catalog, time_ranges
+        )["top_genres"],
+        refresh_key="top_artist_dataset",
+    )
+
+
+def get_user_recently_played(ctx, store, history, limit=50, before=None):
+    """
+    It gets a page of the user's play history, newest first. The plays made since the last ingestion
+    are ingested first, in the background unless the user was never ingested
+
+    Args:
+      ctx: The SpotifyContext of the user.
+      store: The UserStore the ingestion's cursor is kept in.
+      history: The PlayHistory of every user.
+      limit: The number of plays to return.
+      before: Only return the plays played before this naive UTC datetime.
+
+    Returns:
+      A list of dictionaries containing the track name, artist name, album name, album picture,
+      track url and when it was played, as `datetime_played`.
+    """
+    get_cached_section(
+        ctx,
+        store,
+        "recently_played",
+        partial(ingest_user_recently_played, history=history),
+    )
+    plays = history.page(ctx.user_id, before=before, limit=limit)
+    for play in plays:
+        play["datetime_played"] = play.pop("played_at").strftime("%Y-%m-%dT%H:%M:%S.%fZ")
+    return plays
+
+
+def parse_played_at(played_at):
+    """
+    It parses a time in Spotify's format, e.g. "2016-12-13T20:44:04.589Z"
+
+    Args:
+      played_at: The time.
+
+    Returns:
+      A naive UTC datetime, as MongoDB stores them.
+    """
+    return (
+        datetime.datetime.fromisoformat(played_at.replace("Z", "+00:00"))
+        .astimezone(datetime.timezone.utc)
+        .replace(tzinfo=None)
+    )
+
+
+def ingest_user_recently_played(ctx, store, history):
+    """
+    It appends the plays the user made since the last ingestion to their history. Spotify is asked
+    for the plays after the cursor kept in the user's document, so every play is downloaded once and
+    an ingestion costs a call per 50 new plays
+
+    Args:
+      ctx: The SpotifyContext of the user.
+      store: The UserStore the cursor is kept in.
+      history: The PlayHistory of every user.
+
+    Returns:
+      The state of the ingestion: the cursor of the latest play ingested, as `after`, and when it
+      ran, as `datetime_added`.
+    """
+    user_id = ctx.user_id
+    return ingest_flight.do(
+        f"recently_played/{user_id}",
+        partial(_ingest_user_recently_played, ctx, store, history),
+    )
+
+
+def _ingest_user_recently_played(ctx, store, history):
+    sp = ctx.sp
+    user_id = ctx.user_id
+    state = store.get_field(user_id, "recently_played")
+    # the cursor in the user's document can be behind, its cached copy may be out of date and other
+    # workers ingest too, so carry on after whichever is latest of it and the history itself
+    cursors = [state.get("after")] if isinstance(state, dict) else []
+    last_played_at = history.last_played_at(user_id)
+    if last_played_at is not None:
+        cursors.append(to_cursor(last_played_at))
+    cursors = [cursor for cursor in cursors if cursor is not None]
+    after = max(cursors) if cursors else None
+    plays = {}
+    while True:
+        items = sp.current_user_recently_played(
+            limit=RECENTLY_PLAYED_PAGE_SIZE, after=after
+        )["items"]
+        for item in items:
+            played_at = parse_played_at(item["played_at"])
+            if after is not None and to_cursor(played_at) <= after:
+                continue
+            plays[played_at] = {"played_at": played_at, **transform(item, PLAY_FIELDS)}
+        # without a cursor Spotify only pages backwards, and only 50 plays back
+        if after is None or len(items) < RECENTLY_PLAYED_PAGE_SIZE or not plays:
+            break
+        after = to_cursor(max(plays))
+    if plays:
+        # another worker may have appended some of them while these were downloaded
+        for played_at in history.played_at_since(user_id, min(plays)):
+            plays.pop(played_at, None)
+    history.append(user_id, sorted(plays.values(), key=lambda play: play["played_at"]))
+    if plays:
+        after = to_cursor(max(plays))
+    logger.debug(f"Ingested {len(plays)} plays of {user_id}")
+    state = {"after": after, "datetime_added": datetime.datetime.now()}
+    store.set(user_id, recently_played=state)
+    return state
+
+
+# What each profile section falls back to when it fails or times out, so the page still renders
+PROFILE_SECTION_FALLBACKS = {
+    "recommended_playlist": lambda: {"external_urls": {"spotify": ""}},
+    "top_tracks": lambda: {time_range: [] for time_range in TIME_RANGES},
+    "top_artists": lambda: {time_range: [] for time_range in TIME_RANGES},
+    "top_genres": lambda: {"genres": []},
+    "public_playlists": lambda: {"playlists": []},
+}
+
+
+# The fields of the user's document that the profile sections are cached in
+PROFILE_SECTION_FIELDS = (
+    "top_tracks",
+    "top_artists",
+    "top_genres",
+    "playlists",
+    "recommended_playlist",
+)
+
+
+def get_user_profile_sections(ctx, store, catalog, timeout=None):
+    """
+    It fetches every section of the profile page at the same time, substituting an empty section for
+    any that fails or takes longer than the timeout. The cached sections are read with one projected
+    read up front, and the refreshed ones are written back together in one round trip. The top
+    tracks and artists are then hydrated from the catalog together
+
+    Args:
+      ctx: The SpotifyContext of the user.
+      store: The UserStore the sections are cached in.
+      catalog: The Catalog the top tracks and artists are kept in.
+      timeout: The number of seconds to wait for each section.
+
+    Returns:
+      A tuple of a dictionary with every section, keyed by its name, and the names of the sections
+      that had to be substituted.
+    """
+    store.get(ctx.user_id, *PROFILE_SECTION_FIELDS)
+    with store.batch() as batch:
+        sections, errors = fetch.sections.run(
+            {
+                "recommended_playlist": partial(get_user_recommended_playlist, ctx, batch),
+                "top_tracks": partial(get_user_top_tracks, ctx, batch, catalog),
+                "top_artists": partial(get_user_top_artists, ctx, batch, catalog),
+                "top_genres": partial(get_user_top_genres, ctx, batch, catalog),
+                "public_playlists": partial(get_user_public_playlists, ctx, batch),
+            },
+            timeout,
+        )
+    for name in errors:
+        sections[name] = PROFILE_SECTION_FALLBACKS[name]()
+    sections["top_tracks"], sections["top_artists"] = hydrate_sections(
+        catalog, sections["top_tracks"], sections["top_artists"]
+    )
+    return sections, list(errors)
@@ -0,0 +1,226 @@
+import datetime
+import logging
+import threading
+import traceback
+import uuid
+from collections import defaultdict
+
+from functions import ratelimit
+from functions.cache import TTLCache
+
+logger = logging.getLogger("spotify")
+
+QUEUED = "queued"
+ADDED = "added"
+DUPLICATE = "duplicate"
+FAILED = "failed"
+
+
+class Rejected(Exception):
+    """
+    It is raised by a `SubmissionQueue`'s `add` when Spotify refuses the tracks themselves, e.g. one
+    of them doesn't exist, rather than failing to take them for now
+    """
+
+
+class SubmissionQueue:
+    """
+    It takes the tracks friends suggest for a user's recommended playlist and answers right away,
+    then adds them to the playlist from a background thread, every `interval` seconds or as soon as
+    a user has `batch_size` of them waiting. Tracks already in the playlist, or already waiting, are
+    skipped, and the others are added with one call per `batch_size` tracks. A batch that's
+    rejected is split in halves until the tracks refused are found, so they don't fail the others,
+    and tracks that couldn't be added for another reason, e.g. the rate limit, wait for the next
+    flush, up to `max_attempts` times. The status of every submission is kept in the cache, so any
+    worker can tell how it went
+
+    Args:
+      add: A function taking a user id and a list of track URIs, that adds them to the user's
+        recommended playlist, and raises `Rejected` if Spotify refuses them.
+      existing: A function taking a user id and returning the set of track URIs already in their
+        recommended playlist.
+      statuses: An object with `get` and `set`, like a Flask-Caching `Cache`.
+      interval: The number of seconds between two flushes.
+      batch_size: The number of tracks added with one call, Spotify takes 100 at most.
+      status_ttl: The number of seconds the status of a submission is kept.
+      max_attempts: The number of flushes a track is tried in before it's failed.
+    """
+
+    def __init__(
+        self,
+        add,
+        existing,
+        statuses,
+        interval=5,
+        batch_size=100,
+        status_ttl=3600,
+        max_attempts=5,
+    ):
+        self.add = add
+        self.existing = existing
+        self.statuses = statuses
+        self.interval = interval
+        self.batch_size = batch_size
+        self.status_ttl = status_ttl
+        self.max_attempts = max_attempts
+        # what each user's playlist holds, so it's only listed once in a while
+        self._known = TTLCache(maxsize=1024, ttl=status_ttl)
+        self._pending = defaultdict(dict)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def _status_key(submission_id):
+        return f"submission/{submission_id}"
+
+    def _set_status(self, submission, status, error=None):
+        submission = {**submission, "status": status}
+        if error is not None:
+            submission["error"] = error
+        try:
+            self.statuses.set(
+                self._status_key(submission["id"]), submission, timeout=self.status_ttl
+            )
+        except Exception as e:
+            logger.error(f"submission queue couldn't save {submission['id']}: {e!r}")
+        return submission
+
+    def submit(self, user_id, uri):
+        """
+        It queues a track to be added to a user's recommended playlist
+
+        Args:
+          user_id: The id of the user whose playlist gets the track.
+          uri: The URI of the track.
+
+        Returns:
+          The submission: a dictionary with its id, the user id, the URI, when it was submitted and
+          its status, "queued", or "duplicate" if the track is already waiting.
+        """
+        submission = {
+            "id": uuid.uuid4().hex,
+            "user_id": user_id,
+            "uri": uri,
+            "submitted_at": datetime.datetime.utcnow().isoformat() + "Z",
+        }
+        with self._lock:
+            pending = self._pending[user_id]
+            duplicate = uri in pending
+            if not duplicate:
+                pending[uri] = submission
+            full = len(pending) >= self.batch_size
+        self.start()
+        if full:
+            self._wake.set()
+        return self._set_status(submission, DUPLICATE if duplicate else QUEUED)
+
+    def status(self, submission_id):
+        """
+        It tells how a submission went
+
+        Args:
+          submission_id: The id of the submission.
+
+        Returns:
+          The submission with its status, or None if it's unknown or expired.
+        """
+        return self.statuses.get(self._status_key(submission_id))
+
+    def flush(self):
+        """
+        It adds every waiting track to its playlist
+        """
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(dict)
+        with ratelimit.priority(ratelimit.BACKGROUND):
+            for user_id, submissions in pending.items():
+                self._flush_user(user_id, submissions)
+
+    def _flush_user(self, user_id, submissions):
+        # the submissions that haven't been settled yet, in case adding them fails
+        unsettled = dict(submissions)
+        try:
+            known = self._known.get(user_id)
+            if known is None:
+                known = set(self.existing(user_id))
+                self._known.set(user_id, known)
+            for uri in [uri for uri in submissions if uri in known]:
+                self._set_status(unsettled.pop(uri), DUPLICATE)
+            new = list(unsettled)
+            for start in range(0, len(new), self.batch_size):
+                self._add(user_id, new[start : start + self.batch_size], unsettled, known)
+            logger.debug(f"Added {len(new)} submitted tracks to the playlist of {user_id}")
+        except Exception as e:
+            logger.warning(
+                f"Adding the submitted tracks of {user_id} failed\n{traceback.format_exc()}"
+            )
+            self._retry(user_id, unsettled, e)
+
+    def _add(self, user_id, uris, unsettled, known):
+        try:
+            self.add(user_id, uris)
+        except Rejected as e:
+            if len(uris) == 1:
+                logger.warning(f"Spotify refused {uris[0]} for the playlist of {user_id}: {e!r}")
+                self._set_status(unsettled.pop(uris[0]), FAILED, error=repr(e))
+                return
+            # the tracks refused are isolated, the others are still added
+            middle = len(uris) // 2
+            self._add(user_id, uris[:middle], unsettled, known)
+            self._add(user_id, uris[middle:], unsettled, known)
+            return
+        known.update(uris)
+        for uri in uris:
+            self._set_status(unsettled.pop(uri), ADDED)
+
+    def _retry(self, user_id, unsettled, error):
+        # the tracks that couldn't be added are queued again for the next flush, unless they were
+        # submitted again in the meantime
+        retried, failed = {}, []
+        for uri, submission in unsettled.items():
+            submission = {**submission, "attempts": submission.get("attempts", 0) + 1}
+            if submission["attempts"] >= self.max_attempts:
+                failed.append(submission)
+            else:
+                retried[uri] = submission
+        if retried:
+            with self._lock:
+                pending = self._pending[user_id]
+                for uri, submission in retried.items():
+                    pending.setdefault(uri, submission)
+        for submission in failed:
+            self._set_status(submission, FAILED, error=repr(error))
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.error(f"Flushing submissions failed\n{traceback.format_exc()}")
+
+    def start(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(
+                        target=self._run, name="submissions", daemon=True
+                    )
+                    self._thread.start()
+
+    def stop(self):
+        """
+        It stops the background thread once it has added the tracks still waiting
+        """
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        with self._lock:
+            left = sum(len(pending) for pending in self._pending.values())
+        if left:
+            logger.warning(f"{left} submitted tracks couldn't be added before stopping")
@@ -0,0 +1,184 @@
+import itertools
+import logging
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from spotipy.oauth2 import SpotifyOauthError
+
+from functions import util
+
+logger = logging.getLogger("spotify")
+
+
+def refresh_expiring_tokens(
+    sp_oauth,
+    store,
+    collection,
+    window=600,
+    max_workers=4,
+    active_for=7 * 24 * 60 * 60,
+    backoff=60 * 60,
+    batch_size=100,
+):
+    """
+    It refreshes every token that expires within `window` seconds, a few at a time, and saves them
+    with one bulk write per `batch_size` documents read from the cursor. Only the tokens of users
+    seen within `active_for` seconds are kept fresh, the others are refreshed when they're used.
+    Documents stored before `token_expires_at` existed are refreshed too, which gives them the
+    field. A token Spotify refuses to refresh, e.g. revoked by its user, isn't tried again for
+    `backoff` seconds, twice as long after every refusal
+
+    Args:
+      sp_oauth: The SpotifyOAuth object of the app.
+      store: The UserStore holding the users' documents.
+      collection: The collection to scan.
+      window: The number of seconds ahead of expiry a token is refreshed.
+      max_workers: The number of refreshes running at the same time.
+      active_for: The number of seconds since a user was last seen their token is kept fresh for.
+      backoff: The number of seconds a refused token is left alone after its first refusal.
+      batch_size: The number of documents refreshed and saved together.
+
+    Returns:
+      The number of tokens refreshed.
+    """
+    now = int(time.time())
+    cursor = collection.find(
+        {
+            "$or": [
+                {"token_expires_at": {"$lt": now + window}},
+                {"token_expires_at": {"$exists": False}},
+            ],
+            "token": {"$exists": True},
+            "last_seen": {"$gt": now - active_for},
+            "token_retry_at": {"$not": {"$gt": now}},
+        },
+        ["token", "token_refresh_failures"],
+    ).batch_size(batch_size)
+
+    def refresh(document):
+        token = util.decrypt(document["token"])
+        return util.refresh_flight.do(
+            f"token/{document['_id']}",
+            lambda: sp_oauth.refresh_access_token(token["refresh_token"]),
+        )
+
+    scanned = refreshed = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            documents = list(itertools.islice(cursor, batch_size))
+            if not documents:
+                break
+            scanned += len(documents)
+            futures = {
+                document["_id"]: (document, executor.submit(refresh, document))
+                for document in documents
+            }
+            fields = {}
+            for user_id, (document, future) in futures.items():
+                failures = document.get("token_refresh_failures", 0)
+                try:
+                    fields[user_id] = util.token_fields(future.result())
+                    refreshed += 1
+                    if failures:
+                        fields[user_id].update(token_refresh_failures=0, token_retry_at=0)
+                except SpotifyOauthError as e:
+                    if e.error != "invalid_grant":
+                        logger.error(f"Couldn't refresh the token of {user_id}: {e!r}")
+                        continue
+                    retry_in = min(backoff * 2**failures, active_for)
+                    logger.warning(
+                        f"Spotify refused the token of {user_id}, retrying in {retry_in}s"
+                    )
+                    fields[user_id] = {
+                        "token_refresh_failures": failures + 1,
+                        "token_retry_at": now + retry_in,
+                    }
+                except Exception:
+                    logger.error(
+                        f"Couldn't refresh the token of {user_id}\n{traceback.format_exc()}"
+                    )
+            store.set_many(fields)
+    if scanned:
+        logger.info(f"Refreshed {refreshed} of {scanned} expiring tokens")
+    return refreshed
+
+
+class TokenRefreshScheduler:
+    """
+    It refreshes expiring tokens in the background every `interval` seconds, so requests find a
+    valid token instead of refreshing it themselves. With a remote cache only one worker scans per
+    interval
+
+    Args:
+      sp_oauth: The SpotifyOAuth object of the app.
+      store: The UserStore holding the users' documents.
+      collection: The collection to scan.
+      interval: The number of seconds between two scans.
+      window: The number of seconds ahead of expiry a token is refreshed.
+      max_workers: The number of refreshes running at the same time.
+      active_for: The number of seconds since a user was last seen their token is kept fresh for.
+      remote: An object with `add`, like a Flask-Caching `Cache`, or None.
+    """
+
+    def __init__(
+        self,
+        sp_oauth,
+        store,
+        collection,
+        interval=300,
+        window=600,
+        max_workers=4,
+        active_for=7 * 24 * 60 * 60,
+        remote=None,
+    ):
+        self.sp_oauth = sp_oauth
+        self.store = store
+        self.collection = collection
+        self.interval = interval
+        self.window = window
+        self.max_workers = max_workers
+        self.active_for = active_for
+        self.remote = remote
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _claim(self):
+        if self.remote is None:
+            return True
+        try:
+            return bool(self.remote.add("token_refresh_scan", 1, self.interval))
+        except Exception as e:
+            logger.error(f"token refresh scheduler couldn't claim the scan: {e!r}")
+            return True
+
+    def run_once(self):
+        if not self._claim():
+            return 0
+        return refresh_expiring_tokens(
+            self.sp_oauth,
+            self.store,
+            self.collection,
+            self.window,
+            self.max_workers,
+            self.active_for,
+        )
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self.run_once()
+            except Exception:
+                logger.error(f"Token refresh scan failed\n{traceback.format_exc()}")
+            self._stopped.wait(self.interval)
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name="token-refresh", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
@@ -0,0 +1,94 @@
+def field(*path, default=None):
+    """
+    It describes a field copied from an object returned by Spotify
+
+    Args:
+      path: The keys and indexes leading to the value, e.g. "album", "name".
+      default: The value used when the path doesn't lead anywhere.
+
+    Returns:
+      A function taking the object and returning the value.
+    """
+
+    def get(item):
+        for key in path:
+            try:
+                item = item[key]
+            except (KeyError, IndexError, TypeError):
+                return default
+            if item is None:
+                return default
+        return item
+
+    return get
+
+
+def image(*path, width=640, default=None):
+    """
+    It describes the URL of an image picked from a list of images returned by Spotify
+
+    Args:
+      path: The keys leading to the list of images, e.g. "album", "images".
+      width: The width wanted, in pixels.
+      default: The value used when there are no images.
+
+    Returns:
+      A function taking the object and returning the URL.
+    """
+    images = field(*path, default=[])
+
+    def get(item):
+        url = get_image(images(item), width)
+        return default if url is None else url
+
+    return get
+
+
+def get_image(images, width=640):
+    """
+    It picks the image whose width is the nearest to the one wanted. Images without a width, like
+    those of some playlists, are only picked when no image has one
+
+    Args:
+      images: A list of dictionaries, each with the url and width of an image.
+      width: The width wanted, in pixels.
+
+    Returns:
+      The url of the image, or None if there are no images.
+    """
+    if not images:
+        return None
+    sized = [image for image in images if image.get("width")]
+    if not sized:
+        return images[0]["url"]
+    return min(sized, key=lambda image: abs(image["width"] - width))["url"]
+
+
+def transform(item, fields):
+    """
+    It builds a dictionary from an object returned by Spotify, following a field spec
+
+    Args:
+      item: The object, e.g. a track.
+      fields: A dictionary mapping the names of the fields built to functions taking the object, e.g.
+        made by `field` and `image`.
+
+    Returns:
+      A dictionary with every field of the spec.
+    """
+    return {name: get(item) for name, get in fields.items()}
+
+
+def ranked(items, fields, start=1):
+    """
+    It builds a dictionary for every object of a list following a field spec, numbered by its rank
+
+    Args:
+      items: The objects, best ranked first.
+      fields: The field spec, see `transform`.
+      start: The number of the first object.
+
+    Returns:
+      A list of dictionaries, each with its rank as `number` and every field of the spec.
+    """
+    return [{"number": number, **transform(item, fields)} for number, item in enumerate(items, start)]
@@ -0,0 +1,166 @@
+import logging
+import threading
+
+from pymongo import UpdateOne
+
+logger = logging.getLogger("spotify")
+
+
+class UserStore:
+    """
+    It is the one place that reads and writes the per-user documents of `spotify_users`. Reads only
+    fetch the fields they ask for, and writes are atomic upserts, so callers never need to know
+    whether the user's document exists yet
+
+    Args:
+      collection: The `spotify_users` collection, usually wrapped in a UserDocumentCache.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def get(self, user_id, *fields):
+        """
+        It reads some fields of a user's document
+
+        Args:
+          user_id: the user's id
+          *fields: The fields to read, the whole document when none are given.
+
+        Returns:
+          A dictionary with the fields that exist, or None if the user has no document.
+        """
+        return self.collection.find_one({"_id": user_id}, list(fields) or None)
+
+    def get_field(self, user_id, field, default=None):
+        """
+        It reads a single field of a user's document
+
+        Args:
+          user_id: the user's id
+          field: The field to read.
+          default: What to return when the user or the field doesn't exist.
+
+        Returns:
+          The value of the field.
+        """
+        document = self.get(user_id, field)
+        if document is None:
+            return default
+        return document.get(field, default)
+
+    def exists(self, user_id):
+        return self.get(user_id, "_id") is not None
+
+    def set(self, user_id, /, **fields):
+        """
+        It writes some fields of a user's document in one round trip, creating the document if needed
+
+        Args:
+          user_id: the user's id
+          **fields: The fields to write.
+        """
+        self.collection.update_one({"_id": user_id}, {"$set": fields}, upsert=True)
+
+    def create(self, user_id, /, updates=None, **fields):
+        """
+        It creates a user's document with the given fields, leaving an existing document untouched
+        but for `updates`
+
+        Args:
+          user_id: the user's id
+          updates: The fields written whether the document exists or not.
+          **fields: The fields of the new document.
+        """
+        update = {"$setOnInsert": fields}
+        if updates:
+            update["$set"] = updates
+        self.collection.update_one({"_id": user_id}, update, upsert=True)
+
+    def set_many(self, fields_by_user):
+        """
+        It writes the fields of several users with a single `bulk_write`
+
+        Args:
+          fields_by_user: A dictionary mapping a user id to the fields to write.
+        """
+        if not fields_by_user:
+            return
+        self.collection.bulk_write(
+            [
+                UpdateOne({"_id": user_id}, {"$set": fields}, upsert=True)
+                for user_id, fields in fields_by_user.items()
+            ],
+            ordered=False,
+        )
+        write_through = getattr(self.collection, "write_through", None)
+        if write_through is not None:
+            for user_id, fields in fields_by_user.items():
+                write_through({"_id": user_id}, {"$set": fields})
+
+    def batch(self):
+        """
+        It starts a batch of writes that is flushed with one `bulk_write` when the batch ends
+
+        Returns:
+          A UserStoreBatch to use as a context manager.
+        """
+        return UserStoreBatch(self)
+
+
+class UserStoreBatch:
+    """
+    It has the same interface as UserStore but holds on to every `set` until the batch ends, then
+    persists all of them in one round trip. Reads see the batch's own pending writes. Writes made
+    after the batch was flushed, e.g. by a section that outlived its timeout, go straight through
+
+    Args:
+      store: The UserStore the batch writes to.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._pending = {}
+        self._flushed = False
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+    def get(self, user_id, *fields):
+        document = self.store.get(user_id, *fields)
+        with self._lock:
+            pending = self._pending.get(user_id)
+        if pending:
+            pending = {k: v for k, v in pending.items() if not fields or k in fields}
+            document = {**(document or {"_id": user_id}), **pending}
+        return document
+
+    def get_field(self, user_id, field, default=None):
+        document = self.get(user_id, field)
+        if document is None:
+            return default
+        return document.get(field, default)
+
+    def exists(self, user_id):
+        return self.get(user_id, "_id") is not None
+
+    def set(self, user_id, /, **fields):
+        with self._lock:
+            if not self._flushed:
+                self._pending.setdefault(user_id, {}).update(fields)
+                return
+        self.store.set(user_id, **fields)
+
+    def set_many(self, fields_by_user):
+        for user_id, fields in fields_by_user.items():
+            self.set(user_id, **fields)
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._flushed = True
+        self.store.set_many(pending)
@@ -1,57 +1,31 @@
-import json
-import os
-from cryptography.fernet import Fernet
+from functions.crypto import decrypt, encrypt
 from functions import spotify
+from functions.singleflight import SingleFlight
 import logging
 from dotenv import load_dotenv
 load_dotenv()
 logger = logging.getLogger("spotify")
 logger.setLevel(logging.DEBUG)
 
+# Concurrent refreshes of the same user's token, from requests or from the scheduler, share one call
+refresh_flight = SingleFlight()
 
-def encrypt(data):
-    if os.getenv("ENCRYPTION_KEY"):
-        key = os.getenv("ENCRYPTION_KEY")
-        key = bytes(key, "utf-8")
-    else:
-        key = Fernet.generate_key()
-        with open(".env", "a") as f:
-            f.write(f'\nENCRYPTION_KEY= "{key.decode()}"')
-    fernet = Fernet(key)
-    if isinstance(data, dict):
-        data = json.dumps(data)
-    logger.debug(f"Encrypting {data}")
-    return fernet.encrypt(data.encode())
 
-
-def decrypt(data):
-    key = os.getenv("ENCRYPTION_KEY")
-    key = bytes(key, "utf-8")
-
-    fernet = Fernet(key)
-    decrypted_data = fernet.decrypt(data).decode()
-
-    if decrypted_data.startswith("{"):
-        decrypted_data = json.loads(decrypted_data)
-    logger.debug(f"Decrypted {data} to {decrypted_data}")
-    logger.info(f"decypt function called")
-    return decrypted_data
-
-
-def generate_cookie(session, token):
+def generate_cookie(session, token, user_info=None):
     """
     It takes a token, gets the user's info, util.encrypts it, and stores it in a cookie
 
     Args:
       token: The token object returned from the Spotify API
+      user_info: The user's info, if it was already fetched for this token
 
     Returns:
       The data is being returned.
     """
-    user_info = spotify.get_user_info(token["access_token"])
+    if user_info is None:
+        user_info = spotify.get_user_info(token["access_token"])
     logger.info(f"User {user_info['id']} cookie generated")
     data = {"user_info": user_info, "access_token": token}
-    logger.debug(f"posted cookie to {data}")
     session["auth"] = encrypt(data)
     return data
 
@@ -67,24 +41,68 @@ def get_cookie(session):
     return data
 
 
-def check_and_refresh_token(sp_oauth, collection, access_token, session):
+def token_fields(token):
+    """
+    It returns the fields a token is stored as in the user's document: the encrypted token, and its
+    expiry in clear so expiring tokens can be found without decrypting every document
+
+    Args:
+      token: The token dictionary returned by SpotifyOAuth.
+
+    Returns:
+      A dictionary of fields.
+    """
+    return {"token": encrypt(token), "token_expires_at": token.get("expires_at")}
+
+
+def refresh_token(sp_oauth, store, user_id, token):
     """
-    If the token is expired, refresh it and update the database
+    It refreshes a user's token and saves it. Only one refresh per user runs at a time, and callers
+    arriving while it runs get its result
 
     Args:
+      sp_oauth: The SpotifyOAuth object of the app.
+      store: The UserStore holding the user's document.
+      user_id: the user's id
+      token: The user's current token.
+
+    Returns:
+      The refreshed token.
+    """
+
+    def refresh():
+        # the token might have been refreshed by someone else since the caller read it
+        stored = store.get_field(user_id, "token")
+        current = decrypt(stored) if stored else token
+        if not sp_oauth.is_token_expired(current) and current != token:
+            return current
+        refreshed = sp_oauth.refresh_access_token(current["refresh_token"])
+        store.set(user_id, **token_fields(refreshed))
+        logger.info(f"Token refreshed for user {user_id}")
+        return refreshed
+
+    return refresh_flight.do(f"token/{user_id}", refresh)
+
+
+def check_and_refresh_token(sp_oauth, store, user_id, access_token, session):
+    """
+    If the token is expired, refresh it and update the database. The scheduler in functions/tokens.py
+    normally refreshes tokens before they expire, so this is only the fallback
+
+    Args:
+      user_id: The id of the token's owner.
       access_token: The access token of the user.
 
     Returns:
       The refreshed token.
     """
     if sp_oauth.is_token_expired(access_token):
-        access_token = sp_oauth.refresh_access_token(access_token["refresh_token"])
-        user_id = spotify.get_user_info(access_token["access_token"])["id"]
-        collection.update_one(
-            {"_id": user_id}, {"$set": {"token": encrypt(access_token)}}
-        )
-        generate_cookie(session, access_token)
-        logger.info(f"Token refreshed for user {user_id}")
+        access_token = refresh_token(sp_oauth, store, user_id, access_token)
+        # only the owner's own cookie holds their token, visitors of their profile keep theirs
+        if "auth" in session:
+            cookie = get_cookie(session)
+            if cookie["user_info"]["id"] == user_id:
+                generate_cookie(session, access_token, cookie["user_info"])
         return access_token
-    logger.info(f"Token is still valid for user {access_token}")
+    logger.debug(f"Token is still valid for user {user_id}")
     return access_token
@@ -0,0 +1,51 @@
+"""
+The gunicorn settings of the app, every one of them can be changed with an environment variable
+
+Usage:
+  gunicorn -c gunicorn.conf.py wsgi:app
+"""
+import multiprocessing
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+bind = os.getenv("BIND", f"{os.getenv('HOST') or '0.0.0.0'}:{os.getenv('PORT') or 8000}")
+
+# Requests mostly wait on Spotify, MongoDB and Redis, so every worker runs a pool of threads. The
+# now playing streams each hold a thread for as long as they're open, so a worker only streams to
+# NOW_PLAYING_MAX_STREAMS viewers at once, half its threads by default, and the others poll
+worker_class = "gthread"
+workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv("GUNICORN_THREADS", 16))
+timeout = int(os.getenv("GUNICORN_TIMEOUT", 60))
+graceful_timeout = int(os.getenv("GUNICORN_GRACEFUL_TIMEOUT", 30))
+keepalive = int(os.getenv("GUNICORN_KEEPALIVE", 5))
+# Recycling workers now and then bounds how much their in-process caches can grow
+max_requests = int(os.getenv("GUNICORN_MAX_REQUESTS", 10000))
+max_requests_jitter = int(os.getenv("GUNICORN_MAX_REQUESTS_JITTER", 1000))
+
+# The app is imported by every worker, after the fork, so each one opens its own connections to
+# MongoDB, Redis and Spotify
+preload_app = False
+
+# ProxyFix in routes.py trusts the proxy in front of the app, gunicorn doesn't need to
+forwarded_allow_ips = "*"
+accesslog = os.getenv("GUNICORN_ACCESS_LOG")
+errorlog = "-"
+loglevel = os.getenv("GUNICORN_LOG_LEVEL", "info")
+
+
+def post_worker_init(worker):
+    from wsgi import start_worker
+
+    start_worker()
+
+
+def worker_exit(server, worker):
+    # recycled and restarted workers add the submitted tracks they still hold first, within
+    # graceful_timeout
+    from wsgi import stop_worker
+
+    stop_worker()
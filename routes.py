@@ -1,46 +1,81 @@
-import datetime
+import atexit
+import json
 import os
+import time
 import logging
+import threading
+from functools import partial
 
 from flask_caching import Cache
+
 from flask import jsonify
-from flask import redirect, render_template, request, url_for, session, Flask
+from flask import redirect, render_template, request, url_for, session, g, Flask
+from flask import Response, has_request_context
+from werkzeug.middleware.proxy_fix import ProxyFix
 from werkzeug.serving import WSGIRequestHandler
 from rich.logging import RichHandler
 import pymongo
-import spotipy
 from dotenv import load_dotenv
-
+from spotipy.cache_handler import MemoryCacheHandler
+from spotipy.exceptions import SpotifyException
+
+from functions import client as spotify_client
+from functions import crypto
+from functions import fragments
+from functions import jobs
+from functions import metrics
+from functions import ratelimit
+from functions import serving
+from functions import tokens
 from functions import spotify
 from functions import util
+from functions.cache import TTLCache, UserDocumentCache
+from functions.catalog import Catalog
+from functions.history import PlayHistory, create_history_collection
+from functions.nowplaying import NowPlayingHub
+from functions.singleflight import SingleFlight
+from functions.submissions import Rejected, SubmissionQueue
+from functions.transform import get_image
+from functions.users import UserStore
 
 load_dotenv()
 client = pymongo.MongoClient(os.getenv("MONGO_URI"))
 db = client.spotify
-collection = db.spotify_users
 
 app = Flask("spotify")
+# The app runs behind a proxy, which tells it the client's address, scheme and host
+app.wsgi_app = ProxyFix(
+    app.wsgi_app,
+    x_for=int(os.getenv("PROXY_X_FOR", 1)),
+    x_proto=int(os.getenv("PROXY_X_PROTO", 1)),
+    x_host=int(os.getenv("PROXY_X_HOST", 0)),
+)
 
 SCOPE = "user-read-private user-read-playback-state user-modify-playback-state user-library-read user-top-read user-library-modify playlist-read-private playlist-modify-private playlist-read-collaborative playlist-modify-public"
-sp_oauth = spotipy.oauth2.SpotifyOAuth(
+sp_oauth = spotify_client.SpotifyOAuth(
     scope=SCOPE,
     client_id=os.getenv("SPOTIFY_CLIENT_ID"),
     client_secret=os.getenv("SPOTIFY_CLIENT_SECRET"),
     redirect_uri=os.getenv("SPOTIFY_REDIRECT_URI"),
-    cache_handler=None,
+    # tokens are kept per user in Mongo, the default handler would write every one to a .cache file
+    cache_handler=MemoryCacheHandler(),
 )
+if os.getenv("SPOTIFY_ACCOUNTS_URL"):
+    sp_oauth.OAUTH_AUTHORIZE_URL = f"{os.getenv('SPOTIFY_ACCOUNTS_URL')}/authorize"
+    sp_oauth.OAUTH_TOKEN_URL = f"{os.getenv('SPOTIFY_ACCOUNTS_URL')}/api/token"
 
-# Setting up the logger to log to a file and to the console.
+# Setting up the logger to log to the console, and to LOG_FILE unless it's set empty.
+LOG_FILE = os.getenv("LOG_FILE", ".log")
 logging.basicConfig(
     level=logging.INFO,
     format="%(asctime)s [%(levelname)s] [%(lineno)s - %(funcName)s ] %(message)s",
-    handlers=[logging.FileHandler(".log"), RichHandler()],
+    handlers=[logging.FileHandler(LOG_FILE), RichHandler()] if LOG_FILE else [RichHandler()],
 )
 
 logger = logging.getLogger("spotify")
 config = {
     "DEBUG": True,
-    "CACHE_TYPE": "redis",
+    "CACHE_TYPE": os.getenv("CACHE_TYPE", "redis"),
     "CACHE_DEFAULT_TIMEOUT": 60,
     "CACHE_REDIS_HOST": os.getenv("REDIS_HOST"),
     "CACHE_REDIS_PORT": os.getenv("REDIS_PORT"),
@@ -54,6 +89,201 @@ config = {
 
 app.config.from_mapping(config)
 cache = Cache(app)
+# Every route reads the same user document many times, so reads go through an in-process LRU and
+# Redis before reaching Mongo
+collection = UserDocumentCache(
+    metrics.InstrumentedCollection(db.spotify_users),
+    remote=cache,
+    maxsize=int(os.getenv("USER_CACHE_SIZE", 1024)),
+    ttl=int(os.getenv("USER_CACHE_TTL", 10)),
+    remote_ttl=int(os.getenv("USER_CACHE_REMOTE_TTL", 300)),
+)
+users = UserStore(collection)
+jobs.refresh_queue.remote = cache
+collection.create_index("token_expires_at")
+# Every play of every user, kept beyond the 50 Spotify remembers
+history = PlayHistory(metrics.InstrumentedCollection(create_history_collection(db)))
+# The tracks and artists shown on profiles, shared by every user, whose documents only keep the ids
+catalog = Catalog(
+    metrics.InstrumentedCollection(db.spotify_catalog),
+    maxsize=int(os.getenv("CATALOG_CACHE_SIZE", 10000)),
+    ttl=int(os.getenv("CATALOG_CACHE_TTL", 3600)),
+)
+token_refresh_scheduler = tokens.TokenRefreshScheduler(
+    sp_oauth,
+    users,
+    collection,
+    interval=int(os.getenv("TOKEN_REFRESH_INTERVAL", 300)),
+    window=int(os.getenv("TOKEN_REFRESH_WINDOW", 600)),
+    max_workers=int(os.getenv("TOKEN_REFRESH_WORKERS", 4)),
+    active_for=int(os.getenv("TOKEN_REFRESH_ACTIVE_FOR", 7 * 24 * 60 * 60)),
+    remote=cache,
+)
+# When a user was last seen, which keeps their token refreshed, is saved at most once per
+# LAST_SEEN_RESOLUTION seconds by each worker
+LAST_SEEN_RESOLUTION = int(os.getenv("LAST_SEEN_RESOLUTION", 60 * 60))
+last_seen = TTLCache(maxsize=int(os.getenv("USER_CACHE_SIZE", 1024)), ttl=LAST_SEEN_RESOLUTION)
+# How long a fetched currently playing track is served before asking Spotify again
+CURRENTLY_PLAYING_TTL = int(os.getenv("CURRENTLY_PLAYING_TTL", 5))
+# The raw Redis client behind the cache, for the few things that need more than get/set
+redis_client = getattr(cache.cache, "_write_client", None)
+# One poller per watched profile, across all workers, pushes the currently playing track to viewers
+now_playing = NowPlayingHub(
+    lambda user_id: poll_currently_playing(user_id),
+    redis=redis_client,
+    interval=CURRENTLY_PLAYING_TTL,
+)
+NOW_PLAYING_HEARTBEAT = int(os.getenv("NOW_PLAYING_HEARTBEAT", 15))
+NOW_PLAYING_STREAM_MAX_AGE = int(os.getenv("NOW_PLAYING_STREAM_MAX_AGE", 300))
+NOW_PLAYING_RETRY_MS = int(os.getenv("NOW_PLAYING_RETRY_MS", 3000))
+# Every open stream holds one of the worker's threads, so only so many are served at once, and the
+# viewers past them poll /currently_playing instead
+NOW_PLAYING_MAX_STREAMS = int(
+    os.getenv("NOW_PLAYING_MAX_STREAMS", max(1, int(os.getenv("GUNICORN_THREADS", 16)) // 2))
+)
+now_playing_streams = threading.BoundedSemaphore(NOW_PLAYING_MAX_STREAMS)
+# Suggested tracks are added to the recommended playlists in batches, from a background thread
+submissions = SubmissionQueue(
+    lambda user_id, uris: add_submitted_tracks(user_id, uris),
+    lambda user_id: recommended_playlist_uris(user_id),
+    statuses=cache,
+    interval=int(os.getenv("SUBMISSION_FLUSH_INTERVAL", 5)),
+    batch_size=int(os.getenv("SUBMISSION_BATCH_SIZE", 100)),
+)
+# Every worker takes its Spotify calls from the same rate limit bucket
+spotify_client.limiter.redis = redis_client
+# How long the profile page, but its currently playing song, is served before being fetched again
+PROFILE_CACHE_TTL = int(os.getenv("PROFILE_CACHE_TTL", 60))
+# The rendered components of profile pages, kept until the section they show changes
+fragment_cache = fragments.FragmentCache(
+    cache, timeout=int(os.getenv("FRAGMENT_CACHE_TTL", 3600))
+)
+# Concurrent renders of the same profile, in this worker or any other, share one render
+render_flight = SingleFlight(
+    redis=redis_client,
+    lock_timeout=int(os.getenv("RENDER_LOCK_TIMEOUT", 30)),
+    wait_timeout=int(os.getenv("RENDER_WAIT_TIMEOUT", 10)),
+)
+# Production compiles the templates once and serves static files hashed and pre-compressed, set
+# SERVE_MODE=development to pick up changes to templates and static files without restarting
+SERVE_MODE = os.getenv("SERVE_MODE", "production")
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", 1024))
+static_assets = serving.StaticAssets(
+    app,
+    enabled=SERVE_MODE == "production",
+    max_age=int(os.getenv("STATIC_MAX_AGE", 31536000)),
+    min_size=COMPRESS_MIN_SIZE,
+)
+if SERVE_MODE == "production":
+    serving.precompile_templates(app, os.getenv("TEMPLATE_CACHE_DIR"))
+
+
+@app.before_request
+def start_request_metrics():
+    g.request_metrics, g.request_metrics_token = metrics.start_request(
+        request.endpoint
+    )
+
+
+@app.after_request
+def end_request_metrics(response):
+    """
+    It adds the Server-Timing header to the response and logs a summary of the request: its status,
+    its duration, and how many calls to Spotify and MongoDB it made and how long they took
+
+    Args:
+      response: The response of the request.
+
+    Returns:
+      The response, with its Server-Timing header.
+    """
+    token = g.pop("request_metrics_token", None)
+    if token is not None:
+        response.headers["Server-Timing"] = g.request_metrics.server_timing()
+        metrics.end_request(
+            g.request_metrics,
+            token,
+            response.status_code,
+            request.method,
+            request.path,
+            request.remote_addr,
+        )
+    return response
+
+
+@app.after_request
+def compress_response(response):
+    if SERVE_MODE != "production":
+        return response
+    return serving.compress_response(response, COMPRESS_MIN_SIZE)
+
+
+@app.teardown_request
+def discard_request_metrics(exception):
+    # after_request is skipped when a response couldn't be built at all
+    token = g.pop("request_metrics_token", None)
+    if token is not None:
+        metrics.end_request(
+            g.request_metrics, token, 500, request.method, request.path, request.remote_addr
+        )
+
+
+@app.route("/metrics")
+def prometheus_metrics():
+    """
+    It exposes the request and call counters of this worker in the Prometheus text format. When
+    METRICS_TOKEN is set, the scraper has to send it as a bearer token
+
+    Returns:
+      The metrics.
+    """
+    metrics_token = os.getenv("METRICS_TOKEN")
+    if metrics_token and request.headers.get("Authorization") != f"Bearer {metrics_token}":
+        return "Unauthorized", 401
+    return (
+        metrics.registry.render(),
+        200,
+        {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"},
+    )
+
+
+@app.errorhandler(ratelimit.RateLimited)
+def rate_limited(error):
+    """
+    It answers with a 503 when the app is too close to Spotify's rate limit to make the call in time,
+    so clients back off instead of seeing a server error
+
+    Returns:
+      The error and a Retry-After header.
+    """
+    logger.warning(f"{request.path}: {error}")
+    return jsonify({"error": "Too many requests, try again shortly."}), 503, {"Retry-After": "1"}
+
+
+def get_spotify_context(user_id):
+    """
+    It decrypts the user's stored token, refreshes it if needed, and builds a SpotifyContext for it.
+    The context is kept on `g`, so every helper called while handling the same request shares one
+    client and one /me lookup. Outside of a request, e.g. in a poller, it needs an app context
+
+    Args:
+      user_id: the user's id
+
+    Returns:
+      The SpotifyContext of the user.
+    """
+    contexts = g.setdefault("spotify_contexts", {})
+    if user_id not in contexts:
+        user_token = util.decrypt(users.get_field(user_id, "token"))
+        user_token = util.check_and_refresh_token(
+            sp_oauth,
+            users,
+            user_id,
+            user_token,
+            session if has_request_context() else {},
+        )
+        contexts[user_id] = spotify.SpotifyContext(user_token["access_token"])
+    return contexts[user_id]
 
 
 @app.route("/")
@@ -67,7 +297,7 @@ def index():
     if "auth" in session:
         data = util.get_cookie(session)
         util.check_and_refresh_token(
-            sp_oauth, collection, data["access_token"], session
+            sp_oauth, users, data["user_info"]["id"], data["access_token"], session
         )
         logger.info(f"{data['user_info']['id']} logged in")
         return redirect("/user/{}".format(data["user_info"]["id"]))
@@ -83,12 +313,14 @@ def home():
 @app.route("/settings")
 def settings():
     data = util.get_cookie(session)
-    util.check_and_refresh_token(sp_oauth, collection, data["access_token"], session)
     user_info = data["user_info"]
+    util.check_and_refresh_token(
+        sp_oauth, users, user_info["id"], data["access_token"], session
+    )
 
     user = {
         "user_display_name": user_info["display_name"],
-        "user_profile_picture": user_info["images"][0]["url"],
+        "user_profile_picture": get_image(user_info["images"]) or "",
         "profile_url": user_info["external_urls"]["spotify"],
         "followers": user_info["followers"]["total"],
         "user_id": user_info["id"],
@@ -100,7 +332,9 @@ def settings():
 def update_profile_link(user_id):
     data = util.get_cookie(session)
     user_info = data["user_info"]
-    util.check_and_refresh_token(sp_oauth, collection, data["access_token"], session)
+    util.check_and_refresh_token(
+        sp_oauth, users, user_info["id"], data["access_token"], session
+    )
     if user_info["id"] != user_id:
         return (
             jsonify({"error": "You are not authorized to update this profile link."}),
@@ -110,13 +344,7 @@ def update_profile_link(user_id):
     json_data = request.get_json()
 
     logger.debug(f"{data}")
-    try:
-        logger.error(f"{e}")
-        collection.insert_one({"_id": user_id, "profile_url": json_data["link"]})
-    except Exception as e:
-        collection.update_one(
-            {"_id": user_id}, {"$set": {"profile_url": json_data["link"]}}
-        )
+    users.set(user_id, profile_url=json_data["link"])
     return jsonify({"success": True})
 
 
@@ -160,23 +388,35 @@ def callback():
     token = sp_oauth.get_access_token(code, as_dict=True, check_cache=False)
     user_info = util.generate_cookie(session, token)["user_info"]
     logger.info(f"{user_info['id']} calledback")
-    if not collection.find_one({"_id": user_info["id"]}):
-        collection.insert_one(
-            {
-                "_id": user_info["id"],
-                "user_id": user_info["id"],
-                "token": util.encrypt(token),
-            }
-        )
+    users.create(
+        user_info["id"],
+        updates={"last_seen": int(time.time())},
+        user_id=user_info["id"],
+        **util.token_fields(token),
+    )
+    last_seen.set(user_info["id"], True)
     return redirect(url_for("index"))
 
 
+def mark_seen(user_id):
+    """
+    It saves that a user was just seen, so the token refresh scheduler keeps their token fresh
+
+    Args:
+      user_id: the user's id
+    """
+    if last_seen.get(user_id) is None:
+        last_seen.set(user_id, True)
+        users.set(user_id, last_seen=int(time.time()))
+
+
 @app.route("/user/<user_id>")
-@cache.cached(timeout=60, query_string=True, unless=lambda: request.args.get("refresh"))
 def user_top_page(user_id, is_base: bool = False):
     """
     It takes a user_id and a boolean value, and returns a rendered template of the user's top tracks and
-    artists, as well as the currently playing song
+    artists, as well as the currently playing song. Everything but the currently playing song is
+    cached for PROFILE_CACHE_TTL seconds, and its components are cached as fragments until their
+    section changes, so the page is assembled from cached markup and a fresh now playing block
 
     Args:
       user_id: The user's ID
@@ -186,79 +426,235 @@ def user_top_page(user_id, is_base: bool = False):
       A rendered template of the top page for the user.
     """
     logger.debug(f"{user_id} called")
-    if not collection.find_one({"_id": user_id}):
+    # one projected read of everything the page needs, the rest of the render reads it from cache
+    if (
+        users.get(
+            user_id, "token", "currently_playing", *spotify.PROFILE_SECTION_FIELDS
+        )
+        is None
+    ):
         return render_template("404.html"), 404
 
     if user_id == "favicon.ico":
         return redirect("/static/img/favicon.ico")
 
-    logger.info(f"{user_id} viewed their top page")
-    user_token = collection.find_one({"_id": user_id})["token"]
-    user_token = util.decrypt(user_token)
+    logger.debug(f"{user_id} viewed their top page")
+    mark_seen(user_id)
+    key = f"user_top_page/{user_id}/{is_base}"
+    profile = None if request.args.get("refresh") else cache.get(key)
+    if profile is None:
+        profile, failed_sections = render_flight.do(
+            key, partial(render_user_top_page, user_id, is_base)
+        )
+        # don't hold on to a page with missing sections
+        if not failed_sections:
+            cache.set(key, profile, timeout=PROFILE_CACHE_TTL)
 
-    user_token = util.check_and_refresh_token(sp_oauth, collection, user_token, session)
-    user_info = spotify.get_user_info(user_token["access_token"])
+    try:
+        currently_playing = get_currently_playing(user_id)
+    except Exception as e:
+        # like the other sections, a failing now playing block doesn't take the page down with it
+        logger.warning(f"{user_id} rendered without a fresh currently playing track: {e!r}")
+        currently_playing = (
+            users.get_field(user_id, "currently_playing") or spotify.nothing_playing()
+        )
+    has_currently_playing = currently_playing["track_name"] not in ("", "Nothing is playing")
+    return render_template(
+        "user_profile.jinja",
+        page="youraccount",
+        currently_playing=currently_playing,
+        has_currently_playing=has_currently_playing,
+        now_playing_poll_ms=CURRENTLY_PLAYING_TTL * 1000,
+        **profile,
+    )
+
+
+def render_user_top_page(user_id, is_base):
+    """
+    It fetches everything shown on a user's top page but the currently playing song, and renders the
+    components of the page
+
+    Args:
+      user_id: The user's ID
+      is_base (bool): if True, the page will be rendered with the track recommendations form disabled.
+
+    Returns:
+      A tuple of the template variables of the page and the names of the sections that couldn't be
+      fetched.
+    """
+    ctx = get_spotify_context(user_id)
+    user_info = ctx.user_info
+    sections, failed_sections = spotify.get_user_profile_sections(ctx, users, catalog)
+    if failed_sections:
+        logger.warning(f"{user_id} rendered without {', '.join(failed_sections)}")
     user = {
         "user_display_name": user_info["display_name"],
-        "user_profile_picture": user_info["images"][0]["url"],
-        "user_recommended_playlist_url": spotify.get_user_recommended_playlist(
-            user_token["access_token"]
-        )["external_urls"]["spotify"],
+        "user_profile_picture": get_image(user_info["images"]) or "",
+        "user_recommended_playlist_url": sections["recommended_playlist"][
+            "external_urls"
+        ]["spotify"],
         "profile_url": user_info["external_urls"]["spotify"],
         "followers": user_info["followers"]["total"],
         "user_id": user_info["id"],
     }
-    top_tracks = spotify.get_user_top_tracks(user_token["access_token"], collection)
-    top_artists = spotify.get_user_top_artists(user_token["access_token"], collection)
-    currently_playing = spotify.get_user_currently_playing(user_token["access_token"])
-    if currently_playing["track_name"] == "":
-        try:
-            currently_playing = collection.find_one({"_id": user_id})[
-                "currently_playing"
-            ]
-            if datetime.datetime.strptime(
-                currently_playing["datetime_added"]
-            ) < datetime.datetime.now() - datetime.timedelta(minutes=1):
-                raise "Cache expired"
-        except Exception as e:
-            collection.update_one(
-                {"_id": user_id},
-                {"$set": {"currently_playing": currently_playing}},
+    top_tracks = sections["top_tracks"]
+    top_artists = sections["top_artists"]
+    public_playlists = sections["public_playlists"]
+    components = {
+        "top_tracks": {
+            time_range: fragment_cache.render(
+                "components/top_card_tracks.jinja",
+                user_id,
+                time_range,
+                fragments.section_version(top_tracks),
+                top_tracks[time_range],
             )
-
-    if (
-        currently_playing["track_name"] == "Nothing is playing"
-        or currently_playing["track_name"] == ""
-    ):
-        has_currently_playing = False
-        print("has_currently_playing is false")
-        logger.debug(f"{user_id} has nothing playing")
-    else:
-        has_currently_playing = True
-        logger.debug(f"{currently_playing}")
-    user_data = {"top_tracks": top_tracks, "top_artists": top_artists}
-    return render_template(
-        "user_profile.jinja",
-        page="youraccount",
-        user=user,
-        user_data=user_data,
-        currently_playing=currently_playing,
-        base=is_base,
-        has_currently_playing=has_currently_playing,
-        top_genres=spotify.get_user_top_genres(user_token["access_token"], collection)[
-            "genres"
-        ][0:10],
-        public_playlists=spotify.get_user_public_playlists(
-            user_token["access_token"], collection
-        )["playlists"],
-    )
+            for time_range in spotify.TIME_RANGES
+        },
+        "top_artists": {
+            time_range: fragment_cache.render(
+                "components/top_card_artists.jinja",
+                user_id,
+                time_range,
+                fragments.section_version(top_artists),
+                top_artists[time_range],
+            )
+            for time_range in spotify.TIME_RANGES
+        },
+        "public_playlists": fragment_cache.render(
+            "components/public_playlists.jinja",
+            user_id,
+            "public_playlists",
+            fragments.section_version(public_playlists, user["user_display_name"]),
+            public_playlists["playlists"],
+            user,
+        ),
+    }
+    profile = {
+        "user": user,
+        "base": is_base,
+        "top_genres": sections["top_genres"]["genres"][0:10],
+        "components": components,
+    }
+    return profile, failed_sections
 
 
 @app.route("/user/<user_id>/currently_playing")
-@cache.memoize(timeout=120)
 def user_currently_playing(user_id):
     """
-    It gets the currently playing track for a user, and updates the database with the track information
+    It returns the currently playing track of a user, with an ETag derived from the track and whether
+    it is playing. The track is only fetched from Spotify once per CURRENTLY_PLAYING_TTL seconds, so
+    clients can poll every few seconds, and a client sending the ETag it already has gets an empty
+    304 until something changes
+
+    Args:
+      user_id: the user's id
+
+    Returns:
+      The currently playing song of the user.
+    """
+    currently_playing = get_currently_playing(user_id)
+    response = jsonify(currently_playing)
+    response.set_etag(spotify.currently_playing_etag(currently_playing))
+    response.headers["Cache-Control"] = "no-cache"
+    return response.make_conditional(request)
+
+
+@app.route("/user/<user_id>/currently_playing/stream")
+def user_currently_playing_stream(user_id):
+    """
+    It streams the currently playing track of a user as Server-Sent Events: the current track right
+    away, then every change. The track is fetched by one poller per watched user, shared by all of
+    their viewers. A stream ends after NOW_PLAYING_STREAM_MAX_AGE seconds and the browser reconnects,
+    so a connection doesn't hold a worker thread forever. A worker serves at most
+    NOW_PLAYING_MAX_STREAMS streams at once, past them it answers with a 503 and the page polls
+    /currently_playing instead, so open profiles can't take every thread of the worker
+
+    Args:
+      user_id: the user's id
+
+    Returns:
+      A text/event-stream response.
+    """
+    if not users.exists(user_id):
+        return jsonify({"error": "User not found."}), 404
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    if request.method == "HEAD":
+        # the body would never be read, so there's nothing to subscribe to
+        return Response(mimetype="text/event-stream", headers=headers)
+    if not now_playing_streams.acquire(blocking=False):
+        return (
+            jsonify({"error": "Too many streams, poll the currently playing track instead."}),
+            503,
+            {"Retry-After": str(CURRENTLY_PLAYING_TTL)},
+        )
+    try:
+        currently_playing = get_currently_playing(user_id)
+        subscription = now_playing.subscribe(user_id)
+    except BaseException:
+        now_playing_streams.release()
+        raise
+
+    def event(currently_playing):
+        etag = spotify.currently_playing_etag(currently_playing)
+        return f"id: {etag}\nevent: currently_playing\ndata: {json.dumps(currently_playing)}\n\n"
+
+    def stream():
+        try:
+            yield f"retry: {NOW_PLAYING_RETRY_MS}\n"
+            yield event(currently_playing)
+            last_etag = spotify.currently_playing_etag(currently_playing)
+            deadline = time.monotonic() + NOW_PLAYING_STREAM_MAX_AGE
+            while time.monotonic() < deadline:
+                update = subscription.get(timeout=NOW_PLAYING_HEARTBEAT)
+                if update is None:
+                    # keeps proxies from closing an idle connection
+                    yield ": keep-alive\n\n"
+                    continue
+                etag = spotify.currently_playing_etag(update)
+                if etag != last_etag:
+                    last_etag = etag
+                    yield event(update)
+        finally:
+            subscription.close()
+
+    response = Response(stream(), mimetype="text/event-stream", headers=headers)
+    # called even when the client leaves before the stream starts, unlike the generator's finally
+    response.call_on_close(subscription.close)
+    response.call_on_close(now_playing_streams.release)
+    return response
+
+
+def get_currently_playing(user_id):
+    """
+    It returns the cached currently playing track of a user, fetching it if it expired. Concurrent
+    fetches of the same user share one call
+
+    Args:
+      user_id: the user's id
+
+    Returns:
+      The currently playing song of the user.
+    """
+    key = f"currently_playing/{user_id}"
+    currently_playing = cache.get(key)
+    if currently_playing is None:
+        currently_playing = render_flight.do(
+            key, partial(refresh_currently_playing, user_id)
+        )
+    return currently_playing
+
+
+def poll_currently_playing(user_id):
+    with app.app_context():
+        return refresh_currently_playing(user_id)
+
+
+def refresh_currently_playing(user_id):
+    """
+    It fetches the currently playing track of a user and caches it for CURRENTLY_PLAYING_TTL seconds.
+    The user's document is only written when the track or its state changed, and otherwise the saved
+    copy is kept as it is, so the response stays the same as long as the ETag does
 
     Args:
       user_id: the user's id
@@ -266,15 +662,21 @@ def user_currently_playing(user_id):
     Returns:
       The currently playing song of the user.
     """
-    user_token = util.decrypt(collection.find_one({"_id": user_id})["token"])
-    user_token = util.check_and_refresh_token(sp_oauth, collection, user_token, session)
-    currently_playing = spotify.get_user_currently_playing(user_token["access_token"])
-    collection.update_one(
-        {"_id": user_id},
-        {"$set": {"currently_playing": currently_playing}},
+    # one read for both fields, the token is then read from the document cache
+    previous = (users.get(user_id, "token", "currently_playing") or {}).get(
+        "currently_playing"
     )
-    logger.info(f"{user_id} is currently playing {currently_playing['track_name']}")
-    return jsonify(currently_playing)
+    ctx = get_spotify_context(user_id)
+    currently_playing = spotify.get_user_currently_playing(ctx)
+    if spotify.is_same_playback(previous, currently_playing):
+        currently_playing = previous
+    else:
+        users.set(user_id, currently_playing=currently_playing)
+        logger.debug(f"{user_id} is now playing {currently_playing['track_name']}")
+    cache.set(
+        f"currently_playing/{user_id}", currently_playing, timeout=CURRENTLY_PLAYING_TTL
+    )
+    return currently_playing
 
 
 @app.route("/user/<user_id>/add_to_queue", methods=["POST"])
@@ -289,33 +691,88 @@ def add_to_queue(user_id):
     Returns:
       The user is being redirected to the user_top_tracks page.
     """
-    user_token = util.decrypt(collection.find_one({"_id": user_id})["token"])
-    user_token = util.check_and_refresh_token(sp_oauth, collection, user_token, session)
+    ctx = get_spotify_context(user_id)
     spotify_link = request.form["link"]
-    spotify.add_track_to_queue(user_token["access_token"], spotify_link)
-    logger.info(f"added {spotify_link} to {user_id} queue")
+    try:
+        spotify.add_track_to_queue(ctx, spotify_link)
+    except ValueError:
+        return "This isn't a Spotify track link", 400
+    logger.debug(f"added {spotify_link} to {user_id} queue")
     return redirect(url_for("user_top_page", user_id=user_id))
 
 
 @app.route("/user/<user_id>/add_track_to_recommended_playlist", methods=["POST"])
 def add_track_to_recommended_playlist(user_id):
     """
-    It takes a user id, finds the user's token, checks if the token is expired, if it is, it refreshes
-    the token, then it adds the track to the user's recommended playlist.
+    It queues the posted track to be added to the user's recommended playlist and answers right away,
+    the track is added in the background with the other tracks suggested in the meantime
 
     Args:
       user_id: the user's id
 
     Returns:
-    The user is being redirected to the user_top_tracks page.
+    The user is being redirected to the user_top_tracks page, with the id of the submission. Clients
+    asking for JSON get the submission itself, and where to follow its status.
     """
-    user_token = util.decrypt(collection.find_one({"_id": user_id})["token"])
-    user_token = util.check_and_refresh_token(sp_oauth, collection, user_token, session)
-    spotify.add_track_to_recommended_playlist(
-        user_token["access_token"], request.form["link"]
+    if not users.exists(user_id):
+        return render_template("404.html"), 404
+    try:
+        uri = spotify.get_uri_from_track_url(request.form["link"])
+    except (KeyError, ValueError):
+        return "This isn't a Spotify track link", 400
+    submission = submissions.submit(user_id, uri)
+    logger.debug(f"queued {uri} for {user_id} playlist")
+    if request.accept_mimetypes.best == "application/json":
+        response = jsonify(submission)
+        response.status_code = 202
+        response.headers["Location"] = url_for(
+            "submission_status", user_id=user_id, submission_id=submission["id"]
+        )
+        return response
+    return redirect(
+        url_for(
+            "user_top_page",
+            user_id=user_id,
+            track_added=True,
+            submission=submission["id"],
+        )
     )
-    logger.info(f"added {request.form['link']} to {user_id} playlist")
-    return redirect(url_for("user_top_page", user_id=user_id, track_added=True))
+
+
+@app.route("/user/<user_id>/submissions/<submission_id>")
+def submission_status(user_id, submission_id):
+    """
+    It tells whether a suggested track was added to the user's recommended playlist yet
+
+    Args:
+      user_id: the user's id
+      submission_id: the id the submission was given when it was posted
+
+    Returns:
+      The submission, with its status: queued, added, duplicate or failed.
+    """
+    submission = submissions.status(submission_id)
+    if submission is None or submission["user_id"] != user_id:
+        return jsonify({"error": "Unknown submission"}), 404
+    return jsonify(submission)
+
+
+def add_submitted_tracks(user_id, uris):
+    with app.app_context():
+        ctx = get_spotify_context(user_id)
+        try:
+            spotify.add_tracks_to_recommended_playlist(ctx, users, uris)
+        except SpotifyException as e:
+            # a bad request is about the tracks, anything else is worth trying again
+            if e.http_status == 400:
+                raise Rejected(e.msg) from e
+            raise
+
+
+def recommended_playlist_uris(user_id):
+    with app.app_context():
+        ctx = get_spotify_context(user_id)
+        return spotify.get_recommended_playlist_uris(ctx, users)
 
 
 @app.route("/user/<user_id>/public_playlists")
@@ -329,9 +786,8 @@ def get_user_public_playlists(user_id):
     Returns:
       The user's public playlists
     """
-    user_token = util.decrypt(collection.find_one({"_id": user_id})["token"])
-    user_token = util.check_and_refresh_token(sp_oauth, collection, user_token, session)
-    playlists = spotify.get_user_public_playlists(user_token["access_token"])
+    ctx = get_spotify_context(user_id)
+    playlists = spotify.get_user_public_playlists(ctx, users)
     return jsonify(playlists)
 
 
@@ -346,9 +802,8 @@ def get_user_top_genres(user_id):
     Returns:
       The user's top genres
     """
-    user_token = util.decrypt(collection.find_one({"_id": user_id})["token"])
-    user_token = util.check_and_refresh_token(sp_oauth, collection, user_token, session)
-    top_genres = spotify.get_user_top_genres(user_token["access_token"], collection)
+    ctx = get_spotify_context(user_id)
+    top_genres = spotify.get_user_top_genres(ctx, users, catalog)
     return jsonify(top_genres)
 
 
@@ -363,9 +818,9 @@ def get_user_top_artists(user_id):
     Returns:
       The user's top artists
     """
-    user_token = util.decrypt(collection.find_one({"_id": user_id})["token"])
-    user_token = util.check_and_refresh_token(sp_oauth, collection, user_token, session)
-    top_artists = spotify.get_user_top_artists(user_token["access_token"], collection)
+    ctx = get_spotify_context(user_id)
+    top_artists = spotify.get_user_top_artists(ctx, users, catalog)
+    top_artists = spotify.hydrate_sections(catalog, top_artists)[0]
     return jsonify(top_artists)
 
 
@@ -380,16 +835,18 @@ def get_user_top_tracks(user_id):
     Returns:
       The user's top tracks
     """
-    user_token = util.decrypt(collection.find_one({"_id": user_id})["token"])
-    user_token = util.check_and_refresh_token(sp_oauth, collection, user_token, session)
-    top_tracks = spotify.get_user_top_tracks(user_token["access_token"], collection)
+    ctx = get_spotify_context(user_id)
+    top_tracks = spotify.get_user_top_tracks(ctx, users, catalog)
+    top_tracks = spotify.hydrate_sections(catalog, top_tracks)[0]
     return jsonify(top_tracks)
 
 
 @app.route("/user/<user_id>/recently_played")
 def get_user_recently_played(user_id):
     """
-    It gets the user's recently played tracks
+    It gets a page of the user's recently played tracks, newest first. The next page is read by
+    passing the `datetime_played` of the last track as `before`, which the Link header of a full page
+    already does
 
         Args:
             user_id: the user's id
@@ -397,12 +854,27 @@ def get_user_recently_played(user_id):
         Returns:
             The user's recently played tracks
     """
-    user_token = util.decrypt(collection.find_one({"_id": user_id})["token"])
-    user_token = util.check_and_refresh_token(sp_oauth, collection, user_token, session)
+    limit = min(max(request.args.get("limit", 50, type=int), 1), 50)
+    before = request.args.get("before")
+    if before:
+        try:
+            before = spotify.parse_played_at(before)
+        except ValueError:
+            return jsonify({"error": "before isn't a valid time"}), 400
+    ctx = get_spotify_context(user_id)
     recently_played = spotify.get_user_recently_played(
-        user_token["access_token"], collection
+        ctx, users, history, limit=limit, before=before or None
     )
-    return jsonify(recently_played)
+    response = jsonify(recently_played)
+    if len(recently_played) == limit:
+        next_page = url_for(
+            "get_user_recently_played",
+            user_id=user_id,
+            limit=limit,
+            before=recently_played[-1]["datetime_played"],
+        )
+        response.headers["Link"] = f'<{next_page}>; rel="next"'
+    return response
 
 
 @app.errorhandler(404)
@@ -410,13 +882,40 @@ def page_not_found(e):
     return render_template("404.html", the_title="404"), 404
 
 
+def start_worker():
+    """
+    It gets a worker ready to serve: it connects to MongoDB and Redis and opens the pool of
+    connections to Spotify now, instead of on the first requests, and starts the background token
+    refreshes. Every worker process calls it once, after it's forked, so no client is shared across
+    processes. It fails right away when ENCRYPTION_KEY isn't set, as the stored tokens can't be read
+    without it
+    """
+    crypto.get_cipher()
+    app.secret_key = crypto.session_key()
+    try:
+        client.admin.command("ping")
+        if redis_client is not None:
+            redis_client.ping()
+    except Exception as e:
+        logger.error(f"worker started without its databases: {e!r}")
+    spotify_client.shared_session()
+    token_refresh_scheduler.start()
+    logger.info(f"worker {os.getpid()} started")
+
+
+def stop_worker():
+    """
+    It lets a worker finish what it still holds before it exits: the submitted tracks waiting to be
+    added are added now, instead of being lost with the process
+    """
+    submissions.stop()
+    logger.info(f"worker {os.getpid()} stopped")
+
+
 # overrides the default
-# WSGIRequestHandler class to make it log the IP address of the client instead
-# of the IP address of the proxy server
+# WSGIRequestHandler class to only log the request line and the status, the client's address is
+# taken from X-Forwarded-For by ProxyFix
 class MyRequestHandler(WSGIRequestHandler):
-    def address_string(self):
-        return self.headers["X-Forwarded-For"]
-
     def log_date_time_string(self):
         return ""
 
@@ -425,7 +924,9 @@ class MyRequestHandler(WSGIRequestHandler):
 
 
 if __name__ == "__main__":
-    app.secret_key = os.getenv("ENCRYPTION_KEY")
+    # the development server, see wsgi.py and gunicorn.conf.py for production
+    start_worker()
+    atexit.register(stop_worker)
     logger = logging.getLogger("spotify")
     logger.setLevel(logging.DEBUG)
     app.run(
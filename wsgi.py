@@ -0,0 +1,8 @@
+"""
+The production entry point of the app. It's served by gunicorn with the settings in gunicorn.conf.py,
+which calls `start_worker` in every worker once it's forked, and `stop_worker` before it exits
+
+Usage:
+  gunicorn -c gunicorn.conf.py wsgi:app
+"""
+from routes import app, start_worker, stop_worker  # noqa: F401